@@ -32,11 +32,22 @@ from google.appengine.api import users
 from google.appengine.ext import db
 from google.appengine.api import images
 from google.appengine.api import memcache
+from google.appengine.api import datastore
+from google.appengine.api.labs import taskqueue
+
+# 3rd partly libs
+import simplejson as json
 
 # local imports
-from model import Developer, Game, Score, ScoreField, Category, DefaultValues
+from model import Developer, Game, Score, ScoreField, Category, DefaultValues, ScoresCountry
 from util import *
 import configuration
+import ranking
+from ranker import ranker
+import counter
+import meter
+import windows
+from gameconfig import invalidate_config
 
 def admin_required(func):
     """Ensure that the logged in user is an administrator."""
@@ -146,11 +157,12 @@ class ListGamesReady(BaseHandler):
     @admin_required
     def get(self):
 #        games = Game.all().filter('publish =',True).order('-creationdate')
-        games = Game.all().filter('publish =',True)
+        games = Game.all().filter('publish =',True).fetch(1000)
+        counter.prefetch_total_scores( games )
 
         params = {
             'games' : games,
-            'total' : games.count(),
+            'total' : len( games ),
             'page' : {'title' : 'Games'},
         }
         self.respond('admin-games-ready', params)
@@ -196,6 +208,7 @@ class ListGamesReady(BaseHandler):
 
         game.publish = new_value
         game.put()
+        invalidate_config( game.key().name() )
 # 
 #
 # '/admin/list-games-not-ready' handler
@@ -205,11 +218,12 @@ class ListGamesNotReady(BaseHandler):
     @admin_required
     def get(self):
 #        games = Game.all().filter('publish =',False).order('-creationdate')
-        games = Game.all().filter('publish =',False)
+        games = Game.all().filter('publish =',False).fetch(1000)
+        counter.prefetch_total_scores( games )
 
         params = {
             'games' : games,
-            'total' : games.count(),
+            'total' : len( games ),
             'page' : {'title' : 'Games'},
         }
         self.respond('admin-games', params)
@@ -255,6 +269,7 @@ class ListGamesNotReady(BaseHandler):
 
         game.publish = new_value
         game.put()
+        invalidate_config( game.key().name() )
 # 
 #
 # '/admin/memcache' handler
@@ -264,7 +279,39 @@ class MemCache(BaseHandler):
     @admin_required
     def get(self):
         status = memcache.get_stats()
-        params = { 'status' : status }
+
+        # ranker node cache hits/misses, per game and category.
+        # The counters of every shard of every ranker are read with 1 get_multi
+        entities = datastore.Query('Ranking').Get(1000)
+        keys = []
+        for entity in entities:
+            for rootkey in ranking.rootkeys( entity ):
+                keys.extend( ranker.CacheStatsKeys( rootkey ) )
+        counts = memcache.get_multi( keys )
+
+        rankers = []
+        for entity in entities:
+            hits = misses = 0
+            for rootkey in ranking.rootkeys( entity ):
+                hits_key, misses_key = ranker.CacheStatsKeys( rootkey )
+                hits += counts.get( hits_key, 0 )
+                misses += counts.get( misses_key, 0 )
+            rankers.append( {
+                'game' : entity.key().parent().name(),
+                'category' : entity.key().name(),
+                'hits' : hits,
+                'misses' : misses,
+                } )
+
+        # geo ip lookups: where the answers came from
+        geoip_instance, geoip_total = getGeoIPStats()
+
+        params = {
+            'status' : status,
+            'rankers' : rankers,
+            'geoip_instance' : geoip_instance,
+            'geoip_total' : geoip_total,
+        }
         self.respond('admin-cache', params)
 # 
 #
@@ -278,6 +325,233 @@ class FlushMemCache(BaseHandler):
         self.redirect('/admin/memcache' )
 # 
 #
+# '/admin/usage' handler
+#
+class Usage(BaseHandler):
+    '''Games ordered by number of queries in the current day / week / month / year'''
+
+    @admin_required
+    def get(self):
+        period = self.request.get('period')
+        if period not in meter.PERIODS:
+            period = 'day'
+
+        entries = meter.get_report( period )
+        usage = []
+        for e in entries:
+            usage.append( {
+                'game' : e.parent_key().name(),
+                'push' : e.quantity_push,
+                'pop' : e.quantity_pop,
+                'total' : e.quantity_push + e.quantity_pop,
+                } )
+
+        params = {
+            'usage' : usage,
+            'period' : period,
+            'periods' : meter.PERIODS,
+            'page' : {'title' : 'Usage'},
+        }
+        self.respond('admin-usage', params)
+# 
+#
+# '/admin/write-meter' handler. Runs from the task queue
+#
+class WriteMeter(BaseHandler):
+    '''Adds the usage counted by an instance to the NumberOfQueries buckets'''
+
+    def post(self):
+        counts = json.loads( self.request.get('counts') )
+        when = datetime.datetime.utcfromtimestamp( int( self.request.get('when') ) )
+        for (gamename, (pushes, pops)) in counts.iteritems():
+            game = Game.get_by_key_name( gamename )
+            if not game:
+                logging.warning('WriteMeter: game not found %s' % gamename )
+                continue
+            meter.write( game, pushes, pops, when )
+# 
+#
+# '/admin/migrate-countries' handler
+#
+class MigrateCountries(BaseHandler):
+    '''Moves the ScoresCountry of every game to their 'cc_' + country code key names'''
+
+    @admin_required
+    def get(self):
+        for key in Game.all( keys_only=True ):
+            taskqueue.add( url='/admin/migrate-countries-game', params={'gamename' : key.name()} )
+        self.redirect('/admin/')
+# 
+#
+# '/admin/migrate-countries-game' handler. Runs from the task queue
+#
+class MigrateCountriesGame(BaseHandler):
+    '''Moves the ScoresCountry of a game to their 'cc_' + country code key names.
+    Duplicated rows of a country are merged'''
+
+    def post(self):
+        gamename = self.request.get('gamename')
+        game = Game.get_by_key_name( gamename )
+        if not game:
+            logging.error('MigrateCountriesGame: game not found %s' % gamename )
+            return
+        db.run_in_transaction( self.migrate, game )
+
+    def migrate( self, game ):
+        by_country = {}
+        for sc in ScoresCountry.all().ancestor( game ).fetch( 1000 ):
+            by_country.setdefault( sc.country_code, [] ).append( sc )
+
+        to_put = []
+        to_delete = []
+        for (country_code, rows) in by_country.iteritems():
+            key_name = ScoresCountry.key_name_for( country_code )
+            new = None
+            for sc in rows:
+                if sc.key().name() == key_name:
+                    new = sc
+            if new is None:
+                new = ScoresCountry.new( game, country_code )
+
+            old = [ sc for sc in rows if sc is not new ]
+            if old:
+                for sc in old:
+                    new.quantity += sc.quantity
+                to_put.append( new )
+                to_delete.extend( old )
+
+        db.put( to_put )
+        db.delete( to_delete )
+# 
+#
+# '/admin/reconcile-all-counters' handler
+#
+class ReconcileAllCounters(BaseHandler):
+    '''Starts the reconciliation of the score counters of every game.
+    The games are reconciled one at a time: each one starts the next one when it is done'''
+
+    @admin_required
+    def get(self):
+        first = Game.all( keys_only=True ).order('__key__').get()
+        if first is not None:
+            taskqueue.add( url='/admin/reconcile-counters', params={'gamename' : first.name(), 'chain' : 1} )
+        self.redirect('/admin/')
+# 
+#
+# '/admin/reconcile-counters' handler. On demand (GET) and from the task queue (POST)
+#
+# number of scores counted per task
+RECONCILE_BATCH_SIZE = 200
+
+# seconds between the tasks of a reconciliation, so it doesn't compete with the game's requests
+RECONCILE_DELAY = 5
+
+class ReconcileCounters(BaseHandler):
+    '''Counts the scores of a game by country, RECONCILE_BATCH_SIZE scores per task,
+    and then fixes the sharded counters of the game'''
+
+    @admin_required
+    def get(self):
+        '''reconciles the counters of the game 'gamename' '''
+        gamename = self.request.get('gamename')
+        if gamename:
+            taskqueue.add( url='/admin/reconcile-counters', params={'gamename' : gamename} )
+        self.redirect('/admin/')
+
+    def next_game( self, game_key ):
+        '''starts the reconciliation of the game after game_key, if any'''
+        next = Game.all( keys_only=True ).filter( '__key__ >', game_key ).order('__key__').get()
+        if next is not None:
+            taskqueue.add( url='/admin/reconcile-counters', params={'gamename' : next.name(), 'chain' : 1}, countdown=RECONCILE_DELAY )
+
+    def post(self):
+        gamename = self.request.get('gamename')
+        game = Game.get_by_key_name( gamename )
+        if not game:
+            logging.error('ReconcileCounters: game not found %s' % gamename )
+            if self.request.get('chain'):
+                self.next_game( db.Key.from_path( 'Game', gamename ) )
+            return
+
+        # counted by the previous tasks
+        countries = {}
+        if self.request.get('countries'):
+            countries = json.loads( self.request.get('countries') )
+
+        query = Score.all().ancestor( game )
+        cursor = self.request.get('cursor')
+        if cursor:
+            query.with_cursor( cursor )
+        scores = query.fetch( RECONCILE_BATCH_SIZE )
+
+        for s in scores:
+            countries[ s.cc_country ] = countries.get( s.cc_country, 0 ) + 1
+
+        if len(scores) == RECONCILE_BATCH_SIZE:
+            taskqueue.add( url='/admin/reconcile-counters', params={
+                'gamename' : gamename,
+                'cursor' : query.cursor(),
+                'countries' : json.dumps( countries ),
+                'chain' : self.request.get('chain'),
+                }, countdown=RECONCILE_DELAY )
+        else:
+            counter.reconcile_scores( game, countries )
+            if self.request.get('chain'):
+                self.next_game( game.key() )
+# 
+#
+# '/admin/sweep-windows' handler. Runs from cron, and from the task queue while there is more to delete
+#
+class SweepWindows(BaseHandler):
+    '''Deletes the scores and the rankers of the expired leaderboard windows'''
+
+    def get(self):
+        self.post()
+
+    def post(self):
+        if not windows.sweep():
+            taskqueue.add( url='/admin/sweep-windows' )
+# 
+#
+# '/admin/upgrade-rankers' handler
+#
+class UpgradeRankers(BaseHandler):
+    '''Stores the cumulative counts in the nodes of every ranker. See Ranker.UpgradeNodes'''
+
+    @admin_required
+    def get(self):
+        for entity in datastore.Query('Ranking').Get(1000):
+            if entity.get('bucket_size'):
+                # bucket rankers always store their cumulative counts
+                continue
+            for rootkey in ranking.rootkeys( entity ):
+                taskqueue.add( url='/admin/upgrade-ranker', params={'rootkey' : str(rootkey) } )
+        self.redirect('/admin/')
+# 
+#
+# '/admin/upgrade-ranker' handler. Runs from the task queue
+#
+# number of nodes upgraded per task (and per transaction)
+UPGRADE_BATCH_SIZE = 100
+
+class UpgradeRanker(BaseHandler):
+    '''Upgrades the nodes of a ranker, UPGRADE_BATCH_SIZE nodes per task'''
+
+    def post(self):
+        rootkey = datastore.Key( self.request.get('rootkey') )
+        after = None
+        if self.request.get('after'):
+            after = datastore.Key( self.request.get('after') )
+
+        upgraded, last_key = ranker.Ranker( rootkey ).UpgradeNodes( after, UPGRADE_BATCH_SIZE )
+        logging.info('UpgradeRanker: %s: %d nodes upgraded' % (rootkey, upgraded) )
+        if last_key is not None:
+            taskqueue.add( url='/admin/upgrade-ranker', params={
+                'rootkey' : str(rootkey),
+                'after' : str(last_key),
+                } )
+# 
+#
 # '/admin/list-devs' handler
 #
 class ListDevelopers(BaseHandler):
@@ -378,6 +652,15 @@ application = webapp.WSGIApplication([
         ('/admin/list-devs-updates', ListDevelopersUpdates),
         ('/admin/memcache', MemCache),
         ('/admin/flush-cache', FlushMemCache),
+        ('/admin/usage', Usage),
+        ('/admin/write-meter', WriteMeter),
+        ('/admin/migrate-countries', MigrateCountries),
+        ('/admin/migrate-countries-game', MigrateCountriesGame),
+        ('/admin/reconcile-all-counters', ReconcileAllCounters),
+        ('/admin/reconcile-counters', ReconcileCounters),
+        ('/admin/sweep-windows', SweepWindows),
+        ('/admin/upgrade-rankers', UpgradeRankers),
+        ('/admin/upgrade-ranker', UpgradeRanker),
         ('/admin/', AdminHandler),
         ],
         debug=True)
@@ -17,6 +17,7 @@ import hashlib
 import logging
 
 # GAE imports
+from google.appengine.api.labs import taskqueue
 from google.appengine.api import datastore
 from google.appengine.api import datastore_errors
 from google.appengine.api import datastore_types
@@ -31,8 +32,18 @@ import simplejson as json
 # local imports
 from model import *
 from util import *
+from schema import get_schema
+import pagecache
+import meter
+from paging import fetch_page
+import configuration
+import counter
+from prefetch import Prefetcher
+import rpcstats
 
-from ranker import ranker
+import ranking
+import gameconfig
+import windows
 
 
 class BaseHandler( webapp.RequestHandler):
@@ -42,20 +53,92 @@ class BaseHandler( webapp.RequestHandler):
         self.game = None
         self.game_name = ''
 
+        # entities needed by the request
+        self.prefetcher = Prefetcher()
+
+        # category -> ranker opened by this request
+        self.rankers = {}
+
     def get_ranker( self, game_key, category ):
-        key = datastore_types.Key.from_path("Ranking", category, parent=game_key )
-        return ranker.Ranker(datastore.Get(key)["ranker"])
+        r = self.rankers.get( category )
+        if r is None:
+            # the game snapshot knows the ranker roots
+            r = self.game.get_ranker( category )
+            if r is None:
+                r = ranking.get_ranker( game_key, category, self.prefetcher )
+            self.rankers[ category ] = r
+        return r
+
+    def get_or_create_ranker( self, game_key, category, expires=None ):
+        r = self.rankers.get( category )
+        if r is None:
+            r = self.game.get_ranker( category )
+            if r is None:
+                r = ranking.get_or_create_ranker( self.game, category, self.prefetcher, expires )
+                # a new ranker: the snapshot of the game doesn't have it
+                gameconfig.invalidate_config( self.game_name )
+            self.rankers[ category ] = r
+        return r
+
+    def prefetch( self, gamename, category, country=None ):
+        '''adds the keys of the game, its Ranking and its ScoresCountry to the prefetcher,
+        so that they are fetched with a single Get'''
+        game_name = self.request.get( gamename )
+        if not game_name:
+            return
+        game_key = db.Key.from_path( 'Game', game_name )
+
+        # not needed if this instance has the snapshot of the game
+        config = gameconfig.peek_config( game_name )
+        if config is None:
+            self.prefetcher.add( game_key )
+        if category and ( config is None or category not in config.rankings ):
+            self.prefetcher.add( ranking.ranking_key( game_key, category ) )
+        if country:
+            self.prefetcher.add( ScoresCountry.key_for( game_key, country ) )
+
+    def get_country_ranker( self, category, country, create=False, lookup=False ):
+        '''returns the ranker of a category in a country, or None if the country doesn't have one.
+        create: creates it if the category has less than ranking_countries country rankers.
+        The rankers known by the game snapshot are counted, so the limit is approximate.
+        lookup: if the snapshot doesn't know the ranker, looks for its Ranking entity.
+        The snapshot can miss a ranker created by another instance: use it to remove scores'''
+        if not self.game.ranking_countries or not country or country == 'xx':
+            return None
+        name = ranking.country_ranking_name( category, country )
+        if name in self.rankers or name in self.game.rankings:
+            return self.get_ranker( self.game.key(), name )
+        if lookup:
+            try:
+                return self.get_ranker( self.game.key(), name )
+            except datastore_errors.EntityNotFoundError, e:
+                pass
+        if not create:
+            return None
+        prefix = ranking.country_ranking_name( category, '' )
+        existing = [ n for n in self.game.rankings if n.startswith( prefix ) ]
+        if len( existing ) >= self.game.ranking_countries:
+            return None
+        return self.get_or_create_ranker( self.game.key(), name )
+
+    def get_window( self ):
+        '''returns the name of the current window of the 'querytype' argument,
+        or None for all time queries and for the games without windowed leaderboards.
+        validate_name already checked that it is a number'''
+        query_type = self.request.get('querytype')
+        if not query_type:
+            return None
+        period = QUERY_PERIODS.get( int(query_type) )
+        if period is None or not self.game.windowed_leaderboards:
+            return None
+        return windows.current_window( period )[0]
 
-    def get_or_create_ranker( self, game_key, category ):
-        key = datastore_types.Key.from_path("Ranking", category, parent=game_key )
-        try:
-            return ranker.Ranker(datastore.Get(key)["ranker"])
-        except datastore_errors.EntityNotFoundError:
-            r = ranker.Ranker.Create([self.game.ranking_min_score, self.game.ranking_max_score], self.game.ranking_branch_factor)
-            app = datastore.Entity("Ranking", name=category, parent=game_key )
-            app["ranker"] = r.rootkey
-            datastore.Put(app)
-            return r
+    def get_ranking_name( self, category ):
+        '''returns the name of the ranker of a category in the window of the request'''
+        window = self.get_window()
+        if window is None:
+            return category
+        return windows.ranking_name( category, window )
 
 
     def validate_name(self, gamename ='gamename'):
@@ -69,11 +152,19 @@ class BaseHandler( webapp.RequestHandler):
             self.response.out.write('variable %s not found' % gamename)
             return False
 
-        self.game = Game.get_by_key_name( self.game_name )
+        # read only snapshot of the game
+        self.game = gameconfig.get_config( self.game_name, self.prefetcher )
         if not self.game:
             self.response.set_status(400)
             self.response.out.write('game not found %s' % self.game_name)
             return False
+
+        # the window of the leaderboard. See get_window
+        query_type = self.request.get('querytype')
+        if query_type and not query_type.isdigit():
+            self.response.set_status(400)
+            self.response.out.write('invalid querytype %s' % query_type)
+            return False
         return True
 
 #
@@ -86,6 +177,13 @@ class BaseHandler( webapp.RequestHandler):
 # Query type:
 QueryIgnore, QueryDay, QueryWeek, QueryMonth, QueryAllTime = xrange(5)
 #
+# Query type -> leaderboard window period. See windows.py
+QUERY_PERIODS = {
+    QueryDay : 'day',
+    QueryWeek : 'week',
+    QueryMonth : 'month',
+}
+#
 # Query flags:
 QueryFlagNone = 0
 QueryFlagByCountry = 1 << 0
@@ -126,78 +224,95 @@ class QueryHandler(BaseHandler):
     def cast_value_to_type( self, key, value ):
         '''cast a value to a certain type given it's key'''
 
-        query = db.Query(ScoreField)
-        query.filter('name = ', key).ancestor(self.game)
-        result = query.fetch(1)[0]
+        # strings are not casted... they are already strings
+        return get_schema( self.game ).cast( key, value )
+
+
+    def save_country( self, score_country ):
+        '''stores the ScoresCountry if it is new. Run it in the game's transaction (see ScoresCountry.insert).
+        The number of scores is kept by the sharded counters'''
+        if not score_country.is_saved():
+            score_country.insert()
+
+
+    def count_scores( self, countries ):
+        '''updates the total number of scores and the number of scores by country.
+        countries: dict country_code -> number of new scores.
+        Call it after the scores were written: the counters don't run in the game's transaction'''
+        counter.add_scores( self.game, countries )
+
 
-        if result.type == 'int':
-            return int(value)
-        if result.type == 'float':
-            return float(value)
-        # don't cast strings... they are already strings
-        return value
+    def save_copies( self, score, copies ):
+        '''saves the WindowScores of a saved score. Run it in the game's transaction'''
+        if copies:
+            db.put( windows.link( [ (score, copy) for copy in copies ] ) )
 
 
-    def increment_number_of_push_queries( self, list_of_kinds):
-        '''Increments the total number of push queries'''
-        for kind in lis_of_kinds:
-            kind.quantity_push += 1
-            kind.put()
+    def start_geoip_lookup( self, ipaddr ):
+        '''starts resolving the country of ipaddr, and returns the GeoIPLookup.
+        In deferred mode the remote services are not used: the country will be
+        resolved by BackfillCountry'''
+        return GeoIPLookup( ipaddr, remote=not configuration.GEOIP_DEFERRED )
 
 
-    def increment_number_of_pop_queries( self, list_of_kinds):
-        '''Increments the total number of push queries'''
-        for kind in lis_of_kinds:
-            kind.quantity_pop += 1
-            kind.put()
+    def schedule_backfill( self, score, counted, posted=False ):
+        '''resolves the country of a score stored with 'xx' from the task queue.
+        counted: True if the score was counted in the 'xx' ScoresCountry.
+        posted: True if the score was sent with post-score: it has no name in the rankers'''
+        taskqueue.add( url='/api/backfill-country', params={'key' : str(score.key()), 'counted' : int(counted), 'posted' : int(posted)} )
 
-    def get_or_create_number_of_queries( self ):
-        '''returns or creates the the kind queries'''
-        entities = []
 
-        t = time.time()
-        year = t[0]         # number of year
-        month = t[1]        # number of month
-        day = t[7]          # number of day
-        week = day / 7      # number of week
-        values = [ 0, year, month, week, day ]
-        key = ['all_','year_', 'month_', 'week_', 'day_']
-        for i in range( len(key) ):
-            entity = db.Model.get_or_insert(  \
-                '%s_%d' % (key[i], value[i]),   # key name
-                parent = self.game,             # parent
-                game = self.game,               # game that it belongs to (similar to parent )
-                )
-            entities.append( entity )
+    def find_score( self, category, playername, device_id ):
+        '''returns the Score of a player (playername + device) in a category, or None'''
+        return self.find_scores( category, [ (playername, device_id) ] )[0]
 
-        return kinds
 
+    def find_scores( self, category, players ):
+        '''returns the Score of each (playername, device_id) of players in a category, or None.
+        They are read by key, in one get with the rest of the prefetched keys (see Score.key_for).
+        The Scores stored before they had key names are looked up with a query'''
+        keys = [ Score.key_for( self.game.key(), category, "%s@%s" % player ) for player in players ]
+        scores = self.prefetcher.get_multi( keys )
+        for i in xrange( len(players) ):
+            if scores[i] is None:
+                scores[i] = self.query_score( category, players[i][0], players[i][1] )
+        return scores
 
-    def update_total_scores( self ):
-        ''' updates the total number of scores.'''
-        # Quantity of scores +1
-        self.game.nro_scores +=1 
-        self.game.put()
 
+    def query_score( self, category, playername, device_id ):
+        '''returns the Score of a player with a query. Only needed for the Scores without key name'''
+        query = db.Query(Score)
+        query.ancestor( self.game.key() ).filter('cc_category =',category)
+        query.filter('cc_playername =',playername)
+        query.filter('cc_device_id =',device_id)
+
+        score = query.fetch(limit=1)
+        if score:
+            return score[0]
+        return None
 
-    def update_scores_by_country(self, score_country ):
-        '''updates the total number of scores by country'''
-        score_country.quantity += 1
-        score_country.put()
+
+    def is_better_score( self, new_value, old_value ):
+        '''returns True if new_value is a better score than old_value'''
+        if self.game.scoreorder == 'desc':
+            return new_value > old_value
+        return new_value < old_value
+
+
+    def get_or_create_countries( self, countries ):
+        '''returns the ScoresCountry of each country code, in one db.get.
+        The ones that don't exist are created (but not saved)'''
+        keys = [ ScoresCountry.key_for( self.game.key(), c ) for c in countries ]
+        score_countries = self.prefetcher.get_multi( keys )
+        for i in xrange( len(countries) ):
+            if score_countries[i] is None:
+                score_countries[i] = ScoresCountry.new( self.game.key(), countries[i] )
+        return score_countries
 
 
-    # XXX: possible race condition. use Model.get_or_insert() instead
     def get_or_create_country( self, country ):
         '''returns a new country if it doesn't exist or the current one if it exists'''
-        query = db.Query(ScoresCountry)
-        query.ancestor( self.game )
-        query.filter('country_code =', country)
-        result = query.fetch(limit=1)
-        if query.count() > 0:
-            score_country= result[0]
-        else:
-            score_country = ScoresCountry( parent=self.game, game=self.game, country_code=country, quantity=0 )
-        return  score_country
+        return self.get_or_create_countries( [country] )[0]
 
 
 class GetScores(QueryHandler):
@@ -207,21 +322,8 @@ class GetScores(QueryHandler):
 
     def __init__(self):
         super( GetScores, self ).__init__()
-        self.json = []
         self.position = 0
 
-    def entity_to_json(self, e, fields):
-        '''Converts an entity to JSON format'''
-        d = {}
-        for f in fields:
-            key = f.name
-            value = getattr( e, f.name, '' )
-            d[key] =  value
-
-        d['position'] = self.position
-        self.json.append( d )
-        self.position += 1
-
     def get_offset(self):
         '''Get the offset argument. Default 0'''
         offset = self.request.get('offset')
@@ -232,6 +334,24 @@ class GetScores(QueryHandler):
         self.position = offset
         return offset
 
+    def get_cursor(self):
+        '''Get the cursor argument. Default None'''
+        cursor = self.request.get('cursor')
+        if not cursor:
+            return None
+        return cursor
+
+    def get_rank(self):
+        '''Get the rank argument: 0-based rank of the first score. Default None'''
+        rank = self.request.get('rank')
+        if not rank:
+            return None
+        rank = int(rank)
+        if rank < 1:
+            raise Exception("GetScores: rank must be greater than 0")
+        # ranks are 1-based for the clients
+        return rank - 1
+
     def get_limit(self):
         '''Get the limit argument. Default 25. Maximum limit is 100'''
         limit = self.request.get('limit')
@@ -261,28 +381,11 @@ class GetScores(QueryHandler):
             return '-cc_score'
         return 'cc_score'
 
-    def get_query_type(self):
-        '''Get query type. Default: All time'''
-        query_type = self.request.get('querytype')
-
-        now = datetime.datetime.now()
-        if not query_type:
-            query_type = QueryAllTime
-        else:
-            query_type = int(query_type)
-
-        if query_type == QueryDay:
-            delta = datetime.timedelta(days=1)
-        elif query_type == QueryWeek:
-            delta = datetime.timedelta(weeks=1)
-        elif query_type == QueryMonth:
-            delta = datetime.timedelta(days=30)
-        else:
-            delta = None
-
-        if delta:
-            return now - delta
-        return None
+    def reverse_order(self, order):
+        '''returns the opposite of an order returned by get_order'''
+        if order.startswith('-'):
+            return order[1:]
+        return '-' + order
 
     def get_query_flags(self):
         '''Get flags'''
@@ -296,85 +399,240 @@ class GetScores(QueryHandler):
         '''Get the device ID'''
         return self.request.get('device')
 
-    def update_json_with_positions( self, ranker ):
-        scores = map(lambda y: [y['cc_score']], self.json )
-        ranks = ranker.FindRanks( scores )
-
-        for i,item in enumerate(self.json):
+    def get_positions( self, results, country=None, device=None ):
+        '''returns the position of each score: its rank if the game
+        supports rankings, or its position in the query otherwise.
+        The scores of a country are ranked by the ranker of the country, if it has one.
+        The scores of a device, and the scores of a country without ranker, are
+        ranked by their position in the query'''
+        positions = range( self.position, self.position + len(results) )
+        if not self.game.ranking_enabled or not results:
+            return positions
+        try:
+            ranker = None
+            if country:
+                # the country rankers are all time rankers
+                if not self.get_window():
+                    ranker = self.get_country_ranker( self.get_category(), country )
+            elif not device:
+                ranker = self.get_ranker( self.game.key(), self.get_ranking_name( self.get_category() ) )
+
+            if ranker is not None:
+                ranks = ranker.FindRanks( [ [r.cc_score] for r in results ] )
+            else:
+                ranks = positions
             # ranker are 0-based. Make it 1-based
-            item['position'] = ranks[i] + 1
+            positions = [ rank + 1 for rank in ranks ]
+        except AssertionError, e:
+            logging.error('API get-scores: Ranking out of range')
+        return positions
+
+    def fetch_from_rank( self, query, category, rank, limit ):
+        '''fetches 'limit' scores starting at the 0-based 'rank'.
+        The ranker converts the rank into a score, so the query only reads
+        the scores that are returned (plus the ties before 'rank')'''
+        try:
+            ranker = self.get_ranker( self.game.key(), category )
+        except datastore_errors.EntityNotFoundError, e:
+            # no scores in this window yet
+            return []
+        found = ranker.FindScoreApproximate( rank )
+        if found is None:
+            # not so many scores
+            return []
+        score, rank_of_tie = found
+        query.filter('cc_score <=', score[0])
+        return query.fetch( limit, rank - rank_of_tie )
 
     def get(self):
         '''HTTP GET request.
         Valid arguments:
             gamename: Name of the game. Required field
             offset: offset from the query. Default 0
+            cursor: continue from a previous page ('next_cursor' of the previous answer). Overrides offset
+            rank: return the scores starting at this rank (1-based). Only valid with rankings. Overrides offset and cursor
             limit: how many scores to send back. Default 25
             category: category of the game
             order: desc or asc ?
+            querytype: 1 day, 2 week, 3 month, 4 all time (default). The windows
+                are calendar days, ISO weeks and months (UTC). Only for games with windowed leaderboards
             flags: flags for the query, like:only scores from country
         '''
         if not self.validate_name():
             logging.error('API get-scores: Name validation failed')
             raise Exception("GetScores: Name validation failed")
 
+        meter.pop( self.game_name )
+
         offset = self.get_offset()
+        cursor = self.get_cursor()
         limit = self.get_limit()
+        rank = self.get_rank()
         category = self.get_category()
         order = self.get_order()
-        dates = self.get_query_type()
+        window = self.get_window()
         flags = self.get_query_flags()
 
-        # sort the scores by the score field
-        query = db.Query(Score)
-        query.ancestor( self.game ).filter('cc_category =',category)
+        if rank is not None:
+            if not self.game.ranking_enabled:
+                logging.error('API get-scores: rank argument used in a game that does not support ranking')
+                raise Exception("GetScores: game does not support ranking")
+            if flags:
+                logging.error('API get-scores: rank argument can not be used with flags')
+                raise Exception("GetScores: rank can not be used with flags")
+
+        country = None
+        device = None
 
         # only by country ?
         if QueryFlagByCountry & flags:
             country = getGeoIPCode( self.request.remote_addr)
-            if country:
-                query.filter('cc_country =', country)
-            else:
+            if not country:
                 logging.error('API get-scores: Cannot locate country for current IP. Game: %s' % self.game_name)
                 raise Exception("GetScores: Cannot locate country for current IP address")
 
         # device and country can't be at the same time
         elif QueryFlagByDevice & flags:
             device = self.get_device_id()
-            if device:
-                query.filter('cc_device_id = ', device)
-            else:
+            if not device:
                 logging.error('API get-scores: Device parameter missing. Game: %s' % self.game_name)
                 raise Exception("GetScores: Device parameter is missing")
 
-        #if dates:
-        #    query.filter('cc_when >', dates)
-        query.order(order)
-        results = query.fetch(limit=limit, offset=offset)
-        
-        # filter the fields to send to the usr
-        query = db.Query(ScoreField)
-        query.ancestor( self.game).filter('send = ', True)
-        count = query.count()
-        fields = query.fetch(limit=count)
+        # same query, same answer until somebody writes a score in this category
+        shape = ( 'api', offset, cursor, rank, limit, order, window, country, device )
+        body, generation = pagecache.get_page( self.game.key(), category, shape )
+        if body is not None:
+            self.response.out.write( body )
+            return
 
-        # convert the restuls to JSON format
-        for r in results:
-            self.entity_to_json(r, fields)
+        # sort the scores by the score field
+        if window:
+            query = windows.query( self.game.key(), category, window )
+        else:
+            query = db.Query(Score)
+            query.ancestor( self.game.key() ).filter('cc_category =',category)
+        if country:
+            query.filter('cc_country =', country)
+        elif device:
+            query.filter('cc_device_id = ', device)
 
-        try:
-            if self.game.ranking_enabled:
-                ranker = self.get_ranker( self.game.key(), category )
-                self.update_json_with_positions( ranker )
-        except AssertionError, e:
-            logging.error('API get-scores: Ranking out of range')
+        query.order(order)
+        if rank is not None:
+            results = self.fetch_from_rank( query, self.get_ranking_name( category ), rank, limit )
+            next_cursor = None
+        else:
+            results, self.position, next_cursor = fetch_page( query, limit, offset, cursor )
+        
+        positions = self.get_positions( results, country, device )
 
+        # convert the results to JSON format, with the fields to send to the usr.
         # to comply with JSON parser in objective-c
         # a dictionary shall be the first element
-        d = { 'scores' : self.json }
+        serializer = get_schema( self.game ).serializer()
+        body = serializer.dumps( results, positions, { 'next_cursor' : next_cursor } )
+        pagecache.set_page( self.game.key(), category, shape, body, generation )
 
         # send back the info
-        self.response.out.write( json.dumps( d ) )
+        self.response.out.write( body )
+
+
+class GetScoresAroundRank(GetScores):
+    '''Handles the HTTP GET request to obtain the scores around a rank.
+    eg: the 20 players around rank 5000.
+    No login is necessary
+    '''
+
+    def get_rank(self):
+        '''Get the rank argument. Returns the 0-based rank of the first score,
+        so that the requested rank is in the middle of the page'''
+        rank = self.request.get('rank')
+        if not rank:
+            raise Exception("GetScoresAroundRank: rank argument is missing")
+        rank = int(rank)
+        if rank < 1:
+            raise Exception("GetScoresAroundRank: rank must be greater than 0")
+        return max( rank - 1 - self.get_limit() // 2, 0 )
+
+
+class GetScoresAroundPlayer(GetScores):
+    '''Handles the HTTP GET request to obtain the scores around a player:
+    the player's score, the 'around' scores above it, and the 'around' scores below it.
+    No login is necessary
+    '''
+
+    def get_around(self):
+        '''Get the around argument. Default 5. Maximum 25'''
+        around = self.request.get('around')
+        if not around:
+            return 5
+        around = int(around)
+        if around > 25:
+            raise Exception("GetScoresAroundPlayer: around can't be greater than 25")
+        return around
+
+    def get(self):
+        '''HTTP GET request.
+        Valid arguments:
+            gamename: Name of the game. Required field
+            category: category of the game
+            cc_playername: name of the player. Required field
+            cc_device_id: device id of the player. Required field
+            around: how many scores to send above and below the player. Default 5
+        '''
+        if not self.validate_name():
+            logging.error('API get-scores-around-player: Name validation failed')
+            raise Exception("GetScoresAroundPlayer: Name validation failed")
+
+        meter.pop( self.game_name )
+
+        if not self.game.ranking_enabled:
+            logging.error('API get-scores-around-player: game does not support ranking')
+            raise Exception("GetScoresAroundPlayer: game does not support ranking")
+
+        category = self.get_category()
+        around = self.get_around()
+
+        playername = self.request.get('cc_playername')
+        device_id = self.request.get('cc_device_id')
+        if not device_id:
+            logging.error('API get-scores-around-player: No cc_device_id in game: %s' % self.game_name )
+            raise Exception("GetScoresAroundPlayer: no cc_device_id")
+
+        player = self.find_score( category, playername, device_id )
+        if player is None:
+            logging.error('API get-scores-around-player: player not found in game: %s' % self.game_name )
+            raise Exception("GetScoresAroundPlayer: player not found")
+        score = player.cc_score
+        ranker = self.get_ranker( self.game.key(), category )
+
+        # 'better' is the filter of the better scores, in the order of the game
+        if self.game.scoreorder == 'desc':
+            better, worse = '>', '<='
+        else:
+            better, worse = '<', '>='
+
+        # better scores, closest first
+        query = db.Query(Score)
+        query.ancestor( self.game.key() ).filter('cc_category =',category)
+        query.filter('cc_score %s' % better, score).order( self.reverse_order( self.get_order() ) )
+        above = query.fetch( around )
+        above.reverse()
+
+        # the ties and the worse scores. The player goes first: with many ties
+        # it might not be in the first 'around' + 1 results
+        query = db.Query(Score)
+        query.ancestor( self.game.key() ).filter('cc_category =',category)
+        query.filter('cc_score %s' % worse, score).order( self.get_order() )
+        below = [ r for r in query.fetch( around + 1 ) if r.key() != player.key() ][:around]
+
+        results = above + [ player ] + below
+
+        # the rank of the player and the positions, in one ranker walk
+        ranks = ranker.FindRanks( [ [score] ] + [ [r.cc_score] for r in results ] )
+        positions = [ rank + 1 for rank in ranks[1:] ]
+
+        serializer = get_schema( self.game ).serializer()
+        self.response.out.write( serializer.dumps( results, positions, { 'rank' : ranks[0] + 1 } ) )
 
 
 class GetRankForScore(BaseHandler):
@@ -391,13 +649,17 @@ class GetRankForScore(BaseHandler):
         '''HTTP GET request.
         Needed arguments:
             gamename: Name of the game. Required field
-            name: name of the player 
-            device: device id 
+            score: the score
+            category: category of the game
+            country: rank within the scores of this country (only the countries with a ranker)
+            flags: with QueryFlagByCountry, rank within the scores of the country of the current IP
         '''
         if not self.validate_name():
             logging.error('API get-rank-for-score: Name validation failed')
             raise Exception("GetRankForScore: Name validation failed")
 
+        meter.pop( self.game_name )
+
         if not self.game.ranking_enabled:
             logging.error('API get-rank-for-score: game does not support ranking')
             raise Exception("GetRankForScore: game does not support ranking")
@@ -406,9 +668,20 @@ class GetRankForScore(BaseHandler):
         if category is None:
             category = ''
 
+        country = self.request.get('country')
+        flags = self.request.get('flags')
+        if not country and flags and ( int(flags) & QueryFlagByCountry ):
+            country = getGeoIPCode( self.request.remote_addr )
+
         score = self.request.get('score')
         score = int(score)
-        ranker = self.get_ranker( self.game.key(), category )
+        if country:
+            ranker = self.get_country_ranker( category, country )
+            if ranker is None:
+                logging.error('API get-rank-for-score: no ranking for country %s in game: %s' % (country, self.game_name) )
+                raise Exception("GetRankForScore: no ranking for this country")
+        else:
+            ranker = self.get_ranker( self.game.key(), self.get_ranking_name( category ) )
         rank = ranker.FindRank( [score] )
         self.response.out.write('OK: %d' % (rank + 1) )
 
@@ -433,6 +706,8 @@ class GetRanksForScores(BaseHandler):
             logging.error('API get-ranks-for-score: Name validation failed')
             raise Exception("GetRanksForScores: Name validation failed")
 
+        meter.pop( self.game_name )
+
         if not self.game.ranking_enabled:
             logging.error('API get-ranks-for-scores: game does not support ranking')
             raise Exception("GetRanksForScores: game does not support ranking")
@@ -444,7 +719,7 @@ class GetRanksForScores(BaseHandler):
         scores = self.request.get('scores')
         scores = scores.split(',')
         scores = map(lambda y: [int(y)], scores)
-        ranker = self.get_ranker( self.game.key(), category )
+        ranker = self.get_ranker( self.game.key(), self.get_ranking_name( category ) )
         ranks = ranker.FindRanks( scores )
         ranks = map(lambda y:int(y)+1, ranks)
         self.response.out.write('OK: %s' % str(ranks) )
@@ -470,6 +745,8 @@ class GetScoreForRank(BaseHandler):
             logging.error('API get-score-for-rank: Name validation failed')
             raise Exception("GetScoreForRank: Name validation failed")
 
+        meter.pop( self.game_name )
+
         if not self.game.ranking_enabled:
             logging.error('API get-score-for-rank: game does not support ranking')
             raise Exception("GetScoreForRank: game does not support ranking")
@@ -480,7 +757,7 @@ class GetScoreForRank(BaseHandler):
 
         rank = self.request.get('rank')
         rank = int(rank)
-        ranker = self.get_ranker( self.game.key(), category )
+        ranker = self.get_ranker( self.game.key(), self.get_ranking_name( category ) )
         score = ranker.FindScore( rank )
         self.response.out.write('OK: %d %d' % (score[0][0], score[1]) )
 #
@@ -491,44 +768,61 @@ class PostScore(QueryHandler):
     # This methods is run inside a transaction
     # All updates shall be done in the 'self.game' context
     @transactional
-    def post_score( self, score, score_country, number_of_queries_entities ):
+    def post_score( self, score, score_country, window_copies ):
 
         # save score
         score.put()
 
-        # update total scores
-        self.update_total_scores()
+        # a new country ?
+        self.save_country( score_country )
 
-        # update scores by country
-        self.update_scores_by_country( score_country )
+        # the copies in the leaderboard windows
+        self.save_copies( score, window_copies )
 
-        # XXX: update number of posts
-#        self.increment_number_of_push_queries( number_of_queries_entities )
+    def rank_score( self, score, window_copies ):
+        '''adds a saved score to the rankers of its category, its country and its windows.
+        Posted scores never change, so they are added without a name: only the
+        counts of the ranker nodes are updated.
+        Returns the rank of the score'''
+        value = [score.cc_score]
+
+        ranker = self.get_or_create_ranker( self.game.key(), score.cc_category )
+        rank = ranker.AddScores( [value], return_ranks=True )[0]
+
+        ranker = self.get_country_ranker( score.cc_category, score.cc_country, create=True )
+        if ranker is not None:
+            ranker.AddScores( [value] )
+
+        for copy in window_copies:
+            name = windows.ranking_name( score.cc_category, copy.cc_window )
+            ranker = self.get_or_create_ranker( self.game.key(), name, copy.cc_expires )
+            ranker.AddScores( [value] )
+        return rank
 
     def get(self):
         pass
 
+    @rpcstats.logged('API post-score')
     def post(self):
         '''HTTP POST handler'''
 
+        # the country is resolved while the score is built
+        geoip = self.start_geoip_lookup( self.request.remote_addr )
+
+        # the game and its ScoresCountry (if the country is already known) in one Get
+        self.prefetch( 'cc_gamename', None, geoip.peek() )
+
         if not self.validate_name( gamename = 'cc_gamename'):
             logging.error('API post-score: Name validation failed')
             raise Exception("PostScore: Name validation failed")
 
-        if self.game.ranking_enabled:
-            logging.error('API post-score: Ranking support is not enabled with "new score" yet')
-            raise Exception("PostScore: Ranking support is not enabled with 'new score' yet")
-
+        meter.push( self.game_name )
 
         if not self.validate_checksum():
             logging.error('API post-score: Checksum validation failed. Game: %s' % self.game_name)
             raise Exception("PostScore: Checksum validation failed")
 
-        score = Score( parent=self.game, cc_ip=self.request.remote_addr, cc_game=self.game)
-
-        country = getGeoIPCode( self.request.remote_addr)
-        country = country.strip()
-        score.cc_country = country
+        score = Score( parent=self.game.key(), cc_ip=self.request.remote_addr, cc_game=self.game.key())
 
         for arg in self.request.arguments():
             if arg.startswith('usr_') or arg =='cc_score' or arg=='cc_playername':
@@ -548,17 +842,45 @@ class PostScore(QueryHandler):
         if device_id:
             score.cc_device_id = device_id
 
+        country = geoip.get_result().strip()
+        score.cc_country = country
+
+        if self.game.ranking_enabled:
+            r = self.game.ranking_min_score, self.game.ranking_max_score
+            if not r[0] <= score.cc_score < r[1]:
+                logging.error('API post-score: score outside ranking range')
+                self.response.out.write('ERROR: score outside ranking range')
+                return
+
         score_country = self.get_or_create_country( country )
 
-        # the entities representing the total number of queries (all time, year, month, week, day)
-#        number_of_queries_entities = self.get_or_create_number_of_queries()
+        if self.game.ranking_enabled:
+            # see rank_score
+            score.cc_ranked_by = 'value'
+
+        window_copies = []
+        if self.game.windowed_leaderboards:
+            window_copies = windows.new_copies( self.game.key(), score )
 
         # runs in trasaction
-#        self.post_score( score, score_country, number_of_queries_entities )
-        self.post_score( score, score_country, 0)
+        self.post_score( score, score_country, window_copies )
 
-        # answer OK
-        self.response.out.write('OK')
+        # the score needs its key to be ranked
+        # BUG XXX should run in the same transaction
+        rank = None
+        if self.game.ranking_enabled:
+            rank = self.rank_score( score, window_copies )
+
+        self.count_scores( { country : 1 } )
+        pagecache.invalidate_category( self.game.key(), score.cc_category )
+
+        if geoip.deferred:
+            self.schedule_backfill( score, True, posted=True )
+
+        if rank is not None:
+            self.response.out.write('OK:ranking=%d' % (rank+1) )
+        else:
+            self.response.out.write('OK')
 
 #
 # 'score/update' handler
@@ -568,28 +890,65 @@ class UpdateScore(QueryHandler):
     # This methods is run inside a transaction
     # All updates shall be done in the 'self.game' context
     @transactional
-    def update_score( self, score, score_country ):
+    def update_score( self, score, score_country, window_copies ):
 
         # save score
         score.put()
 
         if self.new_score:
-            # update total scores
-            self.update_total_scores()
+            # a new country ?
+            self.save_country( score_country )
 
-            # update scores by country
-            self.update_scores_by_country( score_country )
+        # the copies in the leaderboard windows
+        self.save_copies( score, window_copies )
 
+    def prefetch_windows( self ):
+        '''adds the keys of the WindowScores of the player to the prefetcher'''
+        game_name = self.request.get('cc_gamename')
+        device_id = self.request.get('cc_device_id')
+        if not game_name or not device_id:
+            return
+        config = gameconfig.peek_config( game_name )
+        if config is not None and not config.windowed_leaderboards:
+            return
+        category = self.request.get('cc_category')
+        profile_id = "%s@%s" % (self.request.get('cc_playername'), device_id)
+        self.prefetcher.add( *windows.profile_keys( db.Key.from_path( 'Game', game_name ), category, profile_id ) )
 
-    # Get or create score
-    # XXX: possible (but improbable) race condition
-    def get_or_create_score( self ):
+    def prefetch_score( self ):
+        '''adds the key of the Score of the player to the prefetcher'''
+        game_name = self.request.get('cc_gamename')
+        device_id = self.request.get('cc_device_id')
+        if not game_name or not device_id:
+            return
+        profile_id = "%s@%s" % (self.request.get('cc_playername'), device_id)
+        self.prefetcher.add( Score.key_for( db.Key.from_path( 'Game', game_name ), self.request.get('cc_category'), profile_id ) )
+
+    def update_country_rankers( self, old_country, country, value ):
+        '''sets the score of the player in the ranker of its country,
+        and removes it from the ranker of the country of its previous score'''
+        if old_country and old_country != country:
+            ranker = self.get_country_ranker( self.category, old_country, lookup=True )
+            if ranker is not None:
+                ranker.SetScore( self.profile_id, None )
+        ranker = self.get_country_ranker( self.category, country, create=True )
+        if ranker is not None:
+            ranker.SetScore( self.profile_id, [value] )
+
+    def update_window_rankers( self, window_copies ):
+        '''sets the score of the player in the rankers of the windows'''
+        for copy in window_copies:
+            name = windows.ranking_name( self.category, copy.cc_window )
+            ranker = self.get_or_create_ranker( self.game.key(), name, copy.cc_expires )
+            ranker.SetScore( self.profile_id, [copy.cc_score] )
+
+
+    def get_profile( self ):
+        '''returns the (category, playername, device_id) of the request'''
         category = self.request.get('cc_category')
         if not category:
             category = ''
 
-        self.category = category
-
         device_id = self.request.get('cc_device_id')
         if not device_id:
             logging.error('API update-score: No cc_device_id in game: %s' % self.game_name )
@@ -600,59 +959,112 @@ class UpdateScore(QueryHandler):
             logging.error('API update-score: No cc_playername in game: %s' % self.game_name )
             raise Exception("UpdateScore failed: no cc_playername")
 
+        return (category, playername, device_id)
+
+    # Get or create score
+    # XXX: possible (but improbable) race condition
+    def get_or_create_score( self ):
+        category, playername, device_id = self.get_profile()
+
+        self.category = category
+
         # needed for rankings
         self.profile_id = "%s@%s" % (playername, device_id)
 
-        query = db.Query(Score)
-        query.ancestor( self.game ).filter('cc_category =',category)
-        query.filter('cc_playername =',playername)
-        query.filter('cc_device_id =',device_id)
-
-        score = query.fetch(limit=1)
+        score = self.find_score( category, playername, device_id )
         if not score:
             self.new_score = True
-            score = Score( parent=self.game, cc_ip=self.request.remote_addr, cc_game=self.game, cc_playername=playername, cc_category=category, cc_device_id=device_id)
-        else:
-            score = score[0]
+            score = Score( key_name=Score.key_name_for( category, self.profile_id ), parent=self.game.key(), cc_ip=self.request.remote_addr, cc_game=self.game.key(), cc_playername=playername, cc_category=category, cc_device_id=device_id)
         return score
 
 
+    def queue_score( self ):
+        '''stores the score in the pending-writes buffer and schedules a flush.
+        The score will be written by FlushPendingScores'''
+        category, playername, device_id = self.get_profile()
+
+        if not self.request.get('cc_score'):
+            logging.error('API update-score: No cc_score in game: %s' % self.game_name )
+            raise Exception("UpdateScore failed: no cc_score")
+
+        pending = PendingScore( game=self.game.key(), cc_ip=self.request.remote_addr, cc_playername=playername, cc_category=category, cc_device_id=device_id)
+        for arg in self.request.arguments():
+            if arg.startswith('usr_') or arg =='cc_score':
+                value = self.request.get(arg)
+                setattr( pending, arg, self.cast_value_to_type( arg, value ) )
+        pending.put()
+
+        schedule_flush( self.game_name )
+
+        if self.game.ranking_enabled:
+            # approximation: the pending score is not in the ranker yet
+            try:
+                ranker = self.get_ranker( self.game.key(), category )
+                rank = ranker.FindRank( [pending.cc_score] )
+            except (AssertionError, datastore_errors.EntityNotFoundError), e:
+                rank = 0
+            self.response.out.write('OK:ranking=%d,score_updated=0,queued=1' % (rank+1) )
+        else:
+            self.response.out.write('OK')
+
+
     def get(self):
         pass
 
+    @rpcstats.logged('API update-score')
     def post(self):
         '''HTTP POST handler'''
 
+        # the country is resolved while the score is fetched and built
+        geoip = self.start_geoip_lookup( self.request.remote_addr )
+
+        # the game, its Ranking and its ScoresCountry (if the country is already known) in one Get
+        self.prefetch( 'cc_gamename', self.request.get('cc_category'), geoip.peek() )
+        self.prefetch_windows()
+        self.prefetch_score()
+
         if not self.validate_name( gamename = 'cc_gamename'):
             logging.error('API udpate-score: Name validation failed.')
             raise Exception("UpdateScore: Name validation failed")
 
+        meter.push( self.game_name )
+
         if not self.validate_checksum():
             logging.error('API update-score: Checksum validation failed: %s' % self.game_name)
             raise Exception("UpdateScore: Checksum failed")
 
+        if self.game.buffered_updates:
+            self.queue_score()
+            return
+
         self.new_score = False
         score = self.get_or_create_score()
 
-        country = getGeoIPCode( self.request.remote_addr)
-        country = country.strip()
-        score.cc_country = country
-
-        desc_score = False
-        if self.game.scoreorder == 'desc':
-            desc_score = True
-
         if not self.new_score:
             old_score = score.cc_score
+        old_country = score.cc_country
 
         for arg in self.request.arguments():
             if arg.startswith('usr_') or arg =='cc_score':
                 value = self.request.get(arg)
                 casted_value = self.cast_value_to_type( arg, value )
                 setattr( score, arg, casted_value )
+
+        country = geoip.get_result().strip()
+        score.cc_country = country
+
+        # the windows where this is the best score of the player
+        window_copies = []
+        if self.game.windowed_leaderboards:
+            window_copies = windows.best_copies( self.game.key(), score, self.profile_id, self.is_better_score, self.prefetcher )
+            if self.game.ranking_enabled:
+                r = self.game.ranking_min_score, self.game.ranking_max_score
+                if r[0] <= score.cc_score < r[1]:
+                    self.update_window_rankers( window_copies )
      
         score_updated = False
-        if self.new_score or (desc_score and score.cc_score > old_score) or (not desc_score and score.cc_score < old_score):
+        rank = None
+        if self.new_score or self.is_better_score( score.cc_score, old_score ):
             score_country = self.get_or_create_country( country )
 
             if self.game.ranking_enabled:
@@ -660,29 +1072,301 @@ class UpdateScore(QueryHandler):
                 ranker = self.get_or_create_ranker( self.game.key(), self.category )
                 r = ranker.score_range
                 if r[0] <= score.cc_score < r[1]:
-                    ranker.SetScore( self.profile_id, [score.cc_score])
+                    # the new rank is computed from the nodes just updated
+                    ranks = ranker.SetScores( { self.profile_id : [score.cc_score] }, return_ranks=True )
+                    rank = ranks[ self.profile_id ]
+                    score.cc_ranked_by = 'name'
+                    self.update_country_rankers( old_country, country, score.cc_score )
                 else:
                     logging.error('API update-score: score outside ranking range')
                     self.response.out.write('ERROR: score outside ranking range')
                     return
 
             # runs in transaction
-            self.update_score( score, score_country )
+            self.update_score( score, score_country, window_copies )
+            if self.new_score:
+                self.count_scores( { country : 1 } )
+            pagecache.invalidate_category( self.game.key(), self.category )
             score_updated = True
 
+            if geoip.deferred:
+                self.schedule_backfill( score, self.new_score )
+
+        elif window_copies:
+            # not the best score of the player, but the best of a window
+            self.save_copies( score, window_copies )
+            pagecache.invalidate_category( self.game.key(), self.category )
 
         if self.game.ranking_enabled:
-            ranker = self.get_ranker( self.game.key(), self.category )
-            rank = ranker.FindRank( [score.cc_score] )
+            if rank is None:
+                ranker = self.get_ranker( self.game.key(), self.category )
+                rank = ranker.FindRank( [score.cc_score] )
             self.response.out.write('OK:ranking=%d,score_updated=%d' % (rank+1, score_updated) )
         else:
             self.response.out.write('OK')
 
 
+#
+# Buffered score updates
+#
+
+# seconds between the flushes of the pending scores of a game
+FLUSH_DELAY = 10
+
+# maximum number of pending scores written per flush
+FLUSH_BATCH_SIZE = 100
+
+def schedule_flush( game_name, countdown=FLUSH_DELAY ):
+    '''schedules a flush of the pending scores of a game.
+    Only one flush per game is scheduled every FLUSH_DELAY seconds'''
+    name = 'flush-%s-%d' % ( hashlib.md5( game_name.encode('utf-8') ).hexdigest(), int(time.time()) // FLUSH_DELAY )
+    try:
+        taskqueue.add( url='/api/flush-pending-scores', params={'gamename' : game_name}, name=name, countdown=countdown )
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError), e:
+        # already scheduled
+        pass
+
+#
+# 'api/flush-pending-scores' handler. Runs from the task queue
+#
+class FlushPendingScores(QueryHandler):
+
+    # This methods is run inside a transaction
+    # All updates shall be done in the 'self.game' context
+    @transactional
+    def write_scores( self, scores, score_countries, window_copies ):
+        '''writes the scores that are better than the stored ones.
+        An overlapping flush may have written some of them since they were read,
+        so the Scores are read again in the transaction.
+        returns the list of (score, counted) that were written. counted: the Score is new'''
+        stored = db.get( [ score.key() for score in scores ] )
+        written = []
+        for (score, old) in zip( scores, stored ):
+            if old is None or self.is_better_score( score.cc_score, old.cc_score ):
+                written.append( (score, old is None) )
+        if written:
+            db.put( [ score for (score, counted) in written ] )
+
+        # new countries ?
+        countries = set( [ score.cc_country for (score, counted) in written if counted ] )
+        for score_country in score_countries:
+            if score_country.country_code in countries:
+                self.save_country( score_country )
+
+        # the copies in the leaderboard windows
+        for (score, copies) in window_copies:
+            self.save_copies( score, copies )
+        return written
+
+    def coalesce( self, pending ):
+        '''returns a dict of category -> profile id -> best pending score'''
+        categories = {}
+        for p in pending:
+            profiles = categories.setdefault( p.cc_category, {} )
+            profile_id = "%s@%s" % (p.cc_playername, p.cc_device_id)
+            best = profiles.get( profile_id )
+            if not best or self.is_better_score( p.cc_score, best.cc_score ):
+                profiles[ profile_id ] = p
+        return categories
+
+    def flush_category( self, category, profiles ):
+        '''writes the best pending score of every profile of a category.
+        The rankers are updated once the Scores are written'''
+        scores = []
+        # Score key -> (profile id, country of its previous value)
+        candidates = {}
+        # list of (score, copies)
+        window_copies = []
+        # window -> profile id -> score
+        window_ranked = {}
+
+        if self.game.ranking_enabled:
+            ranker = self.get_or_create_ranker( self.game.key(), category )
+            r = ranker.score_range
+
+        # resolve all the countries in parallel
+        geoips = {}
+        for p in profiles.itervalues():
+            if p.cc_ip not in geoips:
+                geoips[ p.cc_ip ] = self.start_geoip_lookup( p.cc_ip )
+
+        # the Scores of all the profiles, in one get
+        profile_ids = profiles.keys()
+        stored = self.find_scores( category, [ (profiles[pid].cc_playername, profiles[pid].cc_device_id) for pid in profile_ids ] )
+
+        for (profile_id, score) in zip( profile_ids, stored ):
+            p = profiles[ profile_id ]
+            if self.game.ranking_enabled and not r[0] <= p.cc_score < r[1]:
+                logging.error('API flush-pending-scores: score outside ranking range')
+                continue
+
+            better = True
+            if score:
+                better = self.is_better_score( p.cc_score, score.cc_score )
+                if not better and not self.game.windowed_leaderboards:
+                    continue
+            else:
+                score = Score( key_name=Score.key_name_for( category, profile_id ), parent=self.game.key(), cc_game=self.game.key(), cc_ip=p.cc_ip, cc_playername=p.cc_playername, cc_category=category, cc_device_id=p.cc_device_id)
+
+            old_country = score.cc_country
+
+            # the fields of the pending score. 'score' is not saved if it is not better
+            for arg in p.dynamic_properties():
+                setattr( score, arg, getattr( p, arg ) )
+            score.cc_ip = p.cc_ip
+            score.cc_country = geoips[ p.cc_ip ].get_result().strip()
+
+            if self.game.windowed_leaderboards:
+                copies = windows.best_copies( self.game.key(), score, profile_id, self.is_better_score )
+                if copies:
+                    window_copies.append( (score, copies) )
+                if self.game.ranking_enabled:
+                    for copy in copies:
+                        window_ranked.setdefault( (copy.cc_window, copy.cc_expires), {} )[ profile_id ] = [p.cc_score]
+            if not better:
+                continue
+
+            candidates[ score.key() ] = (profile_id, old_country)
+            if self.game.ranking_enabled:
+                # see rank_scores
+                score.cc_ranked_by = 'name'
+            scores.append( score )
+
+        if not scores and not window_copies:
+            return
+
+        # runs in transaction
+        countries = set( [ score.cc_country for score in scores if not score.is_saved() ] )
+        written = self.write_scores( scores, self.get_or_create_countries( list(countries) ), window_copies )
+
+        counts = {}
+        for (score, counted) in written:
+            if counted:
+                counts[ score.cc_country ] = counts.get( score.cc_country, 0 ) + 1
+        self.count_scores( counts )
+        pagecache.invalidate_category( self.game.key(), category )
+
+        for (score, counted) in written:
+            if geoips[ score.cc_ip ].deferred:
+                self.schedule_backfill( score, counted )
+
+        if self.game.ranking_enabled:
+            self.rank_scores( category, ranker, [ candidates[ score.key() ] + (score,) for (score, counted) in written ], window_ranked )
+
+    def rank_scores( self, category, ranker, written, window_ranked ):
+        '''updates the rankers with the written scores.
+        written: list of (profile id, old country, score)'''
+        ranked_scores = {}
+        # country -> profile id -> score (None: removed from the country)
+        country_ranked = {}
+        for (profile_id, old_country, score) in written:
+            ranked_scores[ profile_id ] = [score.cc_score]
+            country_ranked.setdefault( score.cc_country, {} )[ profile_id ] = [score.cc_score]
+            if old_country and old_country != score.cc_country:
+                country_ranked.setdefault( old_country, {} )[ profile_id ] = None
+
+        if ranked_scores:
+            ranker.SetScores( ranked_scores )
+
+        for (country, country_scores) in country_ranked.iteritems():
+            added = [ s for s in country_scores.itervalues() if s is not None ]
+            country_ranker = self.get_country_ranker( category, country, create=bool( added ), lookup=True )
+            if country_ranker is not None:
+                country_ranker.SetScores( country_scores )
+
+        for ((window, expires), window_scores) in window_ranked.iteritems():
+            window_ranker = self.get_or_create_ranker( self.game.key(), windows.ranking_name( category, window ), expires )
+            window_ranker.SetScores( window_scores )
+
+    @rpcstats.logged('API flush-pending-scores')
+    def post(self):
+        '''HTTP POST handler'''
+        if not self.validate_name():
+            logging.error('API flush-pending-scores: Name validation failed')
+            return
+
+        query = PendingScore.all().filter('game =', self.game.key()).order('cc_when')
+        pending = query.fetch( FLUSH_BATCH_SIZE )
+
+        for (category, profiles) in self.coalesce( pending ).iteritems():
+            self.flush_category( category, profiles )
+
+        db.delete( pending )
+
+        # more scores are waiting ? flush them now
+        if len(pending) == FLUSH_BATCH_SIZE:
+            taskqueue.add( url='/api/flush-pending-scores', params={'gamename' : self.game_name} )
+
+
+#
+# 'api/backfill-country' handler. Runs from the task queue
+#
+class BackfillCountry(QueryHandler):
+    '''Resolves the country of a score that was stored with 'xx' in deferred Geo IP mode'''
+
+    # This methods is run inside a transaction
+    # All updates shall be done in the 'self.game' context
+    @transactional
+    def patch_country( self, key, country, counted ):
+        score = db.get( key )
+        if not score or score.cc_country != 'xx':
+            # deleted, or already resolved
+            return False
+
+        score.cc_country = country
+        score.put()
+
+        # the copies in the leaderboard windows
+        copies = [ c for c in windows.copies_of( score ).fetch( 10 ) if c.cc_country == 'xx' ]
+        for copy in copies:
+            copy.cc_country = country
+        db.put( copies )
+
+        if counted:
+            # a new country ?
+            self.save_country( self.get_or_create_country( country ) )
+        return True
+
+    def post(self):
+        '''HTTP POST handler'''
+        key = db.Key( self.request.get('key') )
+        score = db.get( key )
+        if not score or score.cc_country != 'xx':
+            return
+
+        country = getGeoIPCode( score.cc_ip ).strip()
+        if country == 'xx':
+            # unknown country. Nothing to patch
+            return
+
+        self.game = gameconfig.get_config( key.parent().name() )
+        if self.game is None:
+            # the game was deleted. Nothing to patch
+            return
+        counted = ( self.request.get('counted') == '1' )
+        if self.patch_country( key, country, counted ):
+            if counted:
+                # move the score from the 'xx' country to the real one
+                self.count_scores( { 'xx' : -1, country : 1 } )
+            if self.game.ranking_enabled:
+                # 'xx' scores are not in any country ranker
+                ranker = self.get_country_ranker( score.cc_category, country, create=True )
+                if ranker is not None:
+                    if self.request.get('posted') == '1':
+                        ranker.AddScores( [[score.cc_score]] )
+                    else:
+                        ranker.SetScore( "%s@%s" % (score.cc_playername, score.cc_device_id), [score.cc_score] )
+            pagecache.invalidate_category( self.game.key(), score.cc_category )
+
+
 application = webapp.WSGIApplication([
         ('/api/post-score', PostScore),
         ('/api/update-score', UpdateScore),
+        ('/api/flush-pending-scores', FlushPendingScores),
+        ('/api/backfill-country', BackfillCountry),
         ('/api/get-scores', GetScores),
+        ('/api/get-scores-around-rank', GetScoresAroundRank),
+        ('/api/get-scores-around-player', GetScoresAroundPlayer),
         ('/api/get-rank-for-score', GetRankForScore),
         ('/api/get-ranks-for-scores', GetRanksForScores),
         ('/api/get-score-for-rank', GetScoreForRank),
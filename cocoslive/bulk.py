@@ -49,15 +49,11 @@ class ScoreLoader(bulkload.Loader):
         game.nro_scores += 1
         game.put()
 
-        query = db.Query(ScoresCountry)
-        query.ancestor( game )
-        query.filter('country_code =', country)
-        result = query.fetch(limit=1)
-        if query.count() > 0:
-            rec = result[0]
+        rec = ScoresCountry.get( ScoresCountry.key_for( game.key(), country ) )
+        if rec:
             rec.quantity += 1
         else:
-            rec = ScoresCountry( parent=game, game=game, country_code=country, quantity=1 )
+            rec = ScoresCountry.new( game, country, quantity=1 )
         rec.put()
 
         return None
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#
+# cocos live - (c) 2009 Ricardo Quesada
+# http://www.cocoslive.net
+#
+# License: GNU GPL v3
+# See the LICENSE file
+#
+__docformat__ = 'restructuredtext'
+
+#
+# In-process cache
+#
+# The entries live as long as the instance does, so they are only used
+# in front of memcache / datastore, for data that can be a few seconds stale.
+#
+
+# python imports
+import time
+
+__all__ = ['LRUCache']
+
+# link fields
+_PREV, _NEXT, _KEY, _VALUE, _EXPIRES = xrange(5)
+
+
+class LRUCache(object):
+    '''A bounded dictionary that evicts the least recently used entries.
+    Entries can expire after a number of seconds.'''
+
+    def __init__(self, size, ttl=None):
+        '''size: maximum number of entries
+        ttl: default time to live in seconds. None: entries don't expire'''
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def clear(self):
+        '''removes all the entries'''
+        self.entries = {}
+        # circular doubly linked list. root[_NEXT] is the most recently used
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, None]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def _unlink(self, link):
+        link[_PREV][_NEXT] = link[_NEXT]
+        link[_NEXT][_PREV] = link[_PREV]
+
+    def _push_front(self, link):
+        first = self.root[_NEXT]
+        link[_PREV] = self.root
+        link[_NEXT] = first
+        first[_PREV] = link
+        self.root[_NEXT] = link
+
+    def get(self, key, default=None):
+        '''returns the value of key, or default if it's not in the cache (or it expired)'''
+        link = self.entries.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        if link[_EXPIRES] is not None and link[_EXPIRES] < time.time():
+            self.delete(key)
+            self.misses += 1
+            return default
+        self._unlink(link)
+        self._push_front(link)
+        self.hits += 1
+        return link[_VALUE]
+
+    def set(self, key, value, ttl=None):
+        '''adds or replaces an entry. ttl overrides the default time to live'''
+        if ttl is None:
+            ttl = self.ttl
+        expires = None
+        if ttl is not None:
+            expires = time.time() + ttl
+
+        link = self.entries.get(key)
+        if link is not None:
+            self._unlink(link)
+            link[_VALUE] = value
+            link[_EXPIRES] = expires
+        else:
+            if len(self.entries) >= self.size:
+                oldest = self.root[_PREV]
+                self._unlink(oldest)
+                del self.entries[oldest[_KEY]]
+            link = [None, None, key, value, expires]
+            self.entries[key] = link
+        self._push_front(link)
+
+    def delete(self, key):
+        '''removes an entry, if present'''
+        link = self.entries.pop(key, None)
+        if link is not None:
+            self._unlink(link)
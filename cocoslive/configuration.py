@@ -37,3 +37,13 @@ SYSTEM_TITLE = 'cocos Live'
 
 # Unique identifier from Google Analytics
 ANALYTICS_ID = 'UA-871936-6'
+
+
+# Geo IP: seconds to wait for each remote Geo IP service
+GEOIP_DEADLINE = 2
+
+
+# Geo IP: if True, the scores are stored with country 'xx' and the country
+# is resolved later from the task queue, so the posts never wait for the
+# remote Geo IP services
+GEOIP_DEFERRED = False
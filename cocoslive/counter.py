@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+#
+# cocos live - (c) 2009 Ricardo Quesada
+# http://www.cocoslive.net
+#
+# License: GNU GPL v3
+# See the LICENSE file
+#
+__docformat__ = 'restructuredtext'
+
+#
+# Sharded counters
+#
+# A counter is split in NUM_SHARDS CounterShard entities. Every increment
+# updates a random shard in its own transaction, so the posts of a game
+# don't contend on a single entity. The sum of the shards is cached in memcache.
+#
+# The score counters are used for the total number of scores of a game and
+# for the number of scores by country:
+#     Game.nro_scores + counter 'scores:<game>'
+#     ScoresCountry.quantity + counter 'scores:<game>:<country>'
+# nro_scores and quantity hold what was counted before the sharded counters,
+# so the old values don't need to be migrated.
+#
+# The counters are updated after the scores are written, outside their transaction.
+# reconcile_scores() fixes the counts that could be lost.
+#
+
+# python imports
+import random
+
+# GAE imports
+from google.appengine.ext import db
+from google.appengine.api import memcache
+
+# local imports
+from model import CounterShard, ScoresCountry
+
+__all__ = ['increment', 'get_count', 'get_counts', 'delete_counter',
+    'add_scores', 'get_total_scores', 'prefetch_total_scores', 'get_scores_by_country', 'delete_scores', 'reconcile_scores',
+]
+
+# number of shards per counter
+NUM_SHARDS = 20
+
+# seconds that the sums are cached
+CACHE_TIME = 60
+
+
+def _cache_key( name ):
+    return 'counter:%s' % name
+
+def _shard_key_names( name ):
+    return [ '%s#%d' % (name, i) for i in xrange(NUM_SHARDS) ]
+
+
+def increment( name, delta=1 ):
+    '''adds delta (can be negative) to the counter name'''
+    key_name = '%s#%d' % (name, random.randint( 0, NUM_SHARDS - 1 ) )
+
+    def txn():
+        shard = CounterShard.get_by_key_name( key_name )
+        if shard is None:
+            shard = CounterShard( key_name=key_name, name=name )
+        shard.count += delta
+        shard.put()
+    db.run_in_transaction( txn )
+
+    # memcache can't store negative numbers. The sum will be read again
+    if delta >= 0:
+        memcache.incr( _cache_key( name ), delta )
+    else:
+        memcache.delete( _cache_key( name ) )
+
+
+def get_counts( names ):
+    '''returns a dict name -> value of the counters'''
+    counts = memcache.get_multi( [ _cache_key(n) for n in names ] )
+    ret = {}
+    missing = []
+    for name in names:
+        value = counts.get( _cache_key( name ) )
+        if value is None:
+            missing.append( name )
+        else:
+            ret[ name ] = value
+
+    if missing:
+        key_names = []
+        for name in missing:
+            key_names.extend( _shard_key_names( name ) )
+        shards = CounterShard.get_by_key_name( key_names )
+
+        to_cache = {}
+        for (i, name) in enumerate( missing ):
+            value = 0
+            for shard in shards[ i * NUM_SHARDS : (i+1) * NUM_SHARDS ]:
+                if shard:
+                    value += shard.count
+            ret[ name ] = value
+            if value >= 0:
+                to_cache[ _cache_key( name ) ] = value
+        # add: don't overwrite a sum updated by a concurrent increment
+        for (key, value) in to_cache.iteritems():
+            memcache.add( key, value, CACHE_TIME )
+    return ret
+
+
+def get_count( name ):
+    '''returns the value of the counter name'''
+    return get_counts( [name] )[ name ]
+
+
+def delete_counter( name ):
+    '''deletes the shards of the counter name'''
+    shards = [ s for s in CounterShard.get_by_key_name( _shard_key_names( name ) ) if s ]
+    db.delete( shards )
+    memcache.delete( _cache_key( name ) )
+
+
+#
+# Score counters
+#
+
+def total_scores_name( game_key ):
+    return 'scores:%s' % game_key
+
+def country_scores_name( game_key, country_code ):
+    return 'scores:%s:%s' % ( game_key, country_code )
+
+
+def add_scores( game, countries ):
+    '''countries: dict country_code -> number of new scores (can be negative).
+    Updates the total and the country counters'''
+    total = 0
+    for (country_code, quantity) in countries.iteritems():
+        if quantity:
+            increment( country_scores_name( game.key(), country_code ), quantity )
+            total += quantity
+    if total:
+        increment( total_scores_name( game.key() ), total )
+
+
+def get_total_scores( game ):
+    '''returns the number of scores of a game'''
+    return game.nro_scores + get_count( total_scores_name( game.key() ) )
+
+
+def prefetch_total_scores( games ):
+    '''reads the number of scores of a list of games with a single get_counts.
+    Game.total_scores() returns the prefetched number afterwards, so the game
+    lists don't read a counter per game'''
+    counts = get_counts( [ total_scores_name( g.key() ) for g in games ] )
+    for game in games:
+        game._total_scores = game.nro_scores + counts[ total_scores_name( game.key() ) ]
+
+
+def _group_by_country( game ):
+    '''returns a dict country_code -> ScoresCountry, with the legacy quantity of
+    all the rows of the country in 'base'.
+    Rows not moved yet by /admin/migrate-countries can be duplicated'''
+    countries = {}
+    for sc in game.nro_scores_country:
+        if sc.country_code in countries:
+            countries[ sc.country_code ].base += sc.quantity
+        else:
+            sc.base = sc.quantity
+            countries[ sc.country_code ] = sc
+    return countries
+
+
+def get_scores_by_country( game ):
+    '''returns a ScoresCountry per country of a game. Each one has the number of scores in 'total' '''
+    countries = _group_by_country( game ).values()
+    counts = get_counts( [ country_scores_name( game.key(), sc.country_code ) for sc in countries ] )
+    for sc in countries:
+        sc.total = sc.base + counts[ country_scores_name( game.key(), sc.country_code ) ]
+    return countries
+
+
+def delete_scores( game, countries ):
+    '''deletes the counters of a game. countries: the ScoresCountry of the game'''
+    delete_counter( total_scores_name( game.key() ) )
+    for sc in countries:
+        delete_counter( country_scores_name( game.key(), sc.country_code ) )
+
+
+def reconcile_scores( game, countries ):
+    '''sets the counters of a game to the real number of scores.
+    countries: dict country_code -> number of scores of the game.
+    Scores posted while they were being counted can make it off by a few'''
+    total = 0
+    existing = _group_by_country( game )
+    for country_code in existing:
+        countries.setdefault( country_code, 0 )
+
+    names = [ country_scores_name( game.key(), c ) for c in countries ] + [ total_scores_name( game.key() ) ]
+    # read the shards, not the cached sums
+    memcache.delete_multi( [ _cache_key( n ) for n in names ] )
+
+    current = get_counts( names )
+    for (country_code, quantity) in countries.iteritems():
+        total += quantity
+        name = country_scores_name( game.key(), country_code )
+        sc = existing.get( country_code )
+        if sc is None:
+            sc = ScoresCountry.new( game, country_code )
+            db.run_in_transaction( sc.insert )
+            sc.base = 0
+        delta = quantity - sc.base - current[ name ]
+        if delta:
+            increment( name, delta )
+
+    delta = total - get_total_scores( game )
+    if delta:
+        increment( total_scores_name( game.key() ), delta )
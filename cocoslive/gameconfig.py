@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+#
+# cocos live - (c) 2009 Ricardo Quesada
+# http://www.cocoslive.net
+#
+# License: GNU GPL v3
+# See the LICENSE file
+#
+__docformat__ = 'restructuredtext'
+
+#
+# Game configuration cache
+#
+# The api and widget handlers only read the configuration of a game, so they
+# use a read only snapshot of it (GameConfig) instead of the Game entity.
+# The snapshot also has the ranker roots of every category, so the rankers
+# can be opened without any datastore or memcache call.
+#
+# The snapshots are cached per instance (for LOCAL_TTL seconds) and in memcache.
+# The memcache copy is versioned: invalidate_config() bumps the version of the
+# game, and the snapshots stored with an older version are not used again.
+#
+
+# python imports
+import random
+
+# GAE imports
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+# local imports
+from model import Game
+from cache import LRUCache
+import ranking
+
+__all__ = ['GameConfig', 'get_config', 'peek_config', 'invalidate_config']
+
+# per instance cache. Other instances may see a modified game up to
+# LOCAL_TTL seconds late
+LOCAL_TTL = 30
+_local_cache = LRUCache( 500, LOCAL_TTL )
+
+# Game properties copied to the snapshot.
+# Not the number of scores: it is kept by the sharded counters (see counter.py)
+FIELDS = ( 'name', 'gamekey', 'scoreorder', 'publish', 'use_new_playername',
+    'ranking_enabled', 'ranking_min_score', 'ranking_max_score', 'ranking_branch_factor',
+    'ranking_shards', 'buffered_updates', 'windowed_leaderboards',
+    'ranking_countries', 'ranking_bucket_size',
+    )
+
+
+class GameConfig( object ):
+    '''Read only snapshot of a Game and of the rankers of its categories.
+    It can be used instead of the Game, where only the properties in FIELDS
+    and key() are needed'''
+
+    # defaults of the snapshots cached before the properties existed
+    windowed_leaderboards = False
+    ranking_countries = 0
+    ranking_bucket_size = 0
+
+    def __init__( self, game, rankings ):
+        '''rankings: dict category -> (rootkeys, score_range, branching_factor, bucket_size). See ranking.get_rankings'''
+        d = self.__dict__
+        d['_key'] = game.key()
+        for f in FIELDS:
+            d[f] = getattr( game, f )
+        d['rankings'] = rankings
+
+    def __setattr__( self, name, value ):
+        raise AttributeError( 'GameConfig is read only' )
+
+    def key( self ):
+        return self._key
+
+    def get_ranker( self, category ):
+        '''returns the ranker of a category, or None if the category had no ranker when the snapshot was taken'''
+        r = self.rankings.get( category )
+        if r is None:
+            return None
+        return ranking.open_ranker_from_config( *r )
+
+
+def _generation_key( name ):
+    return 'gameconfig_gen:%s' % name
+
+def _config_key( name ):
+    return 'gameconfig:%s' % name
+
+def get_config( name, prefetcher=None ):
+    '''returns the GameConfig of the game name, or None if the game doesn't exist.
+    prefetcher: a Prefetcher used to get the Game, if it is not cached'''
+    config = _local_cache.get( name )
+    if config is not None:
+        return config
+
+    gen_key = _generation_key( name )
+    config_key = _config_key( name )
+    values = memcache.get_multi( [gen_key, config_key] )
+
+    # initialized with a random value, so that snapshots stored before an
+    # eviction of the generation can't be used again
+    generation = values.get( gen_key )
+    if generation is None:
+        memcache.add( gen_key, random.randint( 0, 2 ** 30 ) )
+        generation = memcache.get( gen_key )
+
+    cached = values.get( config_key )
+    if cached is not None and generation is not None and cached[0] == generation:
+        config = cached[1]
+    else:
+        game_key = db.Key.from_path( 'Game', name )
+        if prefetcher is not None:
+            game = prefetcher.get( game_key )
+        else:
+            game = Game.get( game_key )
+        if game is None:
+            return None
+        config = GameConfig( game, ranking.get_rankings( game_key ) )
+        if generation is not None:
+            memcache.set( config_key, (generation, config) )
+
+    _local_cache.set( name, config )
+    return config
+
+def peek_config( name ):
+    '''returns the GameConfig of the game name if this instance has it, or None. No RPCs'''
+    return _local_cache.get( name )
+
+def invalidate_config( name ):
+    '''forgets the snapshot of a game. Call it after the Game or its rankers changed'''
+    _local_cache.delete( name )
+    key = _generation_key( name )
+    if memcache.incr( key ) is None:
+        memcache.delete( key )
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+#
+# cocos live - (c) 2009 Ricardo Quesada
+# http://www.cocoslive.net
+#
+# License: GNU GPL v3
+# See the LICENSE file
+#
+__docformat__ = 'restructuredtext'
+
+#
+# Local Geo IP database
+#
+# Resolves an IP address to a country code without leaving the instance.
+# The ranges are read once per instance from geoip.zip (bundled like flags.zip)
+# and kept in sorted arrays, so a lookup is a bisect.
+#
+# geoip.zip must contain a geoip.csv file in any of these formats:
+#   - 3 columns: first_ip,last_ip,country_code
+#     (the ips as integers or dotted quads)
+#   - MaxMind GeoIP Country CSV:
+#     "first_ip","last_ip","first_int","last_int","CC","Country name"
+#
+# The database is not commited. If geoip.zip is not found, lookup() returns None
+# and the remote Geo IP services are used instead.
+#
+
+# python imports
+import os
+import csv
+import logging
+import zipfile
+from array import array
+from bisect import bisect_right
+
+__all__ = ['lookup', 'load_table', 'GeoIPTable']
+
+GEOIP_ZIP = os.path.join( os.path.dirname( __file__ ), 'geoip.zip' )
+GEOIP_CSV = 'geoip.csv'
+
+def ip_to_int( ipaddr ):
+    '''converts a dotted quad to an integer. Returns None if the address is not valid'''
+    try:
+        l = [ int(x) for x in ipaddr.split('.') ]
+    except ValueError:
+        return None
+    if len(l) != 4:
+        return None
+    for i in l:
+        if i < 0 or i > 255:
+            return None
+    return (l[0] << 24) | (l[1] << 16) | (l[2] << 8) | l[3]
+
+def _parse_ip( value ):
+    value = value.strip()
+    if '.' in value:
+        return ip_to_int( value )
+    return int( value )
+
+class GeoIPTable( object ):
+    '''Sorted, non overlapping ip ranges with their country codes'''
+
+    def __init__( self, rows ):
+        '''rows: iterable of (first_ip, last_ip, country_code), the ips as integers'''
+        rows = sorted( rows )
+        # 'L' is at least 32 bits: enough for an IPv4 address
+        self.starts = array('L')
+        self.ends = array('L')
+        self.codes = []
+        for (start, end, code) in rows:
+            self.starts.append( start )
+            self.ends.append( end )
+            # intern the codes: there are only ~250 of them
+            self.codes.append( intern( code.strip().lower() ) )
+
+    def __len__( self ):
+        return len( self.starts )
+
+    def lookup( self, ipaddr ):
+        '''returns the country code of ipaddr (a dotted quad), or None if it is not in the table'''
+        ip = ip_to_int( ipaddr )
+        if ip is None:
+            return None
+        i = bisect_right( self.starts, ip ) - 1
+        if i >= 0 and ip <= self.ends[i]:
+            return self.codes[i]
+        return None
+
+def parse_rows( lines ):
+    '''parses the csv lines into (first_ip, last_ip, country_code) tuples'''
+    rows = []
+    for row in csv.reader( lines ):
+        if not row or row[0].startswith('#'):
+            continue
+        try:
+            if len(row) >= 5:
+                # MaxMind format
+                rows.append( ( int(row[2]), int(row[3]), row[4] ) )
+            else:
+                rows.append( ( _parse_ip(row[0]), _parse_ip(row[1]), row[2] ) )
+        except (ValueError, TypeError, IndexError), e:
+            logging.warning('geolocal: ignoring invalid row: %s' % row )
+    return rows
+
+def load_table( filename=GEOIP_ZIP ):
+    '''loads the table from a zip file. Returns an empty table if the file can't be read'''
+    try:
+        z = zipfile.ZipFile( filename )
+        try:
+            data = z.read( GEOIP_CSV )
+        finally:
+            z.close()
+    except (IOError, KeyError, zipfile.BadZipfile), e:
+        logging.info('geolocal: no local Geo IP database: %s' % e )
+        return GeoIPTable( [] )
+    table = GeoIPTable( parse_rows( data.splitlines() ) )
+    logging.info('geolocal: loaded %d ranges' % len(table) )
+    return table
+
+# loaded on first use, and kept for the life of the instance
+_table = None
+
+def lookup( ipaddr ):
+    '''returns the country code of ipaddr using the local database, or None if it is unknown'''
+    global _table
+    if _table is None:
+        _table = load_table()
+    return _table.lookup( ipaddr )
+
+
+if __name__ == '__main__':
+    import random
+    import timeit
+
+    # a synthetic table with the size of the MaxMind country database
+    rows = []
+    start = 0
+    while start < 0xffffffff:
+        end = min( start + random.randint( 1, 1 << 16 ), 0xffffffff )
+        rows.append( ( start, end, random.choice( ['ar', 'us', 'de', 'jp', 'br'] ) ) )
+        start = end + 2
+    table = GeoIPTable( rows )
+
+    ips = [ '%d.%d.%d.%d' % tuple( [ random.randint(0, 255) for i in range(4) ] ) for j in xrange(1000) ]
+
+    def run():
+        for ip in ips:
+            table.lookup( ip )
+
+    number = 100
+    t = timeit.Timer( run ).timeit( number )
+    print '%d ranges: %.0f lookups/sec' % ( len(table), len(ips) * number / t )
@@ -33,7 +33,10 @@ from google.appengine.api import datastore_types
 from model import *
 from util import *
 import configuration
-from ranker import ranker
+import ranking
+import pagecache
+import counter
+from paging import fetch_page
 
 
 class BaseHandler( webapp.RequestHandler):
@@ -105,19 +108,10 @@ class BaseHandler( webapp.RequestHandler):
         return self.respond('404', params )
 
     def get_ranker( self, game_key, category ):
-        key = datastore_types.Key.from_path("Ranking", category, parent=game_key )
-        return ranker.Ranker(datastore.Get(key)["ranker"])
+        return ranking.get_ranker( game_key, category )
 
     def get_or_create_ranker( self, game_key, category ):
-        key = datastore_types.Key.from_path("Ranking", category, parent=game_key )
-        try:
-            return ranker.Ranker(datastore.Get(key)["ranker"])
-        except datastore_errors.EntityNotFoundError:
-            r = ranker.Ranker.Create([self.game.ranking_min_score, self.game.ranking_max_score], self.game.ranking_branch_factor)
-            app = datastore.Entity("Ranking", name=category, parent=game_key )
-            app["ranker"] = r.rootkey
-            datastore.Put(app)
-            return r
+        return ranking.get_or_create_ranker( self.game, category )
 #
 # '/' handler
 #
@@ -143,6 +137,8 @@ class MainPage(BaseHandler):
                 selected_idx.append( idx )
                 selected_games.append( games[idx] )
 
+        counter.prefetch_total_scores( selected_games )
+
         params = {
             'games' : selected_games,
             'user' : user,
@@ -181,49 +177,37 @@ class GameScores(BaseHandler):
         if not deviceid:
             deviceid = ''
 
+        # continue from the previous page ?
+        cursor = self.request.get('cursor')
+
         limit = 20
 
         order = '-cc_score'
         if game.scoreorder == 'asc':
             order = 'cc_score'
-        # sort the scores by the score field
-        query.ancestor( game )
-        query.filter('cc_category =',category)
-        query.order(order)
-        if country:
-            query.filter('cc_country =',country)
-        if deviceid:
-            query.filter('cc_device_id =',deviceid)
-        scores = query.fetch(limit=limit, offset=offset)
 
-        if game.ranking_enabled:
-            self.game = game        # needed for get_or_create_ranker
-            ranker = self.get_or_create_ranker( game.key(), category )
-            s = map( lambda y: [y.cc_score], scores)
-            try:
-                ranks = ranker.FindRanks( s )
-                for i,item in enumerate(scores):
-                    item.position = ranks[i]+1
-            except AssertionError, e:
-                logging.error('Main#get_scores: Ranking out of range')
-                for i,item in enumerate(scores):
-                    item.position = offset + i + 1
-        else:
-            for i,item in enumerate(scores):
-                item.position = offset + i + 1
+        # the page of scores is cached until somebody writes a score in this category
+        shape = ( 'web', offset, cursor, limit, order, country, deviceid )
+        page, generation = pagecache.get_page( game.key(), category, shape )
+        if page is None:
+            page = self.get_scores( game, query, category, order, country, deviceid, offset, cursor, limit )
+            pagecache.set_page( game.key(), category, shape, page, generation )
+        scores, offset, next_cursor = page
 
         fields = game.score_fields
 
         show_prev = ( offset > 0 )
-        show_next = ( len(scores) == limit )
+        show_next = ( next_cursor is not None )
 
         # iPhone ??
         supports_flash = not 'iphone' in os.environ['HTTP_USER_AGENT'].lower()
 
+        scores_by_country = counter.get_scores_by_country( game )
+
         params = {
             'offset' : offset,
-            'next_offset' : offset + limit,
-            'prev_offset' : offset - limit,
+            'next_cursor' : next_cursor,
+            'prev_offset' : max( offset - limit, 0 ),
             'show_next' : show_next,
             'show_prev' : show_prev,
             'category' : category,
@@ -231,16 +215,46 @@ class GameScores(BaseHandler):
             'deviceid' : deviceid,
             'fields' : fields,
             'scores' : scores,
-            'scores_by_country' : game.nro_scores_country,
-            'total_countries' : game.nro_scores_country.count(),
+            'scores_by_country' : scores_by_country,
+            'total_countries' : len( scores_by_country ),
             'game' : game,
             'dev' : game.owner,
             'country' : country,
             'supports_flash' : supports_flash,
-            'page' : {'title' : 'Game Scores: %s (%s)' % (gamename,game.nro_scores,) },
+            'page' : {'title' : 'Game Scores: %s (%s)' % (gamename,game.total_scores(),) },
         }
         self.respond('game-scores', params)
 
+    def get_scores( self, game, query, category, order, country, deviceid, offset, cursor, limit ):
+        '''returns a tuple (scores, offset, next_cursor).
+        Each score has a 'position' attribute'''
+        # sort the scores by the score field
+        query.ancestor( game )
+        query.filter('cc_category =',category)
+        query.order(order)
+        if country:
+            query.filter('cc_country =',country)
+        if deviceid:
+            query.filter('cc_device_id =',deviceid)
+        scores, offset, next_cursor = fetch_page( query, limit, offset, cursor )
+
+        if game.ranking_enabled:
+            self.game = game        # needed for get_or_create_ranker
+            ranker = self.get_or_create_ranker( game.key(), category )
+            s = map( lambda y: [y.cc_score], scores)
+            try:
+                ranks = ranker.FindRanks( s )
+                for i,item in enumerate(scores):
+                    item.position = ranks[i]+1
+            except AssertionError, e:
+                logging.error('Main#get_scores: Ranking out of range')
+                for i,item in enumerate(scores):
+                    item.position = offset + i + 1
+        else:
+            for i,item in enumerate(scores):
+                item.position = offset + i + 1
+        return ( scores, offset, next_cursor )
+
 #
 # Icon Handler
 #
@@ -320,11 +334,12 @@ class GamesUsingCocosLive(BaseHandler):
 
         query_str = "SELECT * FROM Game WHERE publish=True"
 #        query_str = "SELECT * FROM Game"
-        games = db.GqlQuery(query_str)
+        games = db.GqlQuery(query_str).fetch(1000)
+        counter.prefetch_total_scores( games )
 
         params = {
             'games' : games,
-            'total' : games.count(),
+            'total' : len( games ),
             'page' : {'title' : 'Games Using Cocos Live'},
         }
         self.respond('games', params)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# cocos live - (c) 2009 Ricardo Quesada
+# http://www.cocoslive.net
+#
+# License: GNU GPL v3
+# See the LICENSE file
+#
+__docformat__ = 'restructuredtext'
+
+#
+# Usage meter
+#
+# Counts the pushes (post / update score) and pops (get scores / ranks) of every game.
+# The requests are counted in memory, and every FLUSH_INTERVAL seconds the
+# counts of the instance are sent to a task, which adds them to the
+# NumberOfQueries buckets of each game: all, year, month, week and day.
+#
+# Counts not flushed when an instance dies are lost: it is a meter, not an accounting.
+#
+
+# python imports
+import time
+import datetime
+import logging
+
+# GAE imports
+from google.appengine.ext import db
+from google.appengine.api.labs import taskqueue
+
+# 3rd partly libs
+import simplejson as json
+
+# local imports
+from model import NumberOfQueries
+
+__all__ = ['push', 'pop', 'flush', 'write', 'get_report', 'PERIODS']
+
+# seconds between flushes
+FLUSH_INTERVAL = 60
+
+PERIODS = ('all', 'year', 'month', 'week', 'day')
+
+# game name -> [pushes, pops] not flushed yet
+_counts = {}
+_last_flush = time.time()
+
+
+def push( game_name ):
+    '''counts a score post / update'''
+    _record( game_name, 0 )
+
+def pop( game_name ):
+    '''counts a scores / ranks query'''
+    _record( game_name, 1 )
+
+def _record( game_name, index ):
+    counts = _counts.get( game_name )
+    if counts is None:
+        counts = _counts[ game_name ] = [0, 0]
+    counts[ index ] += 1
+
+    if time.time() - _last_flush >= FLUSH_INTERVAL:
+        flush()
+
+
+def flush():
+    '''sends the counts of this instance to the task queue'''
+    global _counts, _last_flush
+    counts = _counts
+    _counts = {}
+    _last_flush = time.time()
+    if not counts:
+        return
+    try:
+        taskqueue.add( url='/admin/write-meter', params={'counts' : json.dumps( counts ), 'when' : int(_last_flush) } )
+    except taskqueue.Error, e:
+        logging.warning('meter: counts lost: %s' % e )
+
+
+def buckets( when ):
+    '''returns the (period, bucket) of a datetime for every period'''
+    iso_year, iso_week, iso_weekday = when.isocalendar()
+    return [
+        ('all', 0),
+        ('year', when.year),
+        ('month', when.year * 100 + when.month),
+        ('week', iso_year * 100 + iso_week),
+        ('day', (when.year * 100 + when.month) * 100 + when.day),
+        ]
+
+def _key_name( period, bucket ):
+    return '%s_%d' % (period, bucket)
+
+
+def write( game, pushes, pops, when ):
+    '''adds the counts to the buckets of the game. when: datetime of the counts'''
+    b = buckets( when )
+    keys = [ db.Key.from_path( 'NumberOfQueries', _key_name( period, bucket ), parent=game.key() ) for (period, bucket) in b ]
+
+    def txn():
+        entities = db.get( keys )
+        for i in xrange( len(b) ):
+            if entities[i] is None:
+                period, bucket = b[i]
+                entities[i] = NumberOfQueries( key_name=_key_name( period, bucket ), parent=game, game=game, period=period, bucket=bucket )
+            entities[i].quantity_push += pushes
+            entities[i].quantity_pop += pops
+        db.put( entities )
+    db.run_in_transaction( txn )
+
+
+def get_report( period, when=None ):
+    '''returns the NumberOfQueries of every game for the current bucket of a period,
+    the busiest games first'''
+    if when is None:
+        when = datetime.datetime.utcnow()
+    bucket = dict( buckets( when ) )[ period ]
+    query = NumberOfQueries.all().filter( 'period =', period ).filter( 'bucket =', bucket )
+    entries = query.fetch( 1000 )
+    entries.sort( key=lambda e: e.quantity_push + e.quantity_pop, reverse=True )
+    return entries
@@ -14,6 +14,9 @@ from google.appengine.ext import db
 __all__ = ['Developer', 'Game', 'Score', 'ScoreField', 'Category', 'ScoresCountry',
     'DefaultValues',
     'NumberOfQueries',
+    'PendingScore',
+    'WindowScore',
+    'CounterShard',
 ]
 
 #
@@ -74,6 +77,7 @@ class Game(db.Model):
 
     #: Number of Scores
     #: It is impossible with current GAE limitations to know if a query has more than 1000 entries
+    #: Only the scores counted before the sharded counters. Use total_scores()
     nro_scores = db.IntegerProperty( default = 0)
 
     #: Featured game
@@ -95,9 +99,40 @@ class Game(db.Model):
     #: ranking:
     ranking_branch_factor = db.IntegerProperty(default=100, required=False)
 
+    #: ranking: number of ranker trees per category. More shards allow more score updates per second
+    ranking_shards = db.IntegerProperty(default=1, required=False)
+
+    #: ranking: maximum number of countries with their own ranker, per category. 0: none
+    ranking_countries = db.IntegerProperty(default=0, required=False)
+
+    #: ranking: scores kept in a ranker node before it is split (see ranker/bucket.py). 0: fixed depth rankers
+    ranking_bucket_size = db.IntegerProperty(default=0, required=False)
+
+    #: 'update score' requests are queued and written in batches
+    buffered_updates = db.BooleanProperty(default=False, required=False)
+
+    #: day, week and month leaderboards. See windows.py
+    windowed_leaderboards = db.BooleanProperty(default=False, required=False)
+
     def __str__(self):
         return str( self.name )
 
+    def total_scores(self):
+        '''Number of scores of the game (see counter.py).
+        Games read with counter.prefetch_total_scores() already have it'''
+        total = getattr( self, '_total_scores', None )
+        if total is not None:
+            return total
+        import counter
+        return counter.get_total_scores( self )
+
+#
+# Scores
+#
+# Update-score games have 1 Score per player and category.
+# key name: 'cc_' + category + ':' + profile id (see Score.key_for). parent: the game
+# Older update-score Scores and post-score Scores have numeric ids
+#
 class Score(db.Expando):
     #: game that belongs
     cc_game = db.ReferenceProperty( Game, collection_name = 'scores' )
@@ -124,6 +159,21 @@ class Score(db.Expando):
     #: score. It can later be changed to Float or String
 #    cc_score = db.IntegerProperty()
 
+    #: how the score is in the rankers: 'name' (update-score, as playername@device_id)
+    #: or 'value' (post-score, without a name. See Ranker.AddScores).
+    #: The scores ranked before it existed are ranked by name
+    cc_ranked_by = db.StringProperty()
+
+    @classmethod
+    def key_name_for( cls, category, profile_id ):
+        return 'cc_%s:%s' % ( category, profile_id )
+
+    @classmethod
+    def key_for( cls, game_key, category, profile_id ):
+        '''key of the Score of a player (playername@device_id) of an update-score game.
+        It can be batched with other keys in a db.get()'''
+        return db.Key.from_path( cls.kind(), cls.key_name_for( category, profile_id ), parent=game_key )
+
 
 class ScoreField(db.Model):
     #: game that belongs
@@ -156,22 +206,123 @@ class Category(db.Model):
     name = db.StringProperty( required = True )
 
 
+#
+# Pending score updates
+#
+# Used by games with 'buffered_updates'. The update-score requests are stored
+# here and later written to Score in batches.
+# They don't have a parent, so that queuing doesn't contend on the game's entity group
+#
+class PendingScore(db.Expando):
+    #: game that belongs
+    game = db.ReferenceProperty( Game, collection_name = 'pending_scores' )
+
+    #: iPhone device id
+    cc_device_id = db.StringProperty( required = True )
+
+    #: category
+    cc_category = db.StringProperty( default = '' )
+
+    #: player name
+    cc_playername = db.StringProperty( default = '' )
+
+    #: ip address. The country is resolved when the score is written
+    cc_ip = db.StringProperty( required = True)
+
+    #: when
+    cc_when = db.DateTimeProperty( auto_now_add=True )
+
+    #: score and usr_ fields are dynamic properties
+
+#
+# Scores of the leaderboard windows
+#
+# A copy of a Score in a day, week or month window. See windows.py
+# Update-score games have 1 copy per player and window (key name: window + category + profile).
+# parent: the game
+#
+class WindowScore(db.Expando):
+    #: game that belongs
+    cc_game = db.ReferenceProperty( Game, collection_name = 'window_scores' )
+
+    #: the copied score
+    cc_source = db.ReferenceProperty( Score, collection_name = 'window_scores' )
+
+    #: window name. eg: 'week_201042'
+    cc_window = db.StringProperty( required = True )
+
+    #: when the window ends. Deleted by the sweeper after that
+    cc_expires = db.DateTimeProperty( required = True )
+
+    #: same fields as Score
+    cc_device_id = db.StringProperty( default = 'no_device' )
+    cc_category = db.StringProperty( default = '' )
+    cc_when = db.DateTimeProperty( auto_now = True )
+    cc_ip = db.StringProperty()
+    cc_country = db.StringProperty( default = '')
+    cc_playername = db.StringProperty( default = '')
+
+    #: score and usr_ fields are dynamic properties
+
 #
 # Scores by country
 #
+# key name: 'cc_' + country code. parent: the game
+# so it can be fetched by key, without queries. See /admin/migrate-countries
+#
 class ScoresCountry( db.Model ):
     #: game that belongs
     game = db.ReferenceProperty( Game, collection_name = 'nro_scores_country' )
     country_code = db.StringProperty( required = True)
+    #: Only the scores counted before the sharded counters. See counter.get_scores_by_country()
     quantity = db.IntegerProperty( required = True )
 
+    @classmethod
+    def key_name_for( cls, country_code ):
+        return 'cc_%s' % country_code
+
+    @classmethod
+    def key_for( cls, game_key, country_code ):
+        '''key of the ScoresCountry of a game. It can be batched with other keys in a db.get()'''
+        return db.Key.from_path( cls.kind(), cls.key_name_for( country_code ), parent=game_key )
+
+    @classmethod
+    def new( cls, game, country_code, quantity=0 ):
+        '''a new (not saved) ScoresCountry'''
+        return cls( key_name=cls.key_name_for( country_code ), parent=game, game=game, country_code=country_code, quantity=quantity )
+
+    def insert( self ):
+        '''get-or-insert of a new ScoresCountry. Run it in a transaction of the game:
+        the row is read again, and only put if it doesn't exist yet. So a row written
+        since it was read (eg: by /admin/migrate-countries, with its legacy quantity) is kept'''
+        if db.get( self.key() ) is None:
+            self.put()
+
 #
-# Number of queries
+# Sharded counters
+#
+# A counter is the sum of its shards. See counter.py
+# They don't have a parent, so that the increments don't contend on any entity group
 #
+class CounterShard( db.Model ):
+    #: counter name
+    name = db.StringProperty( required = True )
+
+    #: shard value
+    count = db.IntegerProperty( required = True, default = 0 )
 
+#
+# Number of queries
+#
+# One entity per game and time bucket. Written by meter.py
+#
 class NumberOfQueries( db.Model ):
     # game that they belong to
     game = db.ReferenceProperty( Game, collection_name = 'number_of_queries' )
+    # 'all', 'year', 'month', 'week' or 'day'
+    period = db.StringProperty()
+    # 0, yyyy, yyyymm, yyyyww (iso week) or yyyymmdd
+    bucket = db.IntegerProperty()
     # new scores / update scores
     quantity_push = db.IntegerProperty( required = True, default = 0 )
     # query scores
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+#
+# cocos live - (c) 2009 Ricardo Quesada
+# http://www.cocoslive.net
+#
+# License: GNU GPL v3
+# See the LICENSE file
+#
+__docformat__ = 'restructuredtext'
+
+#
+# Leaderboard page cache
+#
+# Pages (the final response body, or the data needed to render it) are
+# stored in memcache, keyed by game, category and the shape of the query.
+#
+# Every game and every (game, category) have a generation number in memcache.
+# A write bumps the generation, and a cached page is only used if it was
+# stored with the current generations. The generations and the page are
+# read with a single memcache call.
+#
+
+# python imports
+import hashlib
+import random
+
+# GAE imports
+from google.appengine.api import memcache
+
+__all__ = ['get_page', 'set_page', 'invalidate_category', 'invalidate_game']
+
+# seconds. Pages also expire if nobody writes, to limit memcache usage
+PAGE_TIME = 60 * 60
+
+
+def _digest( value ):
+    if isinstance( value, unicode ):
+        value = value.encode('utf-8')
+    return hashlib.md5( value ).hexdigest()
+
+def _game_generation_key( game_key ):
+    return 'page_gen:%s' % game_key
+
+def _category_generation_key( game_key, category ):
+    return 'page_gen:%s:%s' % ( game_key, _digest(category) )
+
+def _page_key( game_key, category, shape ):
+    return 'page:%s:%s' % ( game_key, _digest( repr( (category, shape) ) ) )
+
+def get_page( game_key, category, shape ):
+    '''returns a tuple (page, generation).
+    page is None if it is not in the cache (or it is stale).
+    generation shall be passed to set_page.
+    shape: a tuple with everything (but the game and category) the page depends on'''
+    game_gen_key = _game_generation_key( game_key )
+    category_gen_key = _category_generation_key( game_key, category )
+    page_key = _page_key( game_key, category, shape )
+
+    values = memcache.get_multi( [game_gen_key, category_gen_key, page_key] )
+
+    # generations are initialized with a random value, so that pages
+    # stored before an eviction of the generation can't be used again
+    missing = {}
+    for key in (game_gen_key, category_gen_key):
+        if key not in values:
+            missing[key] = random.randint( 0, 2 ** 30 )
+    if missing:
+        memcache.add_multi( missing )
+        values.update( memcache.get_multi( missing.keys() ) )
+
+    generation = ( values.get(game_gen_key), values.get(category_gen_key) )
+    page = values.get( page_key )
+    if page is not None and page[0] == generation and None not in generation:
+        return ( page[1], generation )
+    return ( None, generation )
+
+def set_page( game_key, category, shape, page, generation ):
+    '''stores a page, using the generation returned by get_page'''
+    if None in generation:
+        # memcache is not working
+        return
+    memcache.set( _page_key( game_key, category, shape ), (generation, page), PAGE_TIME )
+
+def invalidate_category( game_key, category ):
+    '''forgets all the cached pages of a category. Call it after the scores of a category changed'''
+    key = _category_generation_key( game_key, category )
+    if memcache.incr( key ) is None:
+        memcache.delete( key )
+
+def invalidate_game( game_key ):
+    '''forgets all the cached pages of a game'''
+    key = _game_generation_key( game_key )
+    if memcache.incr( key ) is None:
+        memcache.delete( key )
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+#
+# cocos live - (c) 2009 Ricardo Quesada
+# http://www.cocoslive.net
+#
+# License: GNU GPL v3
+# See the LICENSE file
+#
+__docformat__ = 'restructuredtext'
+
+#
+# Cursor based pagination
+#
+# 'offset' makes the datastore skip (and read) all the previous entities,
+# so deep pages are slow and can't go beyond 1000.
+# A cursor continues the query where the previous page finished, so every
+# page costs the same. The cursors sent to the clients also contain the
+# position of the first score of the page, so that positions can be shown
+# without an offset.
+#
+
+__all__ = ['fetch_page', 'InvalidCursorError']
+
+
+class InvalidCursorError(Exception):
+    pass
+
+
+def encode_cursor( position, datastore_cursor ):
+    '''returns the opaque cursor sent to the clients'''
+    return '%d:%s' % ( position, datastore_cursor )
+
+def decode_cursor( cursor ):
+    '''returns a tuple (position, datastore cursor)'''
+    try:
+        position, datastore_cursor = cursor.split(':', 1)
+        return ( int(position), str(datastore_cursor) )
+    except ValueError, e:
+        raise InvalidCursorError('Invalid cursor: %s' % cursor)
+
+def fetch_page( query, limit, offset=0, cursor=None ):
+    '''fetches a page of results.
+    If cursor is given, the query continues from there and offset is ignored.
+    returns a tuple (results, position, next_cursor):
+        position: position of the first result (0-based)
+        next_cursor: cursor of the following page, or None if this is the last page'''
+    position = offset
+    if cursor:
+        position, datastore_cursor = decode_cursor( cursor )
+        query.with_cursor( datastore_cursor )
+        results = query.fetch( limit )
+    else:
+        results = query.fetch( limit, offset )
+
+    next_cursor = None
+    if len(results) == limit:
+        next_cursor = encode_cursor( position + len(results), query.cursor() )
+    return ( results, position, next_cursor )
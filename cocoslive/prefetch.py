@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+#
+# cocos live - (c) 2009 Ricardo Quesada
+# http://www.cocoslive.net
+#
+# License: GNU GPL v3
+# See the LICENSE file
+#
+__docformat__ = 'restructuredtext'
+
+#
+# Request-scoped entity prefetcher
+#
+# A request adds the keys of all the entities it is going to need, and they are
+# fetched in a single datastore Get the first time any of them is needed.
+# Entities of kinds with a db.Model class are returned as model instances,
+# the rest (eg: 'Ranking') as datastore.Entity
+#
+
+# GAE imports
+from google.appengine.api import datastore
+from google.appengine.ext import db
+
+__all__ = ['Prefetcher']
+
+
+def _to_model( entity ):
+    if entity is None:
+        return None
+    try:
+        cls = db.class_for_kind( entity.kind() )
+    except db.KindError:
+        return entity
+    return cls.from_entity( entity )
+
+
+class Prefetcher( object ):
+    '''Fetches the keys added with add() in one batch'''
+
+    def __init__( self ):
+        # keys not fetched yet
+        self.pending = []
+        # key -> entity (or None if it doesn't exist)
+        self.entities = {}
+        # number of datastore Gets
+        self.batches = 0
+
+    def add( self, *keys ):
+        '''the entities of these keys will be fetched in the next batch'''
+        for key in keys:
+            if key not in self.entities and key not in self.pending:
+                self.pending.append( key )
+
+    def fetch( self ):
+        '''fetches the pending keys'''
+        if not self.pending:
+            return
+        keys = self.pending
+        self.pending = []
+        entities = datastore.Get( keys )
+        self.batches += 1
+        for (key, entity) in zip( keys, entities ):
+            self.entities[ key ] = _to_model( entity )
+
+    def get_multi( self, keys ):
+        '''returns the entities of the keys (None if they don't exist).
+        The keys not fetched yet are fetched with the rest of the pending keys'''
+        self.add( *keys )
+        for key in keys:
+            if key not in self.entities:
+                self.fetch()
+                break
+        return [ self.entities[ key ] for key in keys ]
+
+    def get( self, key ):
+        '''returns the entity of a key, or None if it doesn't exist'''
+        return self.get_multi( [key] )[0]
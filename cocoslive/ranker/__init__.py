@@ -1 +1 @@
-__all__ = ["common", "ranker"]
+__all__ = ["bucket", "common", "nodecache", "ranker", "sharded"]
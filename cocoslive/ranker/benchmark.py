@@ -0,0 +1,91 @@
+#!/usr/bin/python
+#
+# cocos live - (c) 2009 Ricardo Quesada
+# http://www.cocoslive.net
+#
+# License: GNU GPL v3
+# See the LICENSE file
+#
+
+"""Benchmark of Ranker.FindRanks.
+
+Compares the batched FindRanks with the previous implementation, which found
+the path of every score and summed the child counts of every node of the
+path for each score, instead of reading the cumulative counts of the nodes.
+The nodes are kept in memory, so only the computation is measured, not the
+datastore.
+
+Usage (with the App Engine SDK in the PYTHONPATH):
+  python ranker/benchmark.py [number_of_scores] [batch_size]
+"""
+
+import random
+import sys
+import timeit
+
+from ranker import CumulativeCounts
+from ranker import Ranker
+
+
+class MemoryRanker(Ranker):
+  """A Ranker whose nodes are a dict of node ids to child counts."""
+
+  def __init__(self, score_range, branching_factor):
+    self.rootkey = None
+    self.score_range = score_range
+    self.branching_factor = branching_factor
+    self.cache_hits = 0
+    self.cache_misses = 0
+    self.nodes = {}
+    self.cumulative = {}
+
+  def _Ranker__GetMultipleNodes(self, node_ids):
+    nodes = {}
+    for node_id in set(node_ids):
+      if node_id in self.nodes:
+        if node_id not in self.cumulative:
+          self.cumulative[node_id] = CumulativeCounts(self.nodes[node_id])
+        nodes[node_id] = self.cumulative[node_id]
+    return nodes
+
+  def Add(self, score):
+    for (node_id, child) in self._Ranker__FindNodeIDs(score):
+      if node_id not in self.nodes:
+        self.nodes[node_id] = [0] * self.branching_factor
+      self.nodes[node_id][child] += 1
+      self.cumulative.pop(node_id, None)
+
+  def FindRanksPerScore(self, scores):
+    """The previous implementation of FindRanks."""
+    ranks = []
+    for score in scores:
+      tot = 0
+      for (node_id, child) in self._Ranker__FindNodeIDs(score):
+        if node_id in self.nodes:
+          child_counts = self.nodes[node_id]
+          for i in xrange(child + 1, self.branching_factor):
+            tot += child_counts[i]
+      ranks.append(tot)
+    return ranks
+
+
+def main(number_of_scores=100000, batch_size=1000):
+  score_range = [0, 1000000]
+  ranker = MemoryRanker(score_range, 100)
+  for _ in xrange(number_of_scores):
+    ranker.Add([random.randint(score_range[0], score_range[1] - 1)])
+  batch = [[random.randint(score_range[0], score_range[1] - 1)]
+           for _ in xrange(batch_size)]
+
+  assert ranker.FindRanks(batch) == ranker.FindRanksPerScore(batch)
+
+  number = 20
+  for (name, method) in (("per score", ranker.FindRanksPerScore),
+                         ("batched", ranker.FindRanks)):
+    t = timeit.Timer(lambda: method(batch)).timeit(number)
+    print "%-10s %d scores, batches of %d: %.1f ms per batch" % (
+        name, number_of_scores, batch_size, t * 1000 / number)
+
+
+if __name__ == "__main__":
+  main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,521 @@
+#!/usr/bin/python
+#
+# cocos live - (c) 2009 Ricardo Quesada
+# http://www.cocoslive.net
+#
+# License: GNU GPL v3
+# See the LICENSE file
+#
+
+"""A Ranker whose tree is only as deep as its scores need."""
+
+import bisect
+
+from google.appengine.api import datastore
+from google.appengine.api import datastore_types
+from google.appengine.api import memcache
+
+from common import transactional
+from nodecache import NodeCache
+from ranker import CumulativeCounts
+
+
+# The largest bucket_size: a bucket is a single entity.
+MAX_BUCKET_SIZE = 1000
+
+# The kinds of the nodes returned by __GetMultipleNodes.
+BUCKET = "bucket"
+INNER = "inner"
+
+
+class BucketRanker(NodeCache):
+  """A Ranker that stores the scores of sparse subtrees in sorted lists.
+
+  A Ranker always has a node per level of the score range: with the range
+  [0, 100000000) and a branching factor of 100, every score touches 4 nodes,
+  even if the ranker only has a few hundred scores.  A BucketRanker starts
+  with the root as a "bucket": a node holding the sorted list of the scores in
+  its range.  Once a bucket has more than bucket_size scores it is split: it
+  becomes an inner node with child counts, like the nodes of Ranker, and each
+  of its children that has scores becomes a new bucket.  Buckets are never
+  merged back.
+
+  Small games thus write 1 node per operation, and big games only split the
+  subtrees where their scores are.  The nodes have the same ids as in Ranker,
+  so the nodes of a score are still found without a query: like Ranker, every
+  operation but FindScore reads all the levels of the paths of its scores in a
+  single batch (the nodes under the buckets don't exist, and are cached as
+  such).  FindScore reads one level at a time, also like Ranker.
+
+  It supports the same operations as Ranker (SetScores, GetScore, AddScores,
+  RemoveScores, FindRank, FindRanks, FindScore, FindScoreApproximate,
+  TotalRankedScores and CacheStats), and uses the same node cache and
+  "ranker_score" entities.  Only one-dimensional scores are supported.
+
+  A bucket is a "ranker_node" without "child_counts".  Its scores are in the
+  unindexed "scores" property, in increasing order.
+  """
+
+  NODE_CACHE_PREFIX = "ranker_bnode"
+
+  def __init__(self, rootkey, root=None):
+    """Pulls a ranker out of the datastore, given the key of the root node.
+
+    Args:
+      rootkey: The datastore key of the ranker.
+      root: Optional (score_range, branching_factor, bucket_size) of the root,
+        if the caller already has them.  Saves the root lookup.
+    """
+    assert rootkey.kind() == "ranker"
+    root_cache_key = "ranker_bucket_root:%s" % rootkey
+    if root is None:
+      root = memcache.get(root_cache_key)
+    if root is None:
+      entity = datastore.Get(rootkey)
+      root = (entity["score_range"], entity["branching_factor"],
+              entity["bucket_size"])
+      memcache.set(root_cache_key, root)
+    self.rootkey = rootkey
+    self.score_range, self.branching_factor, self.bucket_size = root
+    assert len(self.score_range) == 2
+    assert self.score_range[1] > self.score_range[0]
+    assert self.branching_factor > 1
+    assert 0 < self.bucket_size <= MAX_BUCKET_SIZE
+    self.cache_hits = 0
+    self.cache_misses = 0
+
+  @classmethod
+  def Create(cls, score_range, branching_factor, bucket_size):
+    """Constructs a new BucketRanker and returns it.
+
+    Args:
+      score_range: The range of valid scores, [min, max).
+      branching_factor: The branching factor of the split buckets.
+      bucket_size: The number of scores a bucket holds before it is split.
+
+    Returns:
+      A new BucketRanker.
+    """
+    root = datastore.Entity("ranker")
+    root["score_range"] = score_range
+    root["branching_factor"] = branching_factor
+    root["bucket_size"] = bucket_size
+    datastore.Put(root)
+    return cls(root.key(), (score_range, branching_factor, bucket_size))
+
+  def __WhichChild(self, low, high, score):
+    """Returns the (child, child_low, child_high) of 'score' in [low, high).
+
+    The children divide the range like the ones of Ranker (see
+    Ranker.__WhichChild).
+    """
+    width = high - low
+    child = ((score - low + 1) * self.branching_factor + width - 1) // width - 1
+    return (child, low + child * width // self.branching_factor,
+            low + (child + 1) * width // self.branching_factor)
+
+  def __ChildNodeId(self, node_id, child):
+    """Returns the node id of the child'th child of node_id."""
+    return node_id * self.branching_factor + 1 + child
+
+  def __KeyForScore(self, name):
+    """Returns the key of the ranker_score entity of 'name'."""
+    return datastore_types.Key.from_path("ranker_score", name,
+                                         parent=self.rootkey)
+
+  def __NewBucket(self, node_id, scores):
+    """Returns a new bucket entity holding the sorted list 'scores'."""
+    bucket = datastore.Entity("ranker_node", parent=self.rootkey,
+                              name="node_%x" % node_id,
+                              unindexed_properties=["scores"])
+    if scores:
+      bucket["scores"] = scores
+    return bucket
+
+  def __GetMultipleNodes(self, node_ids):
+    """Gets multiple nodes, using the node cache.  See NodeCache._GetCachedNodes.
+
+    Args:
+      node_ids: A list of node ids we want to get.
+
+    Returns:
+      A dict, indexed by the node ids that were found, of (BUCKET, scores)
+      or (INNER, cumulative counts) tuples.
+    """
+    return self._GetCachedNodes(node_ids, self.__NodeValue)
+
+  def __NodeValue(self, node):
+    """Returns the cached value of a ranker_node entity.  See __GetMultipleNodes.
+    """
+    if "child_counts" in node:
+      return (INNER, node.get("cumulative_counts") or
+              CumulativeCounts(node["child_counts"]))
+    return (BUCKET, list(node.get("scores", [])))
+
+  def __PathNodes(self, scores):
+    """Returns the nodes on the paths of 'scores', down to the leaves.
+
+    Most of the deepest ones don't exist: there are no nodes under a bucket.
+    They are read anyway, so that all the levels are read in a single batch.
+
+    Args:
+      scores: Scores (integers).
+
+    Returns:
+      A dict mapping the node ids to their score range, as (low, high).
+    """
+    nodes = {}
+    for score in scores:
+      node_id = 0
+      low, high = self.score_range
+      while high - low > 1:
+        nodes[node_id] = (low, high)
+        child, low, high = self.__WhichChild(low, high, score)
+        node_id = self.__ChildNodeId(node_id, child)
+    return nodes
+
+  def SetScore(self, name, score):
+    """Sets a single score.  See Ranker.SetScore."""
+    return self.SetScores({name: score})
+
+  def SetScores(self, scores, return_ranks=False):
+    """Changes multiple scores atomically.  See Ranker.SetScores.
+
+    Args:
+      scores: A dict mapping entity names (strings) to scores (integer lists)
+      return_ranks: If True, returns the new ranks of the scores.
+
+    Returns:
+      None, or if return_ranks is True, a dict mapping the names whose score
+      is not None to the 0-based rank of their new score.
+    """
+    ranks = self.__SetScores(scores, return_ranks)
+    self._BumpGeneration()
+    return ranks
+
+  @transactional
+  def __SetScores(self, scores, return_ranks):
+    """Transactional part of SetScores."""
+    score_deltas, score_ents, score_ents_del = self.__ComputeScoreDeltas(scores)
+    new_scores = []
+    if return_ranks:
+      new_scores = [score[0] for score in scores.itervalues() if score]
+    nodes = self.__Update(score_deltas, score_ents, score_ents_del, new_scores)
+    if not return_ranks:
+      return None
+    return dict((name, self.__RankInNodes(score[0], nodes))
+                for (name, score) in scores.iteritems() if score)
+
+  def GetScore(self, name):
+    """Returns the score stored for a name.  See Ranker.GetScore."""
+    score_ent = datastore.Get([self.__KeyForScore(name)])[0]
+    if score_ent:
+      return score_ent["value"]
+    return None
+
+  def __ComputeScoreDeltas(self, scores):
+    """Computes which scores have to be added and removed.
+
+    Like Ranker.__ComputeScoreDeltas, but the scores of 'score_deltas' are
+    integers instead of tuples.
+    """
+    score_keys = [self.__KeyForScore(name) for name in scores]
+    old_scores = {}
+    for old_score in datastore.Get(score_keys):
+      if old_score:
+        old_scores[old_score.key().name()] = old_score
+    score_deltas = {}
+    score_ents = []
+    score_ents_del = []
+    for (score_name, score_value) in scores.iteritems():
+      if score_name in old_scores:
+        score_ent = old_scores[score_name]
+        if score_ent["value"] == score_value:
+          continue  # No change in score => nothing to do
+        old_score = score_ent["value"][0]
+        score_deltas[old_score] = score_deltas.get(old_score, 0) - 1
+      else:
+        score_ent = datastore.Entity("ranker_score", parent=self.rootkey,
+                                     name=score_name)
+      if score_value:
+        assert len(score_value) == 1
+        score_deltas[score_value[0]] = score_deltas.get(score_value[0], 0) + 1
+        score_ent["value"] = score_value
+        score_ents.append(score_ent)
+      elif score_name in old_scores:
+        score_ents_del.append(old_scores[score_name])
+    return (score_deltas, score_ents, score_ents_del)
+
+  def AddScores(self, scores, return_ranks=False):
+    """Adds scores that don't have a name.  See Ranker.AddScores.
+
+    Args:
+      scores: A list of scores (integer lists).
+      return_ranks: If True, returns the new ranks of the scores.
+
+    Returns:
+      None, or if return_ranks is True, a list with the 0-based rank of each
+      score once they are all added.
+    """
+    ranks = self.__ChangeCounts(scores, 1, return_ranks)
+    self._BumpGeneration()
+    return ranks
+
+  def RemoveScores(self, scores):
+    """Removes scores added with AddScores.  See Ranker.RemoveScores."""
+    self.__ChangeCounts(scores, -1, False)
+    self._BumpGeneration()
+
+  @transactional
+  def __ChangeCounts(self, scores, sign, return_ranks):
+    """Transactional part of AddScores and RemoveScores."""
+    score_deltas = {}
+    for score in scores:
+      assert len(score) == 1
+      score_deltas[score[0]] = score_deltas.get(score[0], 0) + sign
+    nodes = self.__Update(score_deltas, [], [])
+    if not return_ranks:
+      return None
+    return [self.__RankInNodes(score[0], nodes) for score in scores]
+
+  def __Update(self, score_deltas, score_entities, score_entities_to_delete,
+               rank_scores=()):
+    """To be run in a transaction.  Applies score deltas to the tree.
+
+    The nodes on the paths of the scores are read in a single Get (see
+    __PathNodes), and created as needed.  The buckets that end up with more than bucket_size
+    scores are split.  Only the nodes that change are written.
+
+    Args:
+      score_deltas: A dict mapping scores (integers) to the number of times
+        they have to be added (or removed, if negative).
+      score_entities: Additional score entities to persist as part of
+        this transaction
+      score_entities_to_delete: Score entities to delete as part of this
+        transaction
+      rank_scores: Scores (integers) whose paths are read too, even if their
+        delta is 0, so that their ranks can be computed with __RankInNodes.
+
+    Returns:
+      A dict mapping the ids of the existing nodes on the paths of the scores
+      to (node, low, high) tuples: the updated node and its score range.
+    """
+    deltas = dict((score, 0) for score in rank_scores)
+    deltas.update(score_deltas)
+    nodes = {}
+    changed = set()
+    path = self.__PathNodes(deltas).keys()
+    stored = dict(zip(path, datastore.Get([self._KeyFromNodeId(node_id)
+                                           for node_id in path])))
+    # The nodes to visit, as node_id -> (low, high, score deltas):
+    pending = {}
+    if deltas:
+      pending[0] = (self.score_range[0], self.score_range[1], deltas)
+    while pending:
+      node_ids = pending.keys()
+      entities = [stored[node_id] for node_id in node_ids]
+      next_pending = {}
+      for (node_id, node) in zip(node_ids, entities):
+        low, high, deltas = pending[node_id]
+        if [delta for delta in deltas.itervalues() if delta != 0]:
+          changed.add(node_id)
+        elif not node:
+          continue  # Only needed for the ranks, and it doesn't exist
+        if not node:
+          node = self.__NewBucket(node_id, [])
+        nodes[node_id] = (node, low, high)
+        if "child_counts" not in node:
+          scores = list(node.get("scores", []))
+          for (score, delta) in deltas.iteritems():
+            assert low <= score < high
+            if delta > 0:
+              i = bisect.bisect_right(scores, score)
+              scores[i:i] = [score] * delta
+            elif delta < 0:
+              i = bisect.bisect_left(scores, score)
+              assert scores[i:i - delta] == [score] * -delta
+              del scores[i:i - delta]
+          if scores:
+            node["scores"] = scores
+          elif "scores" in node:
+            del node["scores"]
+          continue
+        child_counts = node["child_counts"]
+        for (score, delta) in deltas.iteritems():
+          child, child_low, child_high = self.__WhichChild(low, high, score)
+          child_counts[child] += delta
+          assert child_counts[child] >= 0
+          if child_high - child_low > 1:
+            child_id = self.__ChildNodeId(node_id, child)
+            next_pending.setdefault(child_id, (child_low, child_high, {}))
+            next_pending[child_id][2][score] = delta
+        node["cumulative_counts"] = CumulativeCounts(child_counts)
+      pending = next_pending
+
+    for node_id in list(changed):
+      self.__Split(node_id, nodes, changed)
+    datastore.Put([nodes[node_id][0] for node_id in changed] + score_entities)
+    if score_entities_to_delete:
+      datastore.Delete(score_entities_to_delete)
+    return nodes
+
+  def __Split(self, node_id, nodes, changed):
+    """Splits a bucket of 'nodes' if it has more than bucket_size scores.
+
+    The bucket becomes an inner node, and its children with scores become
+    buckets, which are split too if needed.  They are added to 'nodes' and
+    'changed'.
+    """
+    node, low, high = nodes[node_id]
+    scores = node.get("scores", [])
+    if "child_counts" in node or len(scores) <= self.bucket_size:
+      return
+    child_counts = [0] * self.branching_factor
+    children = {}
+    for score in scores:
+      child, child_low, child_high = self.__WhichChild(low, high, score)
+      child_counts[child] += 1
+      if child_high - child_low > 1:
+        children.setdefault(child, (child_low, child_high, []))[2].append(score)
+      # Otherwise the child is a single score: its count is in this node.
+    del node["scores"]
+    node["child_counts"] = child_counts
+    node["cumulative_counts"] = CumulativeCounts(child_counts)
+    for (child, (child_low, child_high, child_scores)) in children.iteritems():
+      child_id = self.__ChildNodeId(node_id, child)
+      # Buckets have no nodes under them, so the child doesn't exist yet.
+      nodes[child_id] = (self.__NewBucket(child_id, child_scores),
+                         child_low, child_high)
+      changed.add(child_id)
+      self.__Split(child_id, nodes, changed)
+
+  def __RankInNodes(self, score, nodes):
+    """Returns the rank of 'score', given the nodes of its path.
+
+    Args:
+      score: An integer.
+      nodes: A dict of node_id -> (node, low, high), as returned by __Update,
+        with every existing node on the path of 'score'.
+    """
+    tot = 0
+    node_id = 0
+    while node_id in nodes:
+      node, low, high = nodes[node_id]
+      if "child_counts" not in node:
+        scores = node.get("scores", [])
+        return tot + len(scores) - bisect.bisect_right(scores, score)
+      child, child_low, child_high = self.__WhichChild(low, high, score)
+      tot += node["cumulative_counts"][self.branching_factor - 1 - child]
+      if child_high - child_low == 1:
+        break
+      node_id = self.__ChildNodeId(node_id, child)
+    return tot
+
+  def FindRank(self, score):
+    """Finds the 0-based rank of a score.  See Ranker.FindRank."""
+    return self.FindRanks([score])[0]
+
+  def FindRanks(self, scores):
+    """Finds the 0-based ranks of a number of scores.  See Ranker.FindRanks.
+
+    The nodes on the paths of the scores are read in a single batch (see
+    __PathNodes), then the tree is walked down to the buckets.
+
+    Args:
+      scores: A list of scores.
+
+    Returns:
+      A list of ranks.
+    """
+    for score in scores:
+      assert len(score) == 1
+    ranks = {}
+    # The nodes to visit, as node_id -> (low, high, dict of the scores under
+    # the node to the number of scores above the node):
+    pending = {}
+    if scores:
+      pending[0] = (self.score_range[0], self.score_range[1],
+                    dict((score[0], 0) for score in scores))
+    last = self.branching_factor - 1
+    nodes = self.__GetMultipleNodes(
+        self.__PathNodes([score[0] for score in scores]).keys())
+    while pending:
+      next_pending = {}
+      for (node_id, (low, high, above)) in pending.iteritems():
+        if node_id not in nodes:
+          # The node doesn't exist, so there are no scores under it.
+          ranks.update(above)
+          continue
+        kind, counts = nodes[node_id]
+        if kind == BUCKET:
+          for (score, tot) in above.iteritems():
+            ranks[score] = tot + len(counts) - bisect.bisect_right(counts, score)
+          continue
+        for (score, tot) in above.iteritems():
+          child, child_low, child_high = self.__WhichChild(low, high, score)
+          tot += counts[last - child]
+          if child_high - child_low > 1:
+            child_id = self.__ChildNodeId(node_id, child)
+            next_pending.setdefault(child_id, (child_low, child_high, {}))
+            next_pending[child_id][2][score] = tot
+          else:
+            ranks[score] = tot
+      pending = next_pending
+    return [ranks[score[0]] for score in scores]
+
+  @transactional
+  def FindScore(self, rank):
+    """Finds the score ranked at 'rank'.  See Ranker.FindScore.
+
+    Args:
+      rank: The rank of the score we wish to find.
+
+    Returns:
+      A tuple, (score, rank_of_tie), or None if there are not enough scores.
+    """
+    node_id = 0
+    low, high = self.score_range
+    discarded = 0
+    while True:
+      node = self.__GetMultipleNodes([node_id]).get(node_id)
+      if node is None:
+        # Only the root can be missing: the ranker is empty.
+        return None
+      kind, counts = node
+      if kind == BUCKET:
+        if rank >= len(counts):
+          return None
+        score = counts[len(counts) - 1 - rank]
+        higher = len(counts) - bisect.bisect_right(counts, score)
+        return ([score], discarded + higher)
+      # The child holding rank 'rank', as in Ranker.__FindScore:
+      k = bisect.bisect_right(counts, rank)
+      if k > self.branching_factor:
+        return None
+      child = self.branching_factor - k
+      discarded += counts[k - 1]
+      rank -= counts[k - 1]
+      width = high - low
+      low, high = (low + child * width // self.branching_factor,
+                   low + (child + 1) * width // self.branching_factor)
+      if high - low == 1:
+        return ([low], discarded)
+      node_id = self.__ChildNodeId(node_id, child)
+
+  def FindScoreApproximate(self, rank):
+    """See Ranker.FindScoreApproximate.
+
+    The exact answer of FindScore satisfies the contract of
+    FindScoreApproximate, so that's what is returned.
+    """
+    return self.FindScore(rank)
+
+  def TotalRankedScores(self):
+    """Returns the total number of ranked scores."""
+    root = self.__GetMultipleNodes([0]).get(0)
+    if root is None:
+      return 0
+    kind, counts = root
+    if kind == BUCKET:
+      return len(counts)
+    return counts[-1]
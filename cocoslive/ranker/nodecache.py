@@ -0,0 +1,190 @@
+#!/usr/bin/python
+#
+# cocos live - (c) 2009 Ricardo Quesada
+# http://www.cocoslive.net
+#
+# License: GNU GPL v3
+# See the LICENSE file
+#
+
+"""The memcache cache of the nodes of a ranker, shared by Ranker and
+BucketRanker.
+"""
+
+import random
+
+from google.appengine.api import datastore
+from google.appengine.api import datastore_types
+from google.appengine.api import memcache
+
+
+# The node cache hits and misses are added to the memcache counters every
+# CACHE_STATS_FLUSH node reads, instead of on every read.
+CACHE_STATS_FLUSH = 100
+# rootkey -> [hits, misses] not added to memcache yet
+_pending_cache_stats = {}
+_pending_cache_reads = [0]
+
+
+def CacheStatsKeys(rootkey):
+  """Returns the memcache keys of the (hits, misses) counters of a ranker."""
+  return ("ranker_hits:%s" % rootkey, "ranker_misses:%s" % rootkey)
+
+
+def RecordCacheStats(rootkey, hits, misses):
+  """Counts node cache hits and misses of a ranker.
+
+  They are kept in the instance, and added to the memcache counters (see
+  CacheStatsKeys) of every ranker with a single offset_multi every
+  CACHE_STATS_FLUSH node reads.
+  """
+  pending = _pending_cache_stats.setdefault(rootkey, [0, 0])
+  pending[0] += hits
+  pending[1] += misses
+  _pending_cache_reads[0] += hits + misses
+  if _pending_cache_reads[0] < CACHE_STATS_FLUSH:
+    return
+  offsets = {}
+  for (key, (key_hits, key_misses)) in _pending_cache_stats.iteritems():
+    hits_key, misses_key = CacheStatsKeys(key)
+    if key_hits:
+      offsets[hits_key] = key_hits
+    if key_misses:
+      offsets[misses_key] = key_misses
+  memcache.offset_multi(offsets, initial_value=0)
+  _pending_cache_stats.clear()
+  _pending_cache_reads[0] = 0
+
+
+class NodeCache(object):
+  """Reads the "ranker_node" entities of a ranker through memcache.
+
+  Every cached node is stamped with the ranker's generation, a per-ranker
+  counter stored in memcache and bumped (see _BumpGeneration) after each
+  successful write.  Bumping the generation makes all previously cached nodes
+  unreachable, so readers never see nodes that are older than the last
+  committed write.  Hits and misses are counted per ranker; see CacheStats.
+
+  Subclasses set self.rootkey, self.cache_hits and self.cache_misses, and
+  NODE_CACHE_PREFIX.
+  """
+
+  # The prefix of the memcache keys of the nodes.  Every subclass caches
+  # different values, so each one has its own.
+  NODE_CACHE_PREFIX = None
+
+  def _KeyFromNodeId(self, node_id):
+    """Creates a (named) key for the node with a given id.
+
+    The key will have the ranker as a parent element to guarantee
+    uniqueness (in the presence of multiple rankers) and to put all
+    nodes in a single entity group.
+
+    Args:
+      node_id: The node's id as an integer.
+
+    Returns:
+      A (named) key for the node with the id 'node_id'.
+    """
+    name = "node_%x" % node_id
+    return datastore_types.Key.from_path("ranker_node", name,
+                                         parent=self.rootkey)
+
+  def _GetCachedNodes(self, node_ids, node_value):
+    """Gets multiple nodes, using the node cache.
+
+    Nodes are looked up in memcache first; only the misses are read from the
+    datastore, and they are stored back in memcache under the current
+    generation.  Nodes that don't exist are cached too, so looking up the rank
+    of an unknown score doesn't hit the datastore either.
+
+    Args:
+      node_ids: A list of node ids we want to get.
+      node_value: A function returning the value to cache for a ranker_node
+        entity.  The value must not be empty.
+
+    Returns:
+      A dict of the values of the nodes that were found, indexed by the node
+      ids found in node_ids.
+    """
+    if len(node_ids) == 0:
+      return {}
+    node_ids = list(set(node_ids))
+    generation = self._CurrentGeneration()
+    cache_keys = dict((self._CacheKeyForNode(node_id, generation), node_id)
+                      for node_id in node_ids)
+    cached = memcache.get_multi(cache_keys.keys())
+    result = {}
+    for (cache_key, value) in cached.iteritems():
+      if value:
+        result[cache_keys[cache_key]] = value
+    missing = [node_id for (cache_key, node_id) in cache_keys.iteritems()
+               if cache_key not in cached]
+    self._RecordCacheStats(len(cached), len(missing))
+    if not missing:
+      return result
+    nodes = datastore.Get([self._KeyFromNodeId(node_id)
+                           for node_id in missing])
+    to_cache = {}
+    for (node_id, node) in zip(missing, nodes):
+      if node:
+        value = node_value(node)
+        result[node_id] = value
+      else:
+        # An empty list marks a node that doesn't exist.
+        value = []
+      to_cache[self._CacheKeyForNode(node_id, generation)] = value
+    memcache.set_multi(to_cache)
+    return result
+
+  def _GenerationKey(self):
+    """Returns the memcache key holding this ranker's generation."""
+    return "ranker_gen:%s" % self.rootkey
+
+  def _CurrentGeneration(self):
+    """Returns the current generation of the node cache.
+
+    If the generation is not in memcache (first use, or evicted) a random one
+    is chosen, so that nodes cached under an older, evicted generation can't
+    become visible again.
+    """
+    key = self._GenerationKey()
+    generation = memcache.get(key)
+    if generation is None:
+      memcache.add(key, random.randint(0, 2 ** 30))
+      generation = memcache.get(key)
+      if generation is None:
+        # memcache is unavailable; use a generation nobody else will use.
+        generation = random.randint(0, 2 ** 30)
+    return generation
+
+  def _BumpGeneration(self):
+    """Invalidates every cached node of this ranker."""
+    if memcache.incr(self._GenerationKey()) is None:
+      memcache.delete(self._GenerationKey())
+
+  def _CacheKeyForNode(self, node_id, generation):
+    """Returns the memcache key of a node for a given generation."""
+    return "%s:%s:%d:%x" % (self.NODE_CACHE_PREFIX, self.rootkey, generation,
+                            node_id)
+
+  def _RecordCacheStats(self, hits, misses):
+    """Adds to the per-ranker hit and miss counters."""
+    self.cache_hits += hits
+    self.cache_misses += misses
+    RecordCacheStats(self.rootkey, hits, misses)
+
+  def CacheStats(self):
+    """Returns the node cache statistics of this ranker.
+
+    The counters live in memcache, so they are shared by all the instances
+    and are reset when memcache is flushed.  Every instance adds its counts
+    every CACHE_STATS_FLUSH node reads, so the most recent ones are missing.
+
+    Returns:
+      A dict with the keys 'hits' and 'misses'.
+    """
+    hits_key, misses_key = CacheStatsKeys(self.rootkey)
+    stats = memcache.get_multi([hits_key, misses_key])
+    return {"hits": stats.get(hits_key, 0),
+            "misses": stats.get(misses_key, 0)}
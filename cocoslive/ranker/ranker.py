@@ -14,13 +14,37 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import bisect
+
 from google.appengine.api import datastore
 from google.appengine.api import datastore_types
+from google.appengine.api import memcache
 
 from common import transactional
+from nodecache import CacheStatsKeys
+from nodecache import NodeCache
+
 
+def CumulativeCounts(child_counts):
+  """Returns the cumulative counts of a node, given its child counts.
 
-class Ranker(object):
+  Args:
+    child_counts: The child_counts list of a node.
+
+  Returns:
+    A non-decreasing list of branching_factor + 1 integers, whose k-th element
+    is the number of scores in the k highest children of the node.  The
+    number of scores above child i is thus element branching_factor - 1 - i.
+  """
+  cumulative = [0]
+  tot = 0
+  for count in reversed(child_counts):
+    tot += count
+    cumulative.append(tot)
+  return cumulative
+
+
+class Ranker(NodeCache):
   """A data structure for storing integer scores and quickly retrieving their
   relative ranks.
 
@@ -110,14 +134,28 @@ class Ranker(object):
   child_node_counts to [0, 1, 0] and node 5's child_node_counts to [1, 0, 0],
   and so forth.
 
+  Nodes also store their "cumulative_counts" (see CumulativeCounts), so the
+  number of scores above a child is a single lookup, and the child holding a
+  given rank is found with a binary search.  Nodes written before that
+  property existed have it derived from child_counts when they are read, and
+  can be rewritten with UpgradeNodes.
+
   Ranker also has a "ranker_score" entity for every score stored in the ranker.
   These entities are part of the same entity group as the ranker_node
   entities. This allows for atomic, idempotent calls to SetScores.
 
+  Scores that are never changed can be stored without a name, with AddScores.
+  Only the child counts of the nodes are updated, so they don't have a
+  "ranker_score" entity, and the calls are not idempotent: they can only be
+  removed with RemoveScores, by value.
+
   Ranker supports the following operations, which can be read about in detail
   in their docstrings:
 
   SetScores(scores): Set scores for multiple players.
+  GetScore(name): Gets the score stored for a player.
+  AddScores(scores): Adds anonymous scores.
+  RemoveScores(scores): Removes anonymous scores.
   FindRank(score): Finds the 0-based rank of the provided score.
   FindScore(rank): Finds the score with the provided 0-based rank.
   FindScoreApproximate(rank): Finds a score >= the score of the provided 0-based
@@ -127,27 +165,47 @@ class Ranker(object):
 
   See __FindNodeIDs for more notes on structure.
 
+  Node cache:
+
+  Reads of 'ranker_node' entities go through memcache (see NodeCache), which
+  holds their cumulative counts.  The generation of the cache is bumped after
+  each successful SetScores, AddScores and RemoveScores.
+
   """
 
-  def __init__(self, rootkey):
+  NODE_CACHE_PREFIX = "ranker_cnode"
+
+  def __init__(self, rootkey, root=None):
     """Pulls a ranker out of the datastore, given the key of the root node.
 
     Args:
       rootkey: The datastore key of the ranker.
+      root: Optional (score_range, branching_factor) of the root, if the
+        caller already has them.  Saves the root lookup.
     """
-    # Get the root from the datastore:
+    # Get the root from memcache or the datastore.  The root never changes
+    # once created, so it can be cached without a generation:
     assert rootkey.kind() == "ranker"
-    root = datastore.Get(rootkey)
+    root_cache_key = "ranker_root:%s" % rootkey
+    if root is None:
+      root = memcache.get(root_cache_key)
+    if root is None:
+      entity = datastore.Get(rootkey)
+      root = (entity["score_range"], entity["branching_factor"])
+      memcache.set(root_cache_key, root)
     # Initialize some class variables:
     self.rootkey = rootkey
-    self.score_range = root["score_range"]
-    self.branching_factor = root["branching_factor"]
+    self.score_range, self.branching_factor = root
     # Sanity checking:
     assert len(self.score_range) > 1
     assert len(self.score_range) % 2 == 0
     for i in xrange(0, len(self.score_range), 2):
       assert self.score_range[i + 1] > self.score_range[i]
     assert self.branching_factor > 1
+    # Node cache statistics for this instance (see CacheStats for the
+    # aggregated, per-ranker numbers):
+    self.cache_hits = 0
+    self.cache_misses = 0
 
   @classmethod
   def Create(cls, score_range, branching_factor):
@@ -221,6 +279,59 @@ class Ranker(object):
         node = self.__ChildNodeId(node, child)
     return nodes
 
+  def __FindNodeGroups(self, scores):
+    """Finds the nodes along the paths from the root to a number of scores.
+
+    Like __FindNodeIDs, but the common prefixes of the paths are walked only
+    once: the scores are sorted, so the scores that go through the same child
+    of a node are contiguous.  The child of a node is computed once per child
+    visited; every other score only costs a comparison per level.
+
+    Args:
+      scores: A sorted list of distinct scores.
+
+    Returns:
+      A list of (node_id, children) tuples, one per node visited.  'children'
+      is a list of (child, start, end) tuples in increasing child order,
+      indicating that the scores in scores[start:end] go through the child'th
+      child of node_id.
+    """
+    branching_factor = self.branching_factor
+    groups = []
+    # The nodes still to visit, as (node_id, score range, start, end):
+    pending = [(0, list(self.score_range), 0, len(scores))]
+    while pending:
+      node, cur_range, start, end = pending.pop()
+      for index in xrange(0, len(cur_range), 2):
+        if cur_range[index + 1] - cur_range[index] > 1:
+          break
+      # Whether the sub-scores after this one still have to be subdivided:
+      subdivided = [i for i in xrange(index + 2, len(cur_range), 2)
+                    if cur_range[i + 1] - cur_range[i] > 1]
+      sub_score = index // 2
+      low, high = cur_range[index], cur_range[index + 1]
+      width = high - low
+      children = []
+      while start < end:
+        # Same as __WhichChild, inlined.
+        want = scores[start][sub_score]
+        child = ((want - low + 1) * branching_factor + width - 1) // width - 1
+        child_low = low + child * width // branching_factor
+        child_high = low + (child + 1) * width // branching_factor
+        stop = start + 1
+        while stop < end and scores[stop][sub_score] < child_high:
+          stop += 1
+        children.append((child, start, stop))
+        if child_high - child_low > 1 or subdivided:
+          child_range = list(cur_range)
+          child_range[index], child_range[index + 1] = child_low, child_high
+          pending.append((self.__ChildNodeId(node, child), child_range,
+                          start, stop))
+        # Otherwise the child is a leaf: its count is stored in this node.
+        start = stop
+      groups.append((node, children))
+    return groups
+
   def __WhichChild(self, low, high, want, branching_factor):
     """Determines which child of the range [low, high) 'want' belongs to.
 
@@ -290,22 +401,29 @@ class Ranker(object):
     return node_id * self.branching_factor + 1 + child
 
   def __GetMultipleNodes(self, node_ids):
-    """Gets multiple nodes from the datastore.
+    """Gets the cumulative counts of multiple nodes, using the node cache.
+
+    See NodeCache._GetCachedNodes.
 
     Args:
       node_ids: A list of node ids we want to get.
 
     Returns:
-      A dict of the nodes that were found, indexed by the node ids found
-      in node_ids.
+      A dict of the cumulative counts (see CumulativeCounts) of the nodes that
+      were found, indexed by the node ids found in node_ids.
     """
-    if len(node_ids) == 0:
-      return []
-    node_ids = set(node_ids)
-    keys = [self.__KeyFromNodeId(node_id) for node_id in node_ids]
-    nodes = datastore.Get(keys)
-    return dict((node_id, node) for (node_id, node) in zip(node_ids, nodes)
-                if node)
+    return self._GetCachedNodes(node_ids, self.__NodeCumulativeCounts)
+
+  def __NodeCumulativeCounts(self, node):
+    """Returns the cumulative counts of a ranker_node entity.
+
+    Nodes written before the "cumulative_counts" property existed have it
+    derived from their child counts.
+    """
+    cumulative = node.get("cumulative_counts")
+    if cumulative is None or len(cumulative) != self.branching_factor + 1:
+      cumulative = CumulativeCounts(node["child_counts"])
+    return cumulative
 
   # Although, this method is currently not needed, we'll keep this
   # since we might need it and some point and it's an interesting
@@ -317,23 +435,6 @@ class Ranker(object):
       return None
     return (node_id - 1) // self.branching_factor
 
-  def __KeyFromNodeId(self, node_id):
-    """Creates a (named) key for the node with a given id.
-
-    The key will have the ranker as a parent element to guarantee
-    uniqueness (in the presence of multiple rankers) and to put all
-    nodes in a single entity group.
-
-    Args:
-      node_id: The node's id as an integer.
-
-    Returns:
-      A (named) key for the node with the id 'node_id'.
-    """
-    name = "node_%x" % node_id
-    return datastore_types.Key.from_path("ranker_node", name,
-                                         parent=self.rootkey)
-
   def __KeyForScore(self, name):
     """Returns a (named) key for a ranker_score entity.
 
@@ -347,7 +448,7 @@ class Ranker(object):
                                          parent=self.rootkey)
 
   def __Increment(self, nodes_with_children, score_entities,
-                  score_entities_to_delete):
+                  score_entities_to_delete, rank_paths=None):
     """Changes child counts for given nodes.
 
     This method will create nodes as needed.
@@ -356,18 +457,35 @@ class Ranker(object):
       nodes_with_children: A dict of (node_key, child) tuples to deltas
       score_entities: Additional score entities to persist as part of
         this transaction
+      score_entities_to_delete: Score entities to delete as part of this
+        transaction
+      rank_paths: Optional dict mapping names to the node ids (paired with
+        children) of their new scores, as returned by __FindNodeIDs.  The
+        nodes on those paths are read in the same Get as the modified ones.
     Returns:
-      None
+      None, or if rank_paths is given, a dict mapping its names to the
+      0-based ranks of their scores once the changes are applied.
     """
-    keys = list(set(key for ((key, _), delta) in nodes_with_children.iteritems()
-                    if delta != 0))
+    changed = set(key for ((key, _), delta) in nodes_with_children.iteritems()
+                  if delta != 0)
+    key_to_id = {}
+    if rank_paths:
+      for node_ids_with_children in rank_paths.itervalues():
+        for (node_id, _) in node_ids_with_children:
+          key_to_id[self._KeyFromNodeId(node_id)] = node_id
+    keys = list(changed.union(key_to_id))
     if not keys:
-      return  # Nothing to do
+      # Nothing to do
+      if rank_paths is None:
+        return None
+      return {}
     nodes = datastore.Get(keys)
 
     node_dict = {}
     for (key, node) in zip(keys, nodes):
       if not node:
+        if key not in changed:
+          continue  # Only needed for the ranks, and it doesn't exist
         node = datastore.Entity("ranker_node", parent=self.rootkey,
                                 name=key.name())
         node["child_counts"] = [0] * self.branching_factor
@@ -377,10 +495,21 @@ class Ranker(object):
         node = node_dict[key]
         node["child_counts"][child] += amount
         assert node["child_counts"][child] >= 0
-    datastore.Put(node_dict.values() + score_entities)
+    for key in changed:
+      node = node_dict[key]
+      node["cumulative_counts"] = CumulativeCounts(node["child_counts"])
+    datastore.Put([node_dict[key] for key in changed] + score_entities)
     if score_entities_to_delete:
       datastore.Delete(score_entities_to_delete)
 
+    if rank_paths is None:
+      return None
+    cumulative = dict((key_to_id[key], self.__NodeCumulativeCounts(node))
+                      for (key, node) in node_dict.iteritems()
+                      if key in key_to_id)
+    return dict((name, self.__FindRank(node_ids_with_children, cumulative))
+                for (name, node_ids_with_children) in rank_paths.iteritems())
+
   def SetScore(self, name, score):
     """Sets a single score.
 
@@ -392,8 +521,7 @@ class Ranker(object):
     """
     return self.SetScores({name: score})
 
-  @transactional
-  def SetScores(self, scores):
+  def SetScores(self, scores, return_ranks=False):
     """Changes multiple scores atomically.
 
     Sets the scores of the named entities in scores to new values. For
@@ -402,12 +530,97 @@ class Ranker(object):
     the score is changed to reflect the new score. If a score is None,
     the named entity's score will be removed from the ranker.
 
+    Once the transaction is committed the node cache is invalidated.
+
+    The nodes modified by the transaction are the nodes on the paths of the
+    new scores, so their ranks can be computed from them at almost no cost,
+    instead of reading the nodes again with FindRanks.
+
     Args:
       scores: A dict mapping entity names (strings) to scores (integer lists)
+      return_ranks: If True, returns the new ranks of the scores.
+
+    Returns:
+      None, or if return_ranks is True, a dict mapping the names whose score
+      is not None to the 0-based rank of their new score.
     """
+    ranks = self.__SetScores(scores, return_ranks)
+    self._BumpGeneration()
+    return ranks
+
+  @transactional
+  def __SetScores(self, scores, return_ranks):
+    """Transactional part of SetScores."""
     score_deltas, score_ents, score_ents_del = self.__ComputeScoreDeltas(scores)
     node_ids_to_deltas = self.__ComputeNodeModifications(score_deltas)
-    self.__Increment(node_ids_to_deltas, score_ents, score_ents_del)
+    rank_paths = None
+    if return_ranks:
+      rank_paths = dict((name, self.__FindNodeIDs(score))
+                        for (name, score) in scores.iteritems() if score)
+    return self.__Increment(node_ids_to_deltas, score_ents, score_ents_del,
+                            rank_paths)
+
+  def AddScores(self, scores, return_ranks=False):
+    """Adds scores that don't have a name.
+
+    Only the child counts of the nodes on the paths of the scores are
+    incremented: no "ranker_score" entity is read or written.  Adding the same
+    score twice ranks it twice.
+
+    Args:
+      scores: A list of scores (integer lists).  Repeated scores are added as
+        many times as they appear.
+      return_ranks: If True, returns the new ranks of the scores.
+
+    Returns:
+      None, or if return_ranks is True, a list with the 0-based rank of each
+      score once they are all added.
+    """
+    ranks = self.__ChangeCounts(scores, 1, return_ranks)
+    self._BumpGeneration()
+    return ranks
+
+  def RemoveScores(self, scores):
+    """Removes scores added with AddScores.
+
+    Args:
+      scores: A list of scores (integer lists).  Repeated scores are removed as
+        many times as they appear.
+    """
+    self.__ChangeCounts(scores, -1, False)
+    self._BumpGeneration()
+
+  @transactional
+  def __ChangeCounts(self, scores, sign, return_ranks):
+    """Transactional part of AddScores and RemoveScores."""
+    score_deltas = {}
+    for score in scores:
+      assert len(score) * 2 == len(self.score_range)
+      score_key = tuple(score)
+      score_deltas[score_key] = score_deltas.get(score_key, 0) + sign
+    node_ids_to_deltas = self.__ComputeNodeModifications(score_deltas)
+    rank_paths = None
+    if return_ranks:
+      rank_paths = dict((score, self.__FindNodeIDs(score))
+                        for score in score_deltas)
+    ranks = self.__Increment(node_ids_to_deltas, [], [], rank_paths)
+    if not return_ranks:
+      return None
+    return [ranks[tuple(score)] for score in scores]
+
+  def GetScore(self, name):
+    """Returns the score stored for a name.
+
+    Args:
+      name: the name of the score as a string
+
+    Returns:
+      The score (an integer list), or None if 'name' has no score.
+    """
+    score_ent = datastore.Get([self.__KeyForScore(name)])[0]
+    if score_ent:
+      return score_ent["value"]
+    return None
 
   def __ComputeScoreDeltas(self, scores):
     """Compute which scores have to be incremented and decremented.
@@ -481,7 +694,7 @@ class Ranker(object):
     nodes_to_deltas = {}
     for score, delta in score_deltas.iteritems():
       for (node_id, child) in self.__FindNodeIDs(score):
-        node = (self.__KeyFromNodeId(node_id), child)
+        node = (self._KeyFromNodeId(node_id), child)
         nodes_to_deltas[node] = nodes_to_deltas.get(node, 0) + delta
     return nodes_to_deltas
 
@@ -491,17 +704,16 @@ class Ranker(object):
     Args:
       node_ids_with_children: A list of node ids down to that score,
         paired with which child links to follow.
-      nodes: A dict mapping node id to node entity.
+      nodes: A dict mapping node id to the node's cumulative counts.
 
     Returns:
       The score's rank.
     """
     tot = 0  # Counts the number of higher scores.
+    last = self.branching_factor - 1
     for (node_id, child) in node_ids_with_children:
       if node_id in nodes:
-        node = nodes[node_id]
-        for i in xrange(child + 1, self.branching_factor):
-          tot += node["child_counts"][i]
+        tot += nodes[node_id][last - child]
       else:
         # If the node isn't in the dict, the node simply doesn't exist.  We
         # are probably finding the rank for a score that doesn't appear in the
@@ -526,6 +738,11 @@ class Ranker(object):
     """Finds the 0-based ranks of a number of particular scores.
     Like FindRank, but more efficient for multiple scores.
 
+    The distinct scores are sorted and the tree is walked once, sharing the
+    common prefixes of their paths (see __FindNodeGroups).  Every distinct node
+    is fetched once, and the number of scores above a child is read from the
+    node's cumulative counts, so each score costs O(1) per level of the tree.
+
     Args:
       scores: A list of scores.
 
@@ -534,19 +751,64 @@ class Ranker(object):
     """
     for score in scores:
       assert len(score) * 2 == len(self.score_range)
-    # Find the nodes we'll need to query to find information about these scores:
-    node_ids_with_children_list = [self.__FindNodeIDs(score)
-                                   for score in scores]
-    node_ids = []
-    for node_ids_with_children in node_ids_with_children_list:
-      node_ids += [node_id for (node_id, _) in node_ids_with_children]
+    if not scores:
+      return []
+    distinct = sorted(set(tuple(score) for score in scores))
+    groups = self.__FindNodeGroups(distinct)
     # Query the needed nodes:
-    nodes_dict = self.__GetMultipleNodes(node_ids)
-    # Call __FindRank, which does the math, for each score:
-    return [self.__FindRank(node_ids_with_children, nodes_dict) for
-            node_ids_with_children in node_ids_with_children_list]
+    nodes_dict = self.__GetMultipleNodes([node_id for (node_id, _) in groups])
+    # Every score in scores[start:end] has the scores in the children after
+    # 'child' above it.  They are added to the whole range at once:
+    deltas = [0] * (len(distinct) + 1)
+    last = self.branching_factor - 1
+    for (node_id, children) in groups:
+      if node_id not in nodes_dict:
+        # The node doesn't exist, so there are no scores under it.
+        continue
+      cumulative = nodes_dict[node_id]
+      for (child, start, end) in children:
+        higher = cumulative[last - child]
+        deltas[start] += higher
+        deltas[end] -= higher
+    ranks = {}
+    tot = 0
+    for (i, score) in enumerate(distinct):
+      tot += deltas[i]
+      ranks[score] = tot
+    return [ranks[tuple(score)] for score in scores]
+
+  def NodeCumulativeCounts(self, node_ids):
+    """Returns the cumulative counts of some nodes, using the node cache.
+
+    Args:
+      node_ids: A list of node ids.
+
+    Returns:
+      A dict mapping the ids of the nodes that exist to their cumulative
+      counts (see CumulativeCounts).
+    """
+    return self.__GetMultipleNodes(node_ids)
 
-  def __FindScore(self, node_id, rank, score_range, approximate):
+  def __CumulativeCountsForFindScore(self, node_id, shards):
+    """Returns the cumulative counts of a node, or None if it doesn't exist.
+
+    If 'shards' is not None, returns the sum of the counts of the node in
+    every ranker of 'shards' instead.
+    """
+    if shards is None:
+      return self.__GetMultipleNodes([node_id]).get(node_id)
+    total = None
+    for shard in shards:
+      cumulative = shard.NodeCumulativeCounts([node_id]).get(node_id)
+      if cumulative is None:
+        continue
+      if total is None:
+        total = list(cumulative)
+      else:
+        total = [a + b for (a, b) in zip(total, cumulative)]
+    return total
+
+  def __FindScore(self, node_id, rank, score_range, approximate, shards=None):
     """To be run in a transaction.  Finds the score ranked 'rank' in the subtree
     defined by node 'nodekey.'
 
@@ -558,42 +820,49 @@ class Ranker(object):
         Derivable from the node's node_id, but included for convenience.
       approximate: Do we have to return an approximate result, or an exact one?
         See the docstrings for FindScore and FindScoreApproximate.
+      shards: Optional list of rankers with the same score range and branching
+        factor.  If given, the counts of their nodes are added up, and the
+        score is found among the scores of all of them (see FindScoreInShards).
 
     Returns:
       A tuple, (score, rank_of_tie), indicating the score's rank within
       node_id's subtree.  The way it indicates rank is defined in the dosctrings
       of FindScore and FindScoreApproximate, depending on the value of
-      'approximate'.
+      'approximate'.  None if there are not enough scores.
     """
     # If we're approximating and thus allowed to do so, early-out if we just
     # need to return the highest available score.
     if approximate and rank == 0:
       return ([score - 1 for score in score_range[1::2]], 0)
     # Find the current node.
-    node = datastore.Get(self.__KeyFromNodeId(node_id))
-    child_counts = node["child_counts"]
-    initial_rank = rank
-    for i in xrange(self.branching_factor - 1, -1, -1):
-      # If this child has enough scores that rank 'rank' is in
-      # there, recurse.
-      if rank - child_counts[i] < 0:
-        child_score_range = self.__ChildScoreRange(score_range, i,
-                                                   self.branching_factor)
-        if self.__IsSingletonRange(child_score_range):
-          # Base case; child_score_range refers to a single score. We don't
-          # store leaf nodes so we can return right here.
-          return (child_score_range[0::2], initial_rank - rank)
-        # Not a base case.  Keep descending into children.
-        ans = self.__FindScore(self.__ChildNodeId(node_id, i), rank,
-                               child_score_range,
-                               approximate)
-        # Note the 'initial_rank - rank': we've asked the child for a score of
-        # some rank among *its* children, so we have to add back in the scores
-        # discarded on the way to that child.
-        return (ans[0], ans[1] + (initial_rank - rank))
-      else:
-        rank -= child_counts[i]
-    return None
+    cumulative = self.__CumulativeCountsForFindScore(node_id, shards)
+    if cumulative is None:
+      # Only the root can be missing: the ranker is empty.
+      return None
+    # The child holding rank 'rank' is the first one, from the highest, whose
+    # cumulative count is greater than 'rank':
+    k = bisect.bisect_right(cumulative, rank)
+    if k > self.branching_factor:
+      return None  # Not enough scores in this subtree.
+    i = self.branching_factor - k
+    # The scores in the children above child i:
+    discarded = cumulative[k - 1]
+    child_score_range = self.__ChildScoreRange(score_range, i,
+                                               self.branching_factor)
+    if self.__IsSingletonRange(child_score_range):
+      # Base case; child_score_range refers to a single score. We don't
+      # store leaf nodes so we can return right here.
+      return (child_score_range[0::2], discarded)
+    # Not a base case.  Keep descending into children.
+    ans = self.__FindScore(self.__ChildNodeId(node_id, i), rank - discarded,
+                           child_score_range,
+                           approximate, shards)
+    if ans is None:
+      # The shards changed while they were being read.
+      return None
+    # We've asked the child for a score of some rank among *its* children, so
+    # we have to add back in the scores discarded on the way to that child.
+    return (ans[0], ans[1] + discarded)
 
   def __IsSingletonRange(self, scorerange):
     """Returns whether a range contains exactly one score."""
@@ -641,15 +910,74 @@ class Ranker(object):
     """
     return self.__FindScore(0, rank, self.score_range, True)
 
+  def FindScoreInShards(self, shards, rank, approximate=False):
+    """Finds the score ranked at 'rank' among the scores of several rankers.
+
+    The rankers must have the same score range and branching factor as this
+    one, so their nodes have the same ids.  The tree is walked once, adding
+    up the counts of each node in every ranker.  It doesn't run in a
+    transaction, since the rankers are different entity groups.
+
+    Args:
+      shards: A list of rankers.
+      rank: The rank of the score we wish to find.
+      approximate: See FindScoreApproximate.
+
+    Returns:
+      A tuple, (score, rank_of_tie), or None if there are not enough scores.
+    """
+    for shard in shards:
+      assert list(shard.score_range) == list(self.score_range)
+      assert shard.branching_factor == self.branching_factor
+    return self.__FindScore(0, rank, self.score_range, approximate, shards)
+
   def TotalRankedScores(self):
     """Returns the total number of ranked scores.
 
     Returns:
       The total number of ranked scores.
     """
-    root = datastore.Get([self.__KeyFromNodeId(0)])[0]
+    root = self.__GetMultipleNodes([0])
     if root:
-      return sum(root["child_counts"])
+      return root[0][-1]
     else:
       # Ranker doesn't have any ranked scores, yet
       return 0
+
+  @transactional
+  def UpgradeNodes(self, after=None, limit=100):
+    """Stores the cumulative counts of the nodes written before they existed.
+
+    Reads don't need it, since the cumulative counts of those nodes are
+    derived from their child counts; it only saves that work.  Runs in a
+    transaction, so it is safe to run while scores are being set.
+
+    Args:
+      after: The key of the last node read by the previous call, or None to
+        start with the first node.
+      limit: The maximum number of nodes to read.
+
+    Returns:
+      A tuple, (upgraded, last_key).  'upgraded' is the number of nodes
+      rewritten, 'last_key' is the key to pass as 'after' in the next call,
+      or None if there are no more nodes.
+    """
+    filters = {}
+    if after is not None:
+      filters["__key__ >"] = after
+    query = datastore.Query("ranker_node", filters)
+    query.Ancestor(self.rootkey)
+    query.Order("__key__")
+    nodes = query.Get(limit)
+    to_put = []
+    for node in nodes:
+      cumulative = node.get("cumulative_counts")
+      if cumulative is None or len(cumulative) != self.branching_factor + 1:
+        node["cumulative_counts"] = CumulativeCounts(node["child_counts"])
+        to_put.append(node)
+    if to_put:
+      datastore.Put(to_put)
+    last_key = None
+    if len(nodes) == limit:
+      last_key = nodes[-1].key()
+    return (len(to_put), last_key)
@@ -0,0 +1,235 @@
+#!/usr/bin/python
+#
+# cocos live - (c) 2009 Ricardo Quesada
+# http://www.cocoslive.net
+#
+# License: GNU GPL v3
+# See the LICENSE file
+#
+
+"""Tests of Ranker.AddScores and Ranker.RemoveScores, and of BucketRanker.
+
+The scores are added and removed once without names, with AddScores and
+RemoveScores, and once with names, with SetScores.  Both rankers must have
+the same ranks.  The BucketRankers are compared with a Ranker holding the same
+scores.  The datastore and memcache are the in-memory stubs of the SDK.
+
+Usage (with the App Engine SDK in the PYTHONPATH):
+  python ranker/ranker_test.py
+"""
+
+import os
+import random
+import unittest
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore_file_stub
+from google.appengine.api.memcache import memcache_stub
+
+from bucket import BUCKET
+from bucket import BucketRanker
+from ranker import Ranker
+from sharded import ShardedRanker
+
+
+SCORE_RANGE = [0, 1000]
+BRANCHING_FACTOR = 10
+# Small, so that most tests split the buckets.
+BUCKET_SIZE = 5
+
+
+class AddScoresTest(unittest.TestCase):
+  """Compares a ranker of anonymous scores with one of named scores."""
+
+  def setUp(self):
+    os.environ["APPLICATION_ID"] = "cocoslive"
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    apiproxy_stub_map.apiproxy.RegisterStub(
+        "datastore_v3",
+        datastore_file_stub.DatastoreFileStub("cocoslive", None, None))
+    apiproxy_stub_map.apiproxy.RegisterStub(
+        "memcache", memcache_stub.MemcacheServiceStub())
+    self.random = random.Random(1)
+    self.names = 0
+
+  def CreateRankers(self):
+    """Returns a new (anonymous, named) pair of rankers."""
+    return (Ranker.Create(SCORE_RANGE, BRANCHING_FACTOR),
+            Ranker.Create(SCORE_RANGE, BRANCHING_FACTOR))
+
+  def RandomScores(self, count, high=SCORE_RANGE[1]):
+    """Returns 'count' random scores.  A small 'high' repeats them."""
+    return [[self.random.randint(SCORE_RANGE[0], high - 1)]
+            for _ in xrange(count)]
+
+  def Name(self, scores):
+    """Returns a dict of new names to scores."""
+    named = {}
+    for score in scores:
+      self.names += 1
+      named["player%d" % self.names] = score
+    return named
+
+  def AssertSameRanks(self, anonymous, named):
+    """Checks that FindRanks, FindScore and TotalRankedScores agree."""
+    total = named.TotalRankedScores()
+    self.assertEqual(total, anonymous.TotalRankedScores())
+    probes = [[score] for score in xrange(SCORE_RANGE[0], SCORE_RANGE[1])]
+    self.assertEqual(named.FindRanks(probes), anonymous.FindRanks(probes))
+    for rank in xrange(total + 2):
+      self.assertEqual(named.FindScore(rank), anonymous.FindScore(rank))
+
+  def testAddScores(self):
+    anonymous, named = self.CreateRankers()
+    scores = self.RandomScores(200)
+    anonymous.AddScores(scores)
+    named.SetScores(self.Name(scores))
+    self.AssertSameRanks(anonymous, named)
+
+  def testReturnedRanks(self):
+    anonymous, named = self.CreateRankers()
+    for score in self.RandomScores(50):
+      names = self.Name([score])
+      named_ranks = named.SetScores(names, return_ranks=True)
+      self.assertEqual(named_ranks.values(),
+                       anonymous.AddScores([score], return_ranks=True))
+    # A batch, with repeated scores:
+    scores = self.RandomScores(50, 20)
+    ranks = anonymous.AddScores(scores, return_ranks=True)
+    named.SetScores(self.Name(scores))
+    self.assertEqual(named.FindRanks(scores), ranks)
+    self.AssertSameRanks(anonymous, named)
+
+  def testDuplicateScores(self):
+    anonymous, named = self.CreateRankers()
+    scores = [[500]] * 30 + self.RandomScores(100, 10) + [[999]] * 5
+    anonymous.AddScores(scores)
+    named.SetScores(self.Name(scores))
+    self.AssertSameRanks(anonymous, named)
+    self.assertEqual(anonymous.FindRank([500]), 5)
+    self.assertEqual(anonymous.FindScore(5), ([500], 5))
+    self.assertEqual(anonymous.FindScore(34), ([500], 5))
+
+  def testRemoveScores(self):
+    anonymous, named = self.CreateRankers()
+    scores = self.RandomScores(100, 50)
+    anonymous.AddScores(scores)
+    names = self.Name(scores)
+    named.SetScores(names)
+    removed = names.keys()[:40]
+    anonymous.RemoveScores([names[name] for name in removed])
+    named.SetScores(dict((name, None) for name in removed))
+    self.AssertSameRanks(anonymous, named)
+
+  def testRemoveAllScores(self):
+    anonymous, named = self.CreateRankers()
+    scores = self.RandomScores(60, 30) + [[0]] * 3
+    anonymous.AddScores(scores)
+    names = self.Name(scores)
+    named.SetScores(names)
+    anonymous.RemoveScores(scores)
+    named.SetScores(dict((name, None) for name in names))
+    self.AssertSameRanks(anonymous, named)
+    self.assertEqual(anonymous.TotalRankedScores(), 0)
+    self.assertEqual(anonymous.FindScore(0), None)
+    # The ranker can be used again:
+    anonymous.AddScores([[7]])
+    self.assertEqual(anonymous.FindScore(0), ([7], 0))
+
+  def testRemoveMissingScore(self):
+    anonymous, named = self.CreateRankers()
+    anonymous.AddScores([[10], [20]])
+    self.assertRaises(AssertionError, anonymous.RemoveScores, [[10], [30]])
+    # Nothing was removed:
+    self.assertEqual(anonymous.TotalRankedScores(), 2)
+    self.assertEqual(anonymous.FindRanks([[10], [20]]), [1, 0])
+
+
+class ShardedAddScoresTest(AddScoresTest):
+  """The same tests, with sharded rankers."""
+
+  def CreateRankers(self):
+    return (ShardedRanker.Create(SCORE_RANGE, BRANCHING_FACTOR, 3),
+            ShardedRanker.Create(SCORE_RANGE, BRANCHING_FACTOR, 3))
+
+  def testEqualScoresSpread(self):
+    anonymous, named = self.CreateRankers()
+    anonymous.AddScores([[0]] * 30)
+    counts = [shard.TotalRankedScores() for shard in anonymous.shards]
+    self.assertEqual(sum(counts), 30)
+    self.assertEqual([count for count in counts if count], counts)
+    anonymous.RemoveScores([[0]] * 25)
+    self.assertEqual(anonymous.TotalRankedScores(), 5)
+    self.assertEqual(anonymous.FindScore(4), ([0], 0))
+
+
+class BucketRankerTest(AddScoresTest):
+  """The same tests, with a BucketRanker instead of the anonymous ranker.
+
+  The named ranker is a Ranker, so every test compares the two.
+  """
+
+  def CreateRankers(self):
+    return (BucketRanker.Create(SCORE_RANGE, BRANCHING_FACTOR, BUCKET_SIZE),
+            Ranker.Create(SCORE_RANGE, BRANCHING_FACTOR))
+
+  def IsBucket(self, ranker, node_id):
+    """Returns whether a node of a BucketRanker is a bucket."""
+    nodes = ranker._BucketRanker__GetMultipleNodes([node_id])
+    return nodes[node_id][0] == BUCKET
+
+  def testSetScores(self):
+    bucket, plain = self.CreateRankers()
+    scores = self.Name(self.RandomScores(100, 50))
+    self.assertEqual(bucket.SetScores(scores, return_ranks=True),
+                     plain.SetScores(scores, return_ranks=True))
+    # Changes and removals:
+    changes = {}
+    for (i, name) in enumerate(sorted(scores)):
+      if i % 3 == 0:
+        changes[name] = self.RandomScores(1)[0]
+      elif i % 5 == 0:
+        changes[name] = None
+    self.assertEqual(bucket.SetScores(changes, return_ranks=True),
+                     plain.SetScores(changes, return_ranks=True))
+    self.AssertSameRanks(bucket, plain)
+    for name in scores:
+      self.assertEqual(bucket.GetScore(name), plain.GetScore(name))
+
+  def testSplitThreshold(self):
+    bucket, plain = self.CreateRankers()
+    scores = [[100 * i] for i in xrange(1, BUCKET_SIZE + 1)]
+    bucket.AddScores(scores)
+    plain.AddScores(scores)
+    self.assertTrue(self.IsBucket(bucket, 0))
+    self.AssertSameRanks(bucket, plain)
+    # One more score splits the root:
+    bucket.AddScores([[999]])
+    plain.AddScores([[999]])
+    self.assertFalse(self.IsBucket(bucket, 0))
+    self.assertTrue(self.IsBucket(bucket, 1 + 9))
+    self.AssertSameRanks(bucket, plain)
+    # The buckets are not merged back:
+    bucket.RemoveScores(scores)
+    plain.RemoveScores(scores)
+    self.assertFalse(self.IsBucket(bucket, 0))
+    self.AssertSameRanks(bucket, plain)
+
+  def testSplitDuplicates(self):
+    # More copies of a score than a bucket holds: the buckets are split down
+    # to the score, whose count is kept by its parent.
+    bucket, plain = self.CreateRankers()
+    scores = [[777]] * (BUCKET_SIZE * 3) + [[776], [778]]
+    bucket.AddScores(scores)
+    plain.AddScores(scores)
+    self.AssertSameRanks(bucket, plain)
+    self.assertEqual(bucket.FindRank([777]), 1)
+    self.assertEqual(bucket.FindScore(1), ([777], 1))
+    self.assertEqual(bucket.FindScore(BUCKET_SIZE * 3 + 1), ([776], 16))
+    bucket.RemoveScores([[777]] * (BUCKET_SIZE * 3 - 1))
+    plain.RemoveScores([[777]] * (BUCKET_SIZE * 3 - 1))
+    self.AssertSameRanks(bucket, plain)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,286 @@
+#!/usr/bin/python
+#
+# cocos live - (c) 2009 Ricardo Quesada
+# http://www.cocoslive.net
+#
+# License: GNU GPL v3
+# See the LICENSE file
+#
+
+"""A Ranker split over several independent trees.
+
+Every Ranker keeps all its entities in a single entity group, so a Ranker
+can't take more than about one SetScores per second.  A ShardedRanker spreads
+the names over N Rankers (each one its own entity group), choosing the shard
+by hashing the name, so writes for different names can run in parallel.
+Scores without a name (see AddScores) go to a random shard, even when they are
+equal.
+Reads have to combine the shards: ranks are the sum of the ranks in every
+shard.
+"""
+
+import hashlib
+import random
+
+from ranker import Ranker
+
+
+class ShardedRanker(object):
+  """A Ranker whose names are spread over several Ranker trees.
+
+  It supports the same operations as Ranker.  A name is always stored in the
+  same shard, so SetScores is still atomic for every single name, but a
+  SetScores call touching names in different shards is not atomic as a whole.
+
+  FindScore walks the trees of all the shards at once, adding up the counts
+  of their nodes.
+  """
+
+  def __init__(self, rootkeys, root=None):
+    """Loads the shards.
+
+    Args:
+      rootkeys: The datastore keys of the Rankers holding the shards.
+      root: Optional (score_range, branching_factor) shared by the shards.
+        See Ranker.__init__.
+    """
+    assert len(rootkeys) > 0
+    self.rootkeys = list(rootkeys)
+    self.shards = [Ranker(rootkey, root) for rootkey in self.rootkeys]
+    self.score_range = self.shards[0].score_range
+    self.branching_factor = self.shards[0].branching_factor
+
+  @classmethod
+  def Create(cls, score_range, branching_factor, num_shards):
+    """Constructs a new ShardedRanker and returns it.
+
+    Args:
+      score_range: The range of valid scores.  See Ranker.Create.
+      branching_factor: The branching factor of every shard.
+      num_shards: The number of Ranker trees.
+
+    Returns:
+      A new ShardedRanker.
+    """
+    rootkeys = [Ranker.Create(score_range, branching_factor).rootkey
+                for _ in xrange(num_shards)]
+    return cls(rootkeys)
+
+  def ShardForName(self, name):
+    """Returns the index of the shard holding 'name'."""
+    if isinstance(name, unicode):
+      name = name.encode("utf-8")
+    return int(hashlib.md5(name).hexdigest()[:8], 16) % len(self.shards)
+
+  def SetScore(self, name, score):
+    """Sets a single score.  See Ranker.SetScore."""
+    return self.SetScores({name: score})
+
+  def SetScores(self, scores, return_ranks=False):
+    """Changes multiple scores.  See Ranker.SetScores.
+
+    Each shard is updated in its own transaction.
+
+    Args:
+      scores: A dict mapping entity names (strings) to scores (integer lists)
+      return_ranks: If True, returns the new ranks of the scores.
+
+    Returns:
+      None, or if return_ranks is True, a dict mapping the names whose score
+      is not None to the 0-based rank of their new score: their rank in
+      their own shard, returned by the update, plus their rank in the
+      other shards.
+    """
+    by_shard = {}
+    for (name, score) in scores.iteritems():
+      by_shard.setdefault(self.ShardForName(name), {})[name] = score
+    ranks = {}
+    for (shard, shard_scores) in by_shard.iteritems():
+      shard_ranks = self.shards[shard].SetScores(shard_scores, return_ranks)
+      if return_ranks:
+        ranks.update(shard_ranks)
+    if not return_ranks:
+      return None
+
+    names = [name for (name, score) in scores.iteritems() if score]
+    for (index, shard) in enumerate(self.shards):
+      others = [name for name in names if self.ShardForName(name) != index]
+      if not others:
+        continue
+      for (name, rank) in zip(others,
+                              shard.FindRanks([scores[n] for n in others])):
+        ranks[name] += rank
+    return ranks
+
+  def ShardForScore(self, score):
+    """Returns the index of a random shard for an anonymous copy of 'score'.
+
+    Equal scores are spread over all the shards, so that a popular score (the
+    minimum, a capped maximum) doesn't make the root of one shard the single
+    point of contention that sharding is meant to remove.  RemoveScores looks
+    for the shards that hold a score.
+    """
+    return random.randrange(len(self.shards))
+
+  def AddScores(self, scores, return_ranks=False):
+    """Adds scores that don't have a name.  See Ranker.AddScores.
+
+    Each score goes to a random shard (see ShardForScore), and each shard is
+    updated in its own transaction.
+
+    Args:
+      scores: A list of scores (integer lists).
+      return_ranks: If True, returns the new ranks of the scores.
+
+    Returns:
+      None, or if return_ranks is True, a list with the 0-based rank of each
+      score: its rank in its own shard, returned by the update, plus its rank
+      in the other shards.
+    """
+    score_shards = [self.ShardForScore(score) for score in scores]
+    by_shard = {}
+    for (i, shard) in enumerate(score_shards):
+      by_shard.setdefault(shard, []).append(i)
+    ranks = [0] * len(scores)
+    for (shard, indexes) in by_shard.iteritems():
+      shard_ranks = self.shards[shard].AddScores(
+          [scores[i] for i in indexes], return_ranks)
+      if return_ranks:
+        for (i, rank) in zip(indexes, shard_ranks):
+          ranks[i] = rank
+    if not return_ranks:
+      return None
+
+    for (index, shard) in enumerate(self.shards):
+      others = [i for i in xrange(len(scores)) if score_shards[i] != index]
+      if not others:
+        continue
+      for (i, rank) in zip(others,
+                           shard.FindRanks([scores[i] for i in others])):
+        ranks[i] += rank
+    return ranks
+
+  def RemoveScores(self, scores):
+    """Removes scores added with AddScores.  See Ranker.RemoveScores.
+
+    The copies of a score can be in any shard, so the number of copies in
+    every shard is counted first (see __CountCopies), and each copy is
+    removed from a shard that holds one.  Each shard is updated in its own
+    transaction.
+
+    Raises:
+      AssertionError if the shards don't hold enough copies of a score.
+      Nothing is removed then.
+    """
+    wanted = {}
+    for score in scores:
+      wanted[tuple(score)] = wanted.get(tuple(score), 0) + 1
+    values = wanted.keys()
+    by_shard = {}
+    for (index, shard) in enumerate(self.shards):
+      for (value, copies) in zip(values, self.__CountCopies(shard, values)):
+        copies = min(copies, wanted[value])
+        if copies:
+          by_shard.setdefault(index, []).extend([list(value)] * copies)
+          wanted[value] -= copies
+    assert not [copies for copies in wanted.itervalues() if copies], (
+        "RemoveScores of scores that are not in the ranker")
+    for (shard, shard_scores) in by_shard.iteritems():
+      self.shards[shard].RemoveScores(shard_scores)
+
+  def __CountCopies(self, shard, values):
+    """Returns how many times each of 'values' is in 'shard'.
+
+    The copies of a score are the scores ranked above the next lower score,
+    but not above the score itself.
+
+    Args:
+      shard: A Ranker.
+      values: A list of score tuples.
+
+    Returns:
+      A list with the number of copies of each value.
+    """
+    lower = [self.__NextLowerScore(value) for value in values]
+    probes = [list(value) for value in values]
+    probes.extend([score for score in lower if score is not None])
+    ranks = shard.FindRanks(probes)
+    lower_ranks = iter(ranks[len(values):])
+    total = None
+    copies = []
+    for (i, score) in enumerate(lower):
+      if score is not None:
+        lower_rank = lower_ranks.next()
+      else:
+        # The lowest possible score: every score is ranked above the next one.
+        if total is None:
+          total = shard.TotalRankedScores()
+        lower_rank = total
+      copies.append(lower_rank - ranks[i])
+    return copies
+
+  def __NextLowerScore(self, value):
+    """Returns the highest score lower than 'value', or None if none is."""
+    score = list(value)
+    for i in reversed(xrange(len(score))):
+      if score[i] > self.score_range[2 * i]:
+        score[i] -= 1
+        return score
+      score[i] = self.score_range[2 * i + 1] - 1
+    return None
+
+  def GetScore(self, name):
+    """Returns the score stored for a name.  See Ranker.GetScore."""
+    return self.shards[self.ShardForName(name)].GetScore(name)
+
+  def FindRank(self, score):
+    """Finds the 0-based rank of a score.  See Ranker.FindRank."""
+    return self.FindRanks([score])[0]
+
+  def FindRanks(self, scores):
+    """Finds the 0-based ranks of a number of scores.  See Ranker.FindRanks.
+
+    Args:
+      scores: A list of scores.
+
+    Returns:
+      A list of ranks: the sum of the ranks in every shard.
+    """
+    ranks = [0] * len(scores)
+    for shard in self.shards:
+      for (i, rank) in enumerate(shard.FindRanks(scores)):
+        ranks[i] += rank
+    return ranks
+
+  def FindScore(self, rank):
+    """Finds the score ranked at 'rank'.  See Ranker.FindScore.
+
+    All the shards have the same score range and branching factor, so their
+    nodes have the same ids: the tree is walked once, adding up the counts of
+    each node in every shard (see Ranker.FindScoreInShards).
+
+    Args:
+      rank: The rank of the score we wish to find.
+
+    Returns:
+      A tuple, (score, rank_of_tie), or None if there are not enough scores.
+    """
+    return self.shards[0].FindScoreInShards(self.shards, rank)
+
+  def FindScoreApproximate(self, rank):
+    """Finds a score that >= the score ranked at 'rank'.
+    See Ranker.FindScoreApproximate."""
+    return self.shards[0].FindScoreInShards(self.shards, rank, True)
+
+  def TotalRankedScores(self):
+    """Returns the total number of ranked scores in all the shards."""
+    return sum(shard.TotalRankedScores() for shard in self.shards)
+
+  def CacheStats(self):
+    """Returns the node cache statistics of all the shards, added up."""
+    stats = {"hits": 0, "misses": 0}
+    for shard in self.shards:
+      shard_stats = shard.CacheStats()
+      stats["hits"] += shard_stats["hits"]
+      stats["misses"] += shard_stats["misses"]
+    return stats
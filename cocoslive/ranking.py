@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+#
+# cocos live - (c) 2009 Ricardo Quesada
+# http://www.cocoslive.net
+#
+# License: GNU GPL v3
+# See the LICENSE file
+#
+__docformat__ = 'restructuredtext'
+
+#
+# Rankers of a game
+#
+# Every category of a ranked game has a 'Ranking' entity (key name: category,
+# parent: game) that points to the root of its ranker tree.
+# Games with more than 1 ranking shard have a list of ranker roots in the
+# 'shards' property. 'ranker' always points to the first shard.
+# Games with 'ranking_bucket_size' use bucket rankers (see ranker/bucket.py),
+# which only split their nodes once they have more than bucket_size scores.
+# Their Ranking entity has a 'bucket_size' property. They are not sharded.
+# The rankers of the leaderboard windows (see windows.py) have an 'expires'
+# property, and they are deleted by delete_ranking() once expired.
+#
+# Games with 'ranking_countries' also have a ranker per category and country
+# (key name: '<category>#<country code>') for the first ranking_countries
+# countries of each category.
+#
+# Update-score games rank their players: the name of a player in the rankers is
+# '<playername>@<device id>'. Post-score games never change a score, so their
+# scores are added to the rankers without a name (see Ranker.AddScores).
+#
+
+# GAE imports
+from google.appengine.api import datastore
+from google.appengine.api import datastore_errors
+from google.appengine.api import datastore_types
+
+# local imports
+from ranker import ranker
+from ranker import sharded
+from ranker import bucket
+
+__all__ = ['get_ranker', 'get_or_create_ranker', 'get_rankings', 'open_ranker_from_config', 'rootkeys',
+    'delete_ranking', 'country_ranking_name']
+
+
+def country_ranking_name( category, country_code ):
+    '''name of the Ranking of a category in a country'''
+    return '%s#%s' % ( category, country_code )
+
+def ranking_key( game_key, category ):
+    '''returns the key of the Ranking entity of a category'''
+    return datastore_types.Key.from_path("Ranking", category, parent=game_key )
+
+def open_ranker( ranking ):
+    '''returns the ranker (sharded or not) referenced by a Ranking entity'''
+    shards = ranking.get('shards')
+    if shards:
+        return sharded.ShardedRanker( shards )
+    if ranking.get('bucket_size'):
+        return bucket.BucketRanker( ranking['ranker'] )
+    return ranker.Ranker( ranking['ranker'] )
+
+def rootkeys( ranking ):
+    '''returns the keys of the ranker roots (1 per shard) of a Ranking entity'''
+    shards = ranking.get('shards')
+    if shards:
+        return list( shards )
+    return [ ranking['ranker'] ]
+
+def get_rankings( game_key ):
+    '''returns a dict category -> (rootkeys, score_range, branching_factor, bucket_size) with
+    the rankers of every category of a game. bucket_size is None for the fixed depth rankers.
+    Uses 2 datastore calls'''
+    entities = datastore.Query( 'Ranking' ).Ancestor( game_key ).Get( 1000 )
+    if not entities:
+        return {}
+    # all the shards of a ranker have the same range and branching factor
+    roots = datastore.Get( [ rootkeys( e )[0] for e in entities ] )
+    rankings = {}
+    for (entity, root) in zip( entities, roots ):
+        if root is None:
+            continue
+        rankings[ entity.key().name() ] = ( rootkeys( entity ), list( root['score_range'] ), root['branching_factor'], entity.get('bucket_size') )
+    return rankings
+
+def open_ranker_from_config( rootkeys, score_range, branching_factor, bucket_size=None ):
+    '''returns the ranker of the roots returned by get_rankings(), without datastore or memcache calls'''
+    root = ( score_range, branching_factor )
+    if len( rootkeys ) > 1:
+        return sharded.ShardedRanker( rootkeys, root )
+    if bucket_size:
+        return bucket.BucketRanker( rootkeys[0], root + ( bucket_size, ) )
+    return ranker.Ranker( rootkeys[0], root )
+
+def _get_ranking( key, prefetcher ):
+    if prefetcher is None:
+        return datastore.Get( key )
+    entity = prefetcher.get( key )
+    if entity is None:
+        raise datastore_errors.EntityNotFoundError()
+    return entity
+
+def get_ranker( game_key, category, prefetcher=None ):
+    '''returns the ranker of a category. Raises EntityNotFoundError if it doesn't exist.
+    prefetcher: a Prefetcher used to get the Ranking entity'''
+    return open_ranker( _get_ranking( ranking_key( game_key, category ), prefetcher ) )
+
+def get_or_create_ranker( game, category, prefetcher=None, expires=None ):
+    '''returns the ranker of a category, creating it if it doesn't exist.
+    The number of shards (or the bucket size) is taken from game.ranking_shards
+    (game.ranking_bucket_size), and it can't be changed once the ranker was created.
+    expires: datetime after which a new ranker can be deleted.
+    Concurrent requests can create the same ranker: the Ranking entity is
+    inserted in a transaction, and the requests that lose delete the roots
+    they created and use the winner's ranker'''
+    key = ranking_key( game.key(), category )
+    try:
+        return open_ranker( _get_ranking( key, prefetcher ) )
+    except datastore_errors.EntityNotFoundError:
+        score_range = [game.ranking_min_score, game.ranking_max_score]
+        app = datastore.Entity("Ranking", name=category, parent=game.key() )
+        if game.ranking_shards > 1:
+            r = sharded.ShardedRanker.Create( score_range, game.ranking_branch_factor, game.ranking_shards )
+            app["ranker"] = r.rootkeys[0]
+            app["shards"] = r.rootkeys
+        elif game.ranking_bucket_size:
+            r = bucket.BucketRanker.Create( score_range, game.ranking_branch_factor, game.ranking_bucket_size )
+            app["ranker"] = r.rootkey
+            app["bucket_size"] = game.ranking_bucket_size
+        else:
+            r = ranker.Ranker.Create( score_range, game.ranking_branch_factor )
+            app["ranker"] = r.rootkey
+        if expires is not None:
+            app["expires"] = expires
+
+        existing = datastore.RunInTransaction( _insert_ranking, app )
+        if existing is not None:
+            # nothing was written under the new roots yet
+            datastore.Delete( rootkeys( app ) )
+            return open_ranker( existing )
+        return r
+
+def _insert_ranking( ranking ):
+    '''runs in a transaction. Puts the Ranking entity if it doesn't exist yet.
+    Returns the existing one, or None if ranking was put'''
+    try:
+        return datastore.Get( ranking.key() )
+    except datastore_errors.EntityNotFoundError:
+        datastore.Put( ranking )
+        return None
+
+def delete_ranking( ranking, limit=500 ):
+    '''deletes up to 'limit' entities of the ranker trees of a Ranking entity.
+    Once the trees are empty, deletes their roots and the Ranking entity.
+    Returns True if everything was deleted'''
+    for rootkey in rootkeys( ranking ):
+        for kind in ( 'ranker_node', 'ranker_score' ):
+            query = datastore.Query( kind, keys_only=True )
+            query.Ancestor( rootkey )
+            keys = query.Get( limit )
+            if keys:
+                datastore.Delete( keys )
+                return False
+    datastore.Delete( rootkeys( ranking ) + [ ranking.key() ] )
+    return True
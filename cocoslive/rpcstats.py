@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#
+# cocos live - (c) 2009 Ricardo Quesada
+# http://www.cocoslive.net
+#
+# License: GNU GPL v3
+# See the LICENSE file
+#
+__docformat__ = 'restructuredtext'
+
+#
+# RPC counter
+#
+# Counts the API calls (datastore, memcache, urlfetch...) made by a request
+# with an apiproxy pre-call hook, and logs them when the request ends.
+#
+# usage:
+#   @rpcstats.logged('update-score')
+#   def post(self):
+#       ...
+#
+
+# python imports
+import logging
+import functools
+
+# GAE imports
+from google.appengine.api import apiproxy_stub_map
+
+__all__ = ['install', 'reset', 'get_counts', 'logged']
+
+# 'service.call' -> number of calls in the current request
+_counts = {}
+_installed = False
+
+
+def _hook( service, call, request, response ):
+    key = '%s.%s' % (service, call)
+    _counts[ key ] = _counts.get( key, 0 ) + 1
+
+
+def install():
+    '''registers the hook. Only once per instance'''
+    global _installed
+    if not _installed:
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append( 'rpcstats', _hook )
+        _installed = True
+
+
+def reset():
+    _counts.clear()
+
+
+def get_counts():
+    '''returns a dict 'service.call' -> number of calls since the last reset()'''
+    return dict( _counts )
+
+
+def logged( name ):
+    '''decorator that logs the number of RPCs of a request handler method'''
+    def decorator( func ):
+        @functools.wraps( func )
+        def wrapper( self, *args, **kwds ):
+            install()
+            reset()
+            try:
+                return func( self, *args, **kwds )
+            finally:
+                counts = get_counts()
+                details = ', '.join( [ '%s=%d' % (k, counts[k]) for k in sorted( counts ) ] )
+                logging.info( '%s: %d RPCs (%s)' % (name, sum( counts.values() ), details) )
+        return wrapper
+    return decorator
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#
+# cocos live - (c) 2009 Ricardo Quesada
+# http://www.cocoslive.net
+#
+# License: GNU GPL v3
+# See the LICENSE file
+#
+__docformat__ = 'restructuredtext'
+
+#
+# Score fields of a game
+#
+# The ScoreField rows of a game are loaded once and kept in memcache and
+# in a per-instance LRU cache. Call invalidate_schema() whenever a ScoreField
+# of the game is created, modified or deleted.
+#
+
+# GAE imports
+from google.appengine.api import memcache
+
+# local imports
+from model import ScoreField
+from cache import LRUCache
+from serializer import ScoreSerializer
+import pagecache
+
+__all__ = ['get_schema', 'invalidate_schema']
+
+# per instance cache. Other instances may see a modified schema up to
+# LOCAL_TTL seconds late
+LOCAL_TTL = 60
+_local_cache = LRUCache( 200, LOCAL_TTL )
+
+def _identity( value ):
+    return value
+
+# field type -> cast function. Strings are not casted
+CASTERS = {
+    'int' : int,
+    'float' : float,
+}
+
+
+class FieldSchema(object):
+    '''The score fields of a game, with their cast functions'''
+
+    def __init__(self, fields):
+        '''fields: list of (name, type, send, displayweb) tuples'''
+        self.fields = tuple(fields)
+        self.types = dict( (name, type) for (name, type, send, displayweb) in fields )
+        self.casters = dict( (name, CASTERS.get(type, _identity)) for (name, type, send, displayweb) in fields )
+
+        #: names of the fields that are sent back to the clients
+        self.send = [ name for (name, type, send, displayweb) in fields if send ]
+
+        # compiled serializers, by 'missing' value
+        self.serializers = {}
+
+    def cast(self, key, value):
+        '''cast a value to the type of the field 'key'. Raises KeyError if the field doesn't exist'''
+        return self.casters[key]( value )
+
+    def serializer(self, missing=''):
+        '''returns the ScoreSerializer of the 'send' fields.
+        missing: value used for the fields that a score doesn't have'''
+        serializer = self.serializers.get( missing )
+        if serializer is None:
+            serializer = ScoreSerializer( self.send, missing )
+            self.serializers[ missing ] = serializer
+        return serializer
+
+
+def _cache_key( game ):
+    return 'schema:%s' % game.key()
+
+def get_schema( game ):
+    '''returns the FieldSchema of a game'''
+    key = _cache_key( game )
+    schema = _local_cache.get( key )
+    if schema is not None:
+        return schema
+
+    fields = memcache.get( key )
+    if fields is None:
+        query = ScoreField.all().ancestor( game.key() )
+        fields = [ (f.name, f.type, f.send, f.displayweb) for f in query.fetch(1000) ]
+        memcache.set( key, fields )
+
+    schema = FieldSchema( fields )
+    _local_cache.set( key, schema )
+    return schema
+
+def invalidate_schema( game ):
+    '''forgets the cached schema of a game, and the pages rendered with it'''
+    key = _cache_key( game )
+    memcache.delete( key )
+    _local_cache.delete( key )
+    pagecache.invalidate_game( game.key() )
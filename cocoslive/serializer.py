@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#
+# cocos live - (c) 2009 Ricardo Quesada
+# http://www.cocoslive.net
+#
+# License: GNU GPL v3
+# See the LICENSE file
+#
+__docformat__ = 'restructuredtext'
+
+#
+# Score serializer
+#
+# Converts a page of Score entities directly into the JSON text sent by
+# get-scores, without building a dictionary per entity.
+# The output is the same as json.dumps( {'scores' : [ {field: value, ..., 'position': n}, ... ]} )
+#
+
+# python imports
+import types
+
+# 3rd partly libs
+import simplejson as json
+from simplejson.encoder import encode_basestring_ascii, FLOAT_REPR, INFINITY
+
+__all__ = ['ScoreSerializer']
+
+def _encode_bool( value ):
+    if value:
+        return 'true'
+    return 'false'
+
+def _encode_none( value ):
+    return 'null'
+
+def _encode_float( value ):
+    if value != value or value == INFINITY or value == -INFINITY:
+        # NaN, Infinity, -Infinity
+        return json.dumps( value )
+    return FLOAT_REPR( value )
+
+# exact type -> encoder. Other types (dates...) use the JSONEncoder
+_ENCODERS = {
+    types.StringType : encode_basestring_ascii,
+    types.UnicodeType : encode_basestring_ascii,
+    types.IntType : str,
+    types.LongType : str,
+    types.FloatType : _encode_float,
+    types.BooleanType : _encode_bool,
+    types.NoneType : _encode_none,
+}
+
+# marks a field that the entity doesn't have
+_MISSING = object()
+
+
+class ScoreSerializer(object):
+    '''Compiled serializer for the 'send' fields of a game'''
+
+    def __init__(self, fields, missing=''):
+        '''fields: names of the fields to serialize
+        missing: value of the fields that an entity doesn't have'''
+        self.encoder = json.JSONEncoder()
+        self.fields = list(fields)
+        # '"name": ' prefixes are encoded once
+        self.prefixes = [ '%s: ' % encode_basestring_ascii(name) for name in self.fields ]
+        self.missing = self.encode_value( missing )
+
+    def encode_value(self, value):
+        '''encodes a single value'''
+        encoder = _ENCODERS.get( type(value) )
+        if encoder is not None:
+            return encoder( value )
+        return self.encoder.encode( value )
+
+    def encode_row(self, entity, position):
+        '''encodes an entity as a JSON object, adding its position'''
+        parts = []
+        for (name, prefix) in zip( self.fields, self.prefixes ):
+            value = getattr( entity, name, _MISSING )
+            if value is _MISSING:
+                parts.append( prefix + self.missing )
+            else:
+                parts.append( prefix + self.encode_value( value ) )
+        parts.append( '"position": %d' % position )
+        return '{%s}' % ', '.join( parts )
+
+    def dumps(self, entities, positions, extra=None):
+        '''returns the JSON text of a page of scores.
+        positions: the position of each entity
+        extra: optional dictionary of values added after 'scores' (eg: next_cursor)'''
+        rows = [ self.encode_row( e, p ) for (e, p) in zip( entities, positions ) ]
+        parts = [ '"scores": [%s]' % ', '.join( rows ) ]
+        if extra:
+            keys = extra.keys()
+            keys.sort()
+            for key in keys:
+                parts.append( '%s: %s' % ( encode_basestring_ascii(key), self.encode_value( extra[key] ) ) )
+        return '{%s}' % ', '.join( parts )
+
+    def dumps_jsonp(self, callback, entities, positions, extra=None):
+        '''like dumps, but wrapped in a JSONP callback'''
+        return '%s(%s)' % ( callback, self.dumps( entities, positions, extra ) )
+
+
+#
+# Microbenchmark: python serializer.py
+# Compares the compiled serializer with the dict + json.dumps version
+#
+if __name__ == '__main__':
+    import timeit
+
+    class FakeScore(object):
+        pass
+
+    def make_scores( n ):
+        scores = []
+        for i in xrange(n):
+            s = FakeScore()
+            s.cc_score = 1000000 - i
+            s.cc_playername = u'player %d' % i
+            s.cc_country = 'ar'
+            s.usr_speed = 1.5 * i
+            s.usr_level = i % 10
+            scores.append( s )
+        return scores
+
+    fields = ['cc_score', 'cc_playername', 'cc_country', 'usr_speed', 'usr_level', 'usr_missing']
+    serializer = ScoreSerializer( fields )
+
+    def with_dicts( scores, positions ):
+        l = []
+        for (e, p) in zip( scores, positions ):
+            d = {}
+            for key in fields:
+                d[key] = getattr( e, key, '' )
+            d['position'] = p
+            l.append( d )
+        return json.dumps( {'scores' : l} )
+
+    for rows in (25, 50, 100):
+        scores = make_scores( rows )
+        positions = range( 1, rows + 1 )
+        assert json.loads( with_dicts( scores, positions ) ) == json.loads( serializer.dumps( scores, positions ) )
+        number = 2000
+        t_dicts = timeit.Timer( lambda: with_dicts( scores, positions ) ).timeit( number )
+        t_compiled = timeit.Timer( lambda: serializer.dumps( scores, positions ) ).timeit( number )
+        print '%3d rows: dict + json.dumps %.2f us/row, compiled %.2f us/row' % ( rows,
+            t_dicts * 1e6 / (number * rows), t_compiled * 1e6 / (number * rows) )
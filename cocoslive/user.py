@@ -39,11 +39,18 @@ from google.appengine.api import images
 import simplejson as json
 
 # local imports
-from model import Developer, Game, Score, ScoreField, Category, ScoresCountry
+from model import Developer, Game, Score, ScoreField, Category, ScoresCountry, PendingScore
 from util import *
+from schema import invalidate_schema
+from gameconfig import invalidate_config
+import pagecache
+from paging import fetch_page
 import configuration
-from ranker import ranker
+import ranking
+import counter
+import windows
 from ranker.common import transactional
+from ranker import bucket
 
 def owner_of_game_required(func):
     """Ensure that the logged in user is the owner of the game."""
@@ -172,19 +179,10 @@ class BaseHandler( webapp.RequestHandler):
             pass
 
     def get_ranker( self, game_key, category ):
-        key = datastore_types.Key.from_path("Ranking", category, parent=game_key )
-        return ranker.Ranker(datastore.Get(key)["ranker"])
+        return ranking.get_ranker( game_key, category )
 
     def get_or_create_ranker( self, game_key, category ):
-        key = datastore_types.Key.from_path("Ranking", category, parent=game_key )
-        try:
-            return ranker.Ranker(datastore.Get(key)["ranker"])
-        except datastore_errors.EntityNotFoundError:
-            r = ranker.Ranker.Create([self.game.ranking_min_score, self.game.ranking_max_score], self.game.ranking_branch_factor)
-            app = datastore.Entity("Ranking", name=category, parent=game_key )
-            app["ranker"] = r.rootkey
-            datastore.Put(app)
-            return r
+        return ranking.get_or_create_ranker( self.game, category )
 #
 # '/create-user' handler
 #
@@ -206,7 +204,8 @@ class ListGames(BaseHandler):
 
         user = users.get_current_user()
         dev = Developer.get_by_key_name( user.email() )
-        games = dev.games.order('creationdate')
+        games = dev.games.order('creationdate').fetch(1000)
+        counter.prefetch_total_scores( games )
 
         params = {
             'games' : games,
@@ -494,12 +493,19 @@ class EditGame(BaseHandler):
             self.update_displayweb( game )
         elif type == 'use_new_playername':
             self.use_new_playername( game )
+        elif type == 'buffered_updates':
+            self.buffered_updates( game )
+        elif type == 'windowed_leaderboards':
+            self.windowed_leaderboards( game )
         elif type == 'enable_ranking':
             self.enable_ranking( game )
         else:
             logging.error('Type not found')
             self.error(404)
 
+        # the api handlers use a cached copy of the game
+        invalidate_config( gamename )
+
         self.redirect('/user/edit-game?gamename=%s' % gamename )
 
     # enable ranking
@@ -507,7 +513,7 @@ class EditGame(BaseHandler):
         if game.ranking_enabled:
             raise Exception("Ranking is already enabled")
 
-        if game.nro_scores != 0:
+        if game.total_scores() != 0:
             raise Exception("Delete all the game scores to enable rankings")
 
         if game.scoreorder != 'desc':
@@ -520,6 +526,29 @@ class EditGame(BaseHandler):
         min = int(min)
         max = int(max)
 
+        shards = self.request.get('rank_shards')
+        if shards:
+            shards = int(shards)
+            if shards < 1:
+                raise Exception("The number of ranking shards must be at least 1")
+            game.ranking_shards = shards
+
+        countries = self.request.get('rank_countries')
+        if countries:
+            countries = int(countries)
+            if countries < 0:
+                raise Exception("The number of country rankers can't be negative")
+            game.ranking_countries = countries
+
+        bucket_size = self.request.get('rank_bucket_size')
+        if bucket_size:
+            bucket_size = int(bucket_size)
+            if not 0 <= bucket_size <= bucket.MAX_BUCKET_SIZE:
+                raise Exception("The bucket size must be between 0 and %d" % bucket.MAX_BUCKET_SIZE)
+            if bucket_size and game.ranking_shards > 1:
+                raise Exception("Rankings with buckets can't be sharded")
+            game.ranking_bucket_size = bucket_size
+
         game.ranking_min_score = min
         game.ranking_max_score = max
         game.ranking_enabled = enabled
@@ -538,6 +567,20 @@ class EditGame(BaseHandler):
         if not field:
             field = ScoreField( key_name='cc_playername', name='cc_playername', type='string', admin=True, send=True, displayweb=True, parent=game, game=game)
             field.put()
+            invalidate_schema( game )
+
+    # queue (or don't queue) the score updates
+    def buffered_updates(self, game ):
+        buffered = self.request.get('buffered_updates')
+        game.buffered_updates = ( buffered == 'True' )
+        game.put()
+
+    # keep (or don't keep) the day, week and month leaderboards
+    def windowed_leaderboards(self, game ):
+        windowed = self.request.get('windowed_leaderboards')
+        game.windowed_leaderboards = ( windowed == 'True' )
+        game.put()
+        pagecache.invalidate_game( game.key() )
 
     # New category
     def new_category( self, game ):
@@ -599,6 +642,7 @@ class EditGame(BaseHandler):
         field = game.score_fields.filter('name =', fieldname).fetch(1)[0]
         field.displayweb = displayweb
         field.put()
+        invalidate_schema( game )
         self.redirect('/user/edit-game?gamename=%s' % game.name)
 
 
@@ -663,6 +707,7 @@ class EditGame(BaseHandler):
 
         field = ScoreField( key_name=fieldname, name=fieldname, type=fieldtype, admin=False, send=sendback, displayweb=displayweb, parent=game, game=game)
         field.put()
+        invalidate_schema( game )
 
 
 #
@@ -681,9 +726,18 @@ class DeleteGame(BaseHandler):
         for s in game.scores:
             s.delete()
 
+        # Delete scores that were not written yet
+        for p in game.pending_scores:
+            p.delete()
+
+        # Delete the copies in the leaderboard windows
+        for w in game.window_scores:
+            w.delete()
+
         # Delete scores by country statistics
-        for sc in game.nro_scores_country:
-            sc.delete()
+        countries = list( game.nro_scores_country )
+        counter.delete_scores( game, countries )
+        db.delete( countries )
 
         # Delete categories
         for c in game.categories:
@@ -692,9 +746,11 @@ class DeleteGame(BaseHandler):
         # Delete fields
         for f in game.score_fields:
             f.delete()
+        invalidate_schema( game )
 
         # Delete the game
         game.delete()
+        invalidate_config( name )
         self.redirect('/user/list-games')
 
 #
@@ -721,11 +777,17 @@ class DeleteScores(BaseHandler):
         for s in game.scores:
             s.delete()
 
-        for sc in game.nro_scores_country:
-            sc.delete()
+        for w in game.window_scores:
+            w.delete()
+
+        countries = list( game.nro_scores_country )
+        counter.delete_scores( game, countries )
+        db.delete( countries )
 
         game.nro_scores = 0
         game.put()
+        invalidate_config( name )
+        pagecache.invalidate_game( game.key() )
 
         self.redirect('/user/list-games')
 #
@@ -761,6 +823,9 @@ class EditScores(BaseHandler):
         if not deviceid:
             deviceid = ''
 
+        # continue from the previous page ?
+        cursor = self.request.get('cursor')
+
         limit = 20
 
         order = '-cc_score'
@@ -774,20 +839,22 @@ class EditScores(BaseHandler):
             query.filter('cc_country =',country)
         if deviceid:
             query.filter('cc_device_id =',deviceid)
-        scores = query.fetch(limit=limit, offset=offset)
+        scores, offset, next_cursor = fetch_page( query, limit, offset, cursor )
 
         fields = game.score_fields
 
         show_prev = ( offset > 0 )
-        show_next = ( len(scores) == limit )
+        show_next = ( next_cursor is not None )
 
         # iPhone ??
         supports_flash = not 'iphone' in os.environ['HTTP_USER_AGENT'].lower()
 
+        scores_by_country = counter.get_scores_by_country( game )
+
         params = {
             'offset' : offset,
-            'next_offset' : offset + limit,
-            'prev_offset' : offset - limit,
+            'next_cursor' : next_cursor,
+            'prev_offset' : max( offset - limit, 0 ),
             'show_next' : show_next,
             'show_prev' : show_prev,
             'category' : category,
@@ -795,13 +862,13 @@ class EditScores(BaseHandler):
             'deviceid' : deviceid,
             'fields' : fields,
             'scores' : scores,
-            'scores_by_country' : game.nro_scores_country,
-            'total_countries' : game.nro_scores_country.count(),
+            'scores_by_country' : scores_by_country,
+            'total_countries' : len( scores_by_country ),
             'game' : game,
             'dev' : game.owner,
             'country' : country,
             'supports_flash' : supports_flash,
-            'page' : {'title' : 'Game Scores: %s (%s)' % (gamename,game.nro_scores,) },
+            'page' : {'title' : 'Game Scores: %s (%s)' % (gamename,game.total_scores(),) },
         }
         self.respond('user-edit-scores', params)
     
@@ -833,23 +900,44 @@ class EditScores(BaseHandler):
         key = db.Key(key)
         score = Score.get( key )
 
-        # scores country
-        query = db.Query(ScoresCountry)
-        query.ancestor( game )
-        query.filter('country_code =', score.cc_country)
-        score_country = query.fetch(limit=1)[0]
-
         if score:
             if game.ranking_enabled:
                 #NOTE: this is the implementation to get profile ID in api.py
                 profile_id = "%s@%s" % (score.cc_playername, score.cc_device_id)
                 ranker = self.get_ranker( game.key(), score.cc_category )
+
+                # the scores sent with post-score have no name in the rankers.
+                # They are removed by value
+                def remove( ranker ):
+                    if score.cc_ranked_by == 'value':
+                        ranker.RemoveScores( [[score.cc_score]] )
+                    else:
+                        ranker.SetScore( profile_id, None )
+
                 try:
-                    ranker.SetScore( profile_id, None )
+                    remove( ranker )
                 except Exception, e:
                     logging.error('DeleteScore: cannot delete score from ranking')
 
-            self.delete_score_transac( score, game, score_country ) #Delete score from DB after score is deleted from Ranker
+                # and from the ranker of its country
+                try:
+                    remove( self.get_ranker( game.key(), ranking.country_ranking_name( score.cc_category, score.cc_country ) ) )
+                except datastore_errors.EntityNotFoundError, e:
+                    # the country doesn't have a ranker
+                    pass
+                except Exception, e:
+                    logging.error('DeleteScore: cannot delete score from country ranking')
+
+                # and from the rankers of the leaderboard windows
+                for copy in windows.copies_of( score ):
+                    try:
+                        remove( self.get_ranker( game.key(), windows.ranking_name( score.cc_category, copy.cc_window ) ) )
+                    except Exception, e:
+                        logging.error('DeleteScore: cannot delete score from window ranking')
+
+            self.delete_score_transac( score ) #Delete score from DB after score is deleted from Ranker
+            counter.add_scores( game, { score.cc_country : -1 } )
+            pagecache.invalidate_category( game.key(), score.cc_category )
 
         else:
             raise Exception('EditScores: Score not not found')
@@ -858,12 +946,9 @@ class EditScores(BaseHandler):
     # delete score, runs in trasaction
     #
     @transactional
-    def delete_score_transac( self, score, game, score_country ):
+    def delete_score_transac( self, score ):
+        db.delete( windows.copies_of( score ).fetch( 10 ) )
         score.delete()
-        score_country.quantity -= 1
-        score_country.put()
-        game.nro_scores -=1 
-        game.put()
         #ranker.SetScore(name, None)
 
 #
@@ -949,6 +1034,7 @@ class DeleteField(BaseHandler):
 
         field = game.score_fields.filter('name =', fieldname).fetch( limit=1 )[0]
         field.delete()
+        invalidate_schema( game )
         self.redirect('/user/edit-game?gamename=%s' % gamename)
 
 
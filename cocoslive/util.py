@@ -11,6 +11,12 @@ __docformat__ = 'restructuredtext'
 # GAE imports
 from google.appengine.api import urlfetch
 from google.appengine.api import memcache
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.runtime import apiproxy_errors
+
+# local imports
+import configuration
+from cache import LRUCache
 
 
 # IMPORTNAT:
@@ -23,7 +29,50 @@ try:
 except Exception, e:
     from geoutil_public import get_services
 
-__all__ = ['getGeoIPCode']
+# local Geo IP database. Used before any remote service
+import geolocal
+
+__all__ = ['getGeoIPCode', 'GeoIPLookup', 'getGeoIPStats']
+
+# per-process cache in front of memcache, keyed by the 20 bit netmask
+GEOIP_LOCAL_SIZE = 10000
+GEOIP_LOCAL_TTL = 60 * 60           # 1 hour
+# 'xx' (unknown country) answers are cached too, but for less time (in memcache too)
+GEOIP_NEGATIVE_TTL = 60 * 10        # 10 minutes
+
+_geoip_cache = LRUCache( GEOIP_LOCAL_SIZE, GEOIP_LOCAL_TTL )
+
+# where the answers came from, in this instance.
+# the deltas are added to the memcache counters every GEOIP_STATS_FLUSH lookups
+GEOIP_STATS_FLUSH = 100
+GEOIP_STATS = ('local_db', 'process', 'memcache', 'remote', 'negative')
+_geoip_stats = dict( [ (k, 0) for k in GEOIP_STATS ] )
+_geoip_stats_pending = dict( [ (k, 0) for k in GEOIP_STATS ] )
+
+def _count_geoip( stat ):
+    _geoip_stats[ stat ] += 1
+    _geoip_stats_pending[ stat ] += 1
+    if sum( _geoip_stats_pending.values() ) >= GEOIP_STATS_FLUSH:
+        for (k, delta) in _geoip_stats_pending.items():
+            if delta:
+                memcache.incr( 'geoip_stats:%s' % k, delta, initial_value=0 )
+            _geoip_stats_pending[ k ] = 0
+
+def getGeoIPStats():
+    '''returns the Geo IP lookup counters of this instance and of all the instances (approximated)
+    as two dicts: source -> number of lookups'''
+    instance = dict( _geoip_stats )
+    instance['cached_netmasks'] = len( _geoip_cache )
+    total = memcache.get_multi( GEOIP_STATS, key_prefix='geoip_stats:' )
+    for k in GEOIP_STATS:
+        total[ k ] = total.get( k, 0 )
+    return (instance, total)
+
+def _cache_geoip( netmask, geoipcode ):
+    if geoipcode == 'xx':
+        _geoip_cache.set( netmask, geoipcode, GEOIP_NEGATIVE_TTL )
+    else:
+        _geoip_cache.set( netmask, geoipcode )
 
 def ipaddr_to_hex( ipaddr ):
     '''converts an ipaddress to it's hexadecimal representation to reduce memory on the memcache'''
@@ -36,49 +85,110 @@ def ipaddr_to_hex( ipaddr ):
         pass
     return ret
 
-def getGeoIPCode(ipaddr):
+class GeoIPLookup( object ):
+    '''Asynchronous getGeoIPCode.
+    The remote services are queried in parallel as soon as the lookup is created,
+    so the caller can keep working while they answer.
+    get_result() returns the first valid answer, or 'xx'
+    '''
 
-    hex_ipaddr = ipaddr_to_hex( ipaddr)
+    def __init__( self, ipaddr, deadline=configuration.GEOIP_DEADLINE, remote=True ):
+        '''If remote is False, only the local database and the cache are used.
+        When both miss, the lookup is 'deferred' and get_result() returns 'xx'
+        '''
+        self.ipaddr = ipaddr
+        self.rpcs = []
+        self.deferred = False
 
-    # use the 20 first bits for the cache.
-    # it is assumed that the rest 12 bits belongs to the same country
-    # this reduces queries and memory, and improves performance
-    netmask = hex_ipaddr[0:5]
+        # the local database doesn't need the cache
+        self.result = geolocal.lookup( ipaddr )
+        if self.result:
+            _count_geoip( 'local_db' )
+            return
 
-    # new memcache key (6 bytes)
-    new_memcache_key = "%s" % netmask
+        # use the 20 first bits for the cache.
+        # it is assumed that the rest 12 bits belongs to the same country
+        # this reduces queries and memory, and improves performance
+        self.memcache_key = ipaddr_to_hex( ipaddr )[0:5]
 
-    data = memcache.get(new_memcache_key)
-    if data is not None:
-        return data
- 
-    services = get_services()
-    geoipcode = ''
+        # busy NATs post many times from the same netmask
+        self.result = _geoip_cache.get( self.memcache_key )
+        if self.result is not None:
+            if self.result == 'xx':
+                _count_geoip( 'negative' )
+            else:
+                _count_geoip( 'process' )
+            return
 
-    for service in services:
-        try:
-            fetch_response = urlfetch.fetch( service % ipaddr)
-            if fetch_response.status_code == 200:
-                geoipcode = fetch_response.content
+        self.result = memcache.get( self.memcache_key )
+        if self.result is not None:
+            _count_geoip( 'memcache' )
+            _cache_geoip( self.memcache_key, self.result )
+            return
 
-            geoipcode = geoipcode.strip().lower()
-            if geoipcode.startswith('(null)') or geoipcode == 'none' or geoipcode =='':
-                geoipcode = ''
+        if not remote:
+            self.deferred = True
+            return
+
+        for service in get_services():
+            rpc = urlfetch.create_rpc( deadline=deadline )
+            try:
+                urlfetch.make_fetch_call( rpc, service % ipaddr )
+            except urlfetch.Error, e:
                 continue
-            else:
-                break
-        except urlfetch.Error, e:
-            continue
+            self.rpcs.append( rpc )
+
+    def parse_response( self, rpc ):
+        '''returns the country code answered by a service, or '' '''
+        try:
+            fetch_response = rpc.get_result()
+        except (urlfetch.Error, apiproxy_errors.Error), e:
+            return ''
+        if fetch_response.status_code != 200:
+            return ''
+        geoipcode = fetch_response.content.strip().lower()
+        if geoipcode.startswith('(null)') or geoipcode == 'none':
+            return ''
+        return geoipcode
+
+    def peek( self ):
+        '''returns the country code if it is already known (without waiting), or None'''
+        if self.result is None and self.deferred:
+            return 'xx'
+        return self.result
+
+    def get_result( self ):
+        '''waits for the services, and returns the country code'''
+        if self.result is not None:
+            return self.result
 
-    if geoipcode:
-        # convert to lower case, and store in mem cache
-        if geoipcode == '':
+        if self.deferred:
+            # not cached: it will be resolved later
+            return 'xx'
+
+        geoipcode = ''
+        pending = list( self.rpcs )
+        while pending and not geoipcode:
+            # first non-null answer wins
+            rpc = apiproxy_stub_map.UserRPC.wait_any( pending )
+            pending.remove( rpc )
+            geoipcode = self.parse_response( rpc )
+
+        if not geoipcode:
             geoipcode = 'xx'
-    else:
-        geoipcode = 'xx'
 
-#    time = 60 * 60 * 24 * 30    # 30 days
-    time = 0                # never expires
-    memcache.set(new_memcache_key, geoipcode, time)
+#        time = 60 * 60 * 24 * 30    # 30 days
+        time = 0                # never expires
+        if geoipcode == 'xx':
+            # maybe the services were down: ask them again later
+            time = GEOIP_NEGATIVE_TTL
+        memcache.set( self.memcache_key, geoipcode, time )
+        _cache_geoip( self.memcache_key, geoipcode )
+        _count_geoip( 'remote' )
 
-    return geoipcode
+        self.result = geoipcode
+        return geoipcode
+
+
+def getGeoIPCode(ipaddr):
+    return GeoIPLookup( ipaddr ).get_result()
@@ -26,6 +26,12 @@ import simplejson as json
 # local imports
 from model import Game, Score, ScoreField, ScoresCountry
 from util import *
+from schema import get_schema
+import pagecache
+import meter
+import gameconfig
+import windows
+from paging import fetch_page
 
 
 class BaseHandler( webapp.RequestHandler):
@@ -46,11 +52,19 @@ class BaseHandler( webapp.RequestHandler):
             self.response.out.write('variable %s not found' % gamename)
             return False
 
-        self.game = Game.get_by_key_name( self.game_name )
+        # read only snapshot of the game
+        self.game = gameconfig.get_config( self.game_name )
         if not self.game:
             self.response.set_status(400)
             self.response.out.write('game not found %s' % self.game_name)
             return False
+
+        # the window of the leaderboard. See get_window
+        query_type = self.request.get('querytype')
+        if query_type and not query_type.isdigit():
+            self.response.set_status(400)
+            self.response.out.write('invalid querytype %s' % query_type)
+            return False
         return True
 
 #
@@ -63,6 +77,13 @@ class BaseHandler( webapp.RequestHandler):
 # Query type:
 QueryIgnore, QueryDay, QueryWeek, QueryMonth, QueryAllTime = xrange(5)
 #
+# Query type -> leaderboard window period. See windows.py
+QUERY_PERIODS = {
+    QueryDay : 'day',
+    QueryWeek : 'week',
+    QueryMonth : 'month',
+}
+#
 # Query flags:
 QueryFlagNone = 0
 QueryFlagByCountry = 1 << 0
@@ -77,22 +98,8 @@ class GetScores(BaseHandler):
 
     def __init__(self):
         super( GetScores, self ).__init__()
-        self.json = []
         self.position = 0
 
-
-    def entity_to_json(self, e, fields):
-        '''Converts an entity to JSON format'''
-        d = {}
-        for f in fields:
-            key = f.name
-            value = getattr( e, f.name, "N/A" )
-            d[key] =  value
-
-        d['position'] = self.position
-        self.json.append( d )
-        self.position += 1
-
     def get_offset(self):
         '''Get the offset argument. Default 0'''
         offset = self.request.get('offset')
@@ -103,6 +110,13 @@ class GetScores(BaseHandler):
         self.position = offset
         return offset
 
+    def get_cursor(self):
+        '''Get the cursor argument. Default None'''
+        cursor = self.request.get('cursor')
+        if not cursor:
+            return None
+        return cursor
+
     def get_limit(self):
         '''Get the limit argument. Default 25. Maximum limit is 100'''
         limit = self.request.get('limit')
@@ -129,28 +143,17 @@ class GetScores(BaseHandler):
             return '-cc_score'
         return 'cc_score'
 
-    def get_query_type(self):
-        '''Get query type. Default: All time'''
+    def get_window(self):
+        '''returns the name of the current window of the 'querytype' argument,
+        or None for all time queries and for the games without windowed leaderboards.
+        validate_name already checked that it is a number'''
         query_type = self.request.get('querytype')
-
-        now = datetime.datetime.now()
         if not query_type:
-            query_type = QueryAllTime
-        else:
-            query_type = int(query_type)
-
-        if query_type == QueryDay:
-            delta = datetime.timedelta(days=1)
-        elif query_type == QueryWeek:
-            delta = datetime.timedelta(weeks=1)
-        elif query_type == QueryMonth:
-            delta = datetime.timedelta(days=30)
-        else:
-            delta = None
-
-        if delta:
-            return now - delta
-        return None
+            return None
+        period = QUERY_PERIODS.get( int(query_type) )
+        if period is None or not self.game.windowed_leaderboards:
+            return None
+        return windows.current_window( period )[0]
 
     def get_query_flags(self):
         '''Get flags'''
@@ -176,9 +179,11 @@ class GetScores(BaseHandler):
         Valid arguments:
             gamename: Name of the game. Required field
             offset: offset from the query. Default 0
+            cursor: continue from a previous page ('next_cursor' of the previous answer). Overrides offset
             limit: how many scores to send back. Default 25
             category: category of the game
             order: desc or asc ?
+            querytype: 1 day, 2 week, 3 month, 4 all time (default). Only for games with windowed leaderboards
             flags: flags for the query, like:only scores from country
             device: filter by this device
             jsonCallback: JSONP callback function
@@ -187,57 +192,64 @@ class GetScores(BaseHandler):
             logging.error('API get-scores: Name validation failed')
             return
 
+        meter.pop( self.game_name )
+
         offset = self.get_offset()
+        cursor = self.get_cursor()
         limit = self.get_limit()
         category = self.get_category()
         order = self.get_order()
-        dates = self.get_query_type()
+        window = self.get_window()
         flags = self.get_query_flags()
         jsonCallback = self.get_json_callback()
 
-        # sort the scores by the score field
-        query = db.Query(Score)
-        query.ancestor( self.game ).filter('cc_category =',category)
+        country = None
+        device = None
 
         # only by country ?
         if QueryFlagByCountry & flags:
             country = getGeoIPCode( self.request.remote_addr)
-            if country:
-                query.filter('cc_country =', country)
-            else:
+            if not country:
                 logging.error('API get-scores: Cannot locate country for current IP')
                 return
 
         # device and country can't be at the same time
         elif QueryFlagByDevice & flags:
             device = self.get_device_id()
-            if device:
-                query.filter('cc_device_id = ', device)
-            else:
+            if not device:
                 logging.error('API get-scores: Device parameter missing')
                 return
 
-        #if dates:
-        #    query.filter('cc_when >', dates)
+        # same query, same answer until somebody writes a score in this category
+        shape = ( 'widget', offset, cursor, limit, order, window, country, device, jsonCallback )
+        body, generation = pagecache.get_page( self.game.key(), category, shape )
+        if body is not None:
+            self.response.out.write( body )
+            return
+
+        # sort the scores by the score field
+        if window:
+            query = windows.query( self.game.key(), category, window )
+        else:
+            query = db.Query(Score)
+            query.ancestor( self.game.key() ).filter('cc_category =',category)
+        if country:
+            query.filter('cc_country =', country)
+        elif device:
+            query.filter('cc_device_id = ', device)
+
         query.order(order)
-        results = query.fetch(limit=limit, offset=offset)
+        results, self.position, next_cursor = fetch_page( query, limit, offset, cursor )
         
-        # filter the fields to send to the usr
-        query = db.Query(ScoreField)
-        query.ancestor( self.game).filter('send =', True)
-        count = query.count()
-        fields = query.fetch(limit=count)
-
-        # convert the restuls to JSON format
-        for r in results:
-            self.entity_to_json(r, fields)
+        positions = range( self.position, self.position + len(results) )
 
-        # to comply with JSON parser in objective-c
-        # a dictionary shall be the first element
-        d = { 'scores' : self.json }
+        # convert the results to JSONP format, with the fields to send to the usr
+        serializer = get_schema( self.game ).serializer( "N/A" )
+        body = serializer.dumps_jsonp( jsonCallback, results, positions, { 'next_cursor' : next_cursor } )
+        pagecache.set_page( self.game.key(), category, shape, body, generation )
 
         # send back the info
-        self.response.out.write( "%s(%s)" % (jsonCallback, json.dumps( d ) ) )
+        self.response.out.write( body )
         
 
 application = webapp.WSGIApplication([
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+#
+# cocos live - (c) 2009 Ricardo Quesada
+# http://www.cocoslive.net
+#
+# License: GNU GPL v3
+# See the LICENSE file
+#
+__docformat__ = 'restructuredtext'
+
+#
+# Leaderboard windows
+#
+# Games with 'windowed_leaderboards' keep a copy of their scores (WindowScore)
+# in each current window: the day, the ISO week and the month (UTC).
+# The copies have the window name in cc_window, so the top list of a window is
+# an equality filter plus the score order, like the all time queries.
+# Update-score games keep 1 copy per player and window: the best score of the
+# player in that window. Post-score games copy every score.
+#
+# Ranked games also have a ranker per category and window: the Ranking entity
+# '<category>/<window>'.
+#
+# The copies and the rankers expire when their window ends. sweep() deletes them.
+#
+
+# python imports
+import datetime
+
+# GAE imports
+from google.appengine.api import datastore
+from google.appengine.ext import db
+
+# local imports
+from model import WindowScore
+import meter
+import ranking
+from gameconfig import invalidate_config
+
+__all__ = ['PERIODS', 'current_window', 'current_windows', 'ranking_name', 'profile_keys',
+    'new_copies', 'best_copies', 'link', 'copies_of', 'query', 'sweep',
+]
+
+PERIODS = ('day', 'week', 'month')
+
+# Score properties that are copied, besides the dynamic ones
+FIELDS = ( 'cc_device_id', 'cc_category', 'cc_ip', 'cc_country', 'cc_playername' )
+
+
+def _expires( period, when ):
+    '''returns the end of the window of a period that contains when'''
+    day = datetime.datetime( when.year, when.month, when.day )
+    if period == 'day':
+        return day + datetime.timedelta( days=1 )
+    elif period == 'week':
+        return day + datetime.timedelta( days=7 - day.weekday() )
+    elif period == 'month':
+        if when.month == 12:
+            return datetime.datetime( when.year + 1, 1, 1 )
+        return datetime.datetime( when.year, when.month + 1, 1 )
+    raise ValueError( 'Invalid period: %s' % period )
+
+
+def current_window( period, when=None ):
+    '''returns the (name, expires) of the window of a period that contains when (default: now).
+    The names are the ones of the usage meter buckets. eg: 'week_201042' '''
+    if when is None:
+        when = datetime.datetime.utcnow()
+    bucket = dict( meter.buckets( when ) )[ period ]
+    return ( '%s_%d' % (period, bucket), _expires( period, when ) )
+
+
+def current_windows( when=None ):
+    '''returns the (name, expires) of every current window'''
+    if when is None:
+        when = datetime.datetime.utcnow()
+    return [ current_window( period, when ) for period in PERIODS ]
+
+
+def ranking_name( category, window ):
+    '''name of the Ranking of a category in a window'''
+    return '%s/%s' % ( category, window )
+
+
+def _copy( score, copy ):
+    '''copies the fields of a Score (or a PendingScore) to a WindowScore'''
+    for name in FIELDS:
+        value = getattr( score, name, None )
+        if value is not None:
+            setattr( copy, name, value )
+    for name in score.dynamic_properties():
+        setattr( copy, name, getattr( score, name ) )
+
+
+def new_copies( game_key, score, when=None ):
+    '''returns a new WindowScore per current window, with the fields of a posted score.
+    They are not saved. See link()'''
+    copies = []
+    for (window, expires) in current_windows( when ):
+        copy = WindowScore( parent=game_key, cc_game=game_key, cc_window=window, cc_expires=expires )
+        _copy( score, copy )
+        copies.append( copy )
+    return copies
+
+
+def _key_name( window, category, profile_id ):
+    return '%s:%s:%s' % ( window, category, profile_id )
+
+
+def profile_keys( game_key, category, profile_id, when=None ):
+    '''returns the keys of the WindowScores of a player in the current windows'''
+    return [ db.Key.from_path( 'WindowScore', _key_name( window, category, profile_id ), parent=game_key )
+            for (window, expires) in current_windows( when ) ]
+
+
+def best_copies( game_key, score, profile_id, is_better, prefetcher=None, when=None ):
+    '''returns the WindowScores of a player (update-score) in which score is the best score
+    of the window, with the fields of the score. They are not saved. See link().
+    is_better: function( new_value, old_value ) that compares 2 scores.
+    prefetcher: a Prefetcher used to get the current copies'''
+    keys = profile_keys( game_key, score.cc_category, profile_id, when )
+    if prefetcher is not None:
+        olds = prefetcher.get_multi( keys )
+    else:
+        olds = db.get( keys )
+
+    copies = []
+    for ((window, expires), key, old) in zip( current_windows( when ), keys, olds ):
+        if old is not None and not is_better( score.cc_score, old.cc_score ):
+            continue
+        if old is None:
+            old = WindowScore( key_name=key.name(), parent=game_key, cc_game=game_key, cc_window=window, cc_expires=expires )
+        _copy( score, old )
+        copies.append( old )
+    return copies
+
+
+def link( pairs ):
+    '''pairs: list of (Score, WindowScore). Points the copies to their (saved) scores,
+    and returns the copies. Call it in the transaction that saves the scores'''
+    copies = []
+    for (score, copy) in pairs:
+        copy.cc_source = score.key()
+        copies.append( copy )
+    return copies
+
+
+def copies_of( score ):
+    '''query of the WindowScores of a Score. Can be used in the game's transactions'''
+    return WindowScore.all().ancestor( score.parent_key() ).filter( 'cc_source =', score.key() )
+
+
+def query( game_key, category, window ):
+    '''query of the scores of a category in a window. Add the order (and the
+    country or device filters) like in the Score queries'''
+    q = db.Query( WindowScore )
+    q.ancestor( game_key ).filter( 'cc_category =', category ).filter( 'cc_window =', window )
+    return q
+
+
+def sweep( limit=500 ):
+    '''deletes up to 'limit' expired WindowScores and the expired rankers.
+    Returns True if there is nothing else to delete'''
+    now = datetime.datetime.utcnow()
+
+    keys = WindowScore.all( keys_only=True ).filter( 'cc_expires <', now ).fetch( limit )
+    db.delete( keys )
+    done = len( keys ) < limit
+
+    rankings = datastore.Query( 'Ranking', { 'expires <' : now } ).Get( 10 )
+    if len( rankings ) == 10:
+        done = False
+    for entity in rankings:
+        if ranking.delete_ranking( entity, limit ):
+            # the snapshots of the game have the roots of the rankers
+            invalidate_config( entity.key().parent().name() )
+        else:
+            done = False
+    return done